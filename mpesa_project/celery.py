@@ -19,4 +19,24 @@ app.conf.beat_schedule = {
         "task": "payments.tasks.reconcile_transactions",
         "schedule": crontab(minute="*/5"),
     },
+    # Resolve PENDING transactions whose callback never arrived
+    "resolve-stale-pending-every-2-min": {
+        "task": "payments.tasks.resolve_stale_pending",
+        "schedule": crontab(minute="*/2"),
+    },
+    # Drain callbacks stored by the ingest-only fast path in micro-batches
+    "drain-callback-logs-every-5-s": {
+        "task": "payments.tasks.drain_callback_logs",
+        "schedule": 5.0,
+    },
+    # Publish the task outbox even when no relay_outbox process is running
+    "relay-task-outbox-every-10-s": {
+        "task": "payments.tasks.relay_task_outbox",
+        "schedule": 10.0,
+    },
+    # Archive and prune callback logs past the retention window, off-peak
+    "archive-callback-logs-daily": {
+        "task": "payments.tasks.archive_callback_logs",
+        "schedule": crontab(hour=2, minute=30),
+    },
 }
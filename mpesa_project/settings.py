@@ -60,6 +60,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its counts include queries made by the middleware below
+    'payments.profiling.QueryProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -96,6 +98,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Take the write lock at BEGIN: a read-then-write atomic block would
+        # otherwise fail with "database is locked" under concurrent writers
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
     }
 }
 
@@ -137,6 +142,18 @@ USE_TZ = True
 STATIC_URL = 'static/'
 
 
+# Shared cache (OAuth tokens etc.). Uses Redis when configured so gunicorn and
+# Celery workers share entries; otherwise Django's per-process memory cache.
+_cache_url = os.getenv('CACHE_URL') or os.getenv('REDIS_URL')
+if _cache_url:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': _cache_url,
+        }
+    }
+
+
 # Celery / Redis
 CELERY_BROKER_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = CELERY_BROKER_URL
@@ -149,6 +166,143 @@ MPESA_PASSKEY = os.getenv('MPESA_PASSKEY')
 MPESA_ENV = os.getenv('MPESA_ENV', 'sandbox')
 MPESA_CALLBACK_URL = os.getenv('MPESA_CALLBACK_URL', '')
 
+# Override the Daraja host, e.g. to point at a local stub server
+MPESA_BASE_URL = os.getenv('MPESA_BASE_URL', '')
+
+# Daraja HTTP client: connection pool, timeouts (seconds) and circuit breaker
+MPESA_POOL_CONNECTIONS = int(os.getenv('MPESA_POOL_CONNECTIONS', '4'))
+MPESA_POOL_MAXSIZE = int(os.getenv('MPESA_POOL_MAXSIZE', '20'))
+MPESA_CONNECT_TIMEOUT = float(os.getenv('MPESA_CONNECT_TIMEOUT', '3.05'))
+MPESA_READ_TIMEOUT = float(os.getenv('MPESA_READ_TIMEOUT', '15'))
+MPESA_BREAKER_FAILURE_THRESHOLD = int(os.getenv('MPESA_BREAKER_FAILURE_THRESHOLD', '5'))
+MPESA_BREAKER_RESET_TIMEOUT = float(os.getenv('MPESA_BREAKER_RESET_TIMEOUT', '30'))
+
+# Return 202 from /payments/stk-push/ and make the Daraja call from a Celery task
+MPESA_STK_PUSH_ASYNC = os.getenv('MPESA_STK_PUSH_ASYNC', 'False') == 'True'
+
+# Bulk STK push: max rows per request, rows per Celery chunk task and
+# concurrent Daraja calls per chunk
+MPESA_BULK_MAX_ITEMS = int(os.getenv('MPESA_BULK_MAX_ITEMS', '10000'))
+MPESA_BULK_CHUNK_SIZE = int(os.getenv('MPESA_BULK_CHUNK_SIZE', '100'))
+MPESA_BULK_CONCURRENCY = int(os.getenv('MPESA_BULK_CONCURRENCY', '10'))
+
+# Bulk callback replay / admin retry: transactions per Celery chunk task, and
+# the most PENDING transactions one replay may select
+MPESA_REPLAY_CHUNK_SIZE = int(os.getenv('MPESA_REPLAY_CHUNK_SIZE', '500'))
+MPESA_REPLAY_MAX_ROWS = int(os.getenv('MPESA_REPLAY_MAX_ROWS', '50000'))
+
+# Callback fast path: store the raw payload, acknowledge, and process in Celery
+MPESA_CALLBACK_INGEST_ONLY = os.getenv('MPESA_CALLBACK_INGEST_ONLY', 'False') == 'True'
+
+# Process ingested callbacks in micro-batches (drain_callback_logs) instead of
+# one Celery task per callback
+MPESA_CALLBACK_BATCHING = os.getenv('MPESA_CALLBACK_BATCHING', 'False') == 'True'
+MPESA_CALLBACK_BATCH_SIZE = int(os.getenv('MPESA_CALLBACK_BATCH_SIZE', '500'))
+MPESA_CALLBACK_MAX_BATCHES = int(os.getenv('MPESA_CALLBACK_MAX_BATCHES', '20'))
+
+# Acknowledge repeats of a CheckoutRequestID + ResultCode seen within this
+# many seconds straight from the cache, without touching the database
+MPESA_CALLBACK_DEDUP = os.getenv('MPESA_CALLBACK_DEDUP', 'True') == 'True'
+MPESA_CALLBACK_DEDUP_TTL = int(os.getenv('MPESA_CALLBACK_DEDUP_TTL', str(24 * 60 * 60)))
+
+# Reconciliation: PENDING age considered stale, export location and format
+MPESA_RECONCILE_STALE_MINUTES = int(os.getenv('MPESA_RECONCILE_STALE_MINUTES', '10'))
+MPESA_RECONCILE_EXPORT_DIR = os.getenv('MPESA_RECONCILE_EXPORT_DIR', str(BASE_DIR / 'reports'))
+MPESA_RECONCILE_GZIP = os.getenv('MPESA_RECONCILE_GZIP', 'False') == 'True'
+MPESA_RECONCILE_CHUNK_SIZE = int(os.getenv('MPESA_RECONCILE_CHUNK_SIZE', '2000'))
+# Incremental runs export rows changed since the watermark; full sweep interval
+MPESA_RECONCILE_FULL_SWEEP_HOURS = float(os.getenv('MPESA_RECONCILE_FULL_SWEEP_HOURS', '24'))
+MPESA_RECONCILE_WATERMARK_LAG = int(os.getenv('MPESA_RECONCILE_WATERMARK_LAG', '60'))
+
+# Stale PENDING resolver (STK Push Query): chunking, concurrency, and age after
+# which unresolved transactions become TIMEOUT
+MPESA_STK_QUERY_BATCH_SIZE = int(os.getenv('MPESA_STK_QUERY_BATCH_SIZE', '100'))
+MPESA_STK_QUERY_MAX_BATCHES = int(os.getenv('MPESA_STK_QUERY_MAX_BATCHES', '10'))
+MPESA_STK_QUERY_CONCURRENCY = int(os.getenv('MPESA_STK_QUERY_CONCURRENCY', '5'))
+# Single-flight lock for the resolver; outlasts a full run (10 x 100 queries at 5/s)
+MPESA_STK_QUERY_LOCK_TIMEOUT = int(os.getenv('MPESA_STK_QUERY_LOCK_TIMEOUT', '900'))
+MPESA_PENDING_EXPIRY_MINUTES = int(os.getenv('MPESA_PENDING_EXPIRY_MINUTES', '60'))
+
+# Cluster-wide outbound rate limits (calls per second) per Daraja endpoint,
+# shared through Redis ('redis') or per process ('local'). Callers wait up to
+# MPESA_RATE_LIMIT_WAIT seconds for a token before the call is shed.
+MPESA_RATE_LIMITS = {
+    'oauth': float(os.getenv('MPESA_RATE_LIMIT_OAUTH', '1')),
+    'stk_push': float(os.getenv('MPESA_RATE_LIMIT_STK_PUSH', '30')),
+    'stk_query': float(os.getenv('MPESA_RATE_LIMIT_STK_QUERY', '5')),
+}
+MPESA_RATE_LIMIT_BACKEND = os.getenv('MPESA_RATE_LIMIT_BACKEND', 'redis')
+MPESA_RATE_LIMIT_REDIS_URL = os.getenv('MPESA_RATE_LIMIT_REDIS_URL', '')
+MPESA_RATE_LIMIT_WAIT = float(os.getenv('MPESA_RATE_LIMIT_WAIT', '2'))
+
+# Idempotency-Key handling on STK push: how long responses are replayed, and
+# how long concurrent duplicates wait for the first request. The in-flight
+# lock is never shorter than the worst-case Daraja round trip (see
+# payments.idempotency.lock_timeout); 0 uses exactly that.
+MPESA_IDEMPOTENCY_TTL = int(os.getenv('MPESA_IDEMPOTENCY_TTL', str(24 * 60 * 60)))
+MPESA_IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv('MPESA_IDEMPOTENCY_LOCK_TIMEOUT', '0'))
+MPESA_IDEMPOTENCY_WAIT = float(os.getenv('MPESA_IDEMPOTENCY_WAIT', '10'))
+
+# Transaction list API page size (default and upper bound for ?limit=)
+MPESA_TRANSACTIONS_PAGE_SIZE = int(os.getenv('MPESA_TRANSACTIONS_PAGE_SIZE', '50'))
+MPESA_TRANSACTIONS_MAX_PAGE_SIZE = int(os.getenv('MPESA_TRANSACTIONS_MAX_PAGE_SIZE', '200'))
+
+# Status polling cache: entry lifetime, and how long an invalidation blocks
+# readers from re-filling a key
+MPESA_STATUS_CACHE = os.getenv('MPESA_STATUS_CACHE', 'True') == 'True'
+MPESA_STATUS_CACHE_TTL = int(os.getenv('MPESA_STATUS_CACHE_TTL', '60'))
+MPESA_STATUS_CACHE_INVALIDATE_HOLD = int(os.getenv('MPESA_STATUS_CACHE_INVALIDATE_HOLD', '1'))
+
+# Server-sent status events: "redis" (pub/sub across processes) or "local"
+# (in-process only), plus stream lifetime and keepalive interval in seconds
+MPESA_EVENTS_BACKEND = os.getenv('MPESA_EVENTS_BACKEND', 'redis')
+MPESA_EVENTS_REDIS_URL = os.getenv('MPESA_EVENTS_REDIS_URL', '')
+MPESA_EVENTS_TIMEOUT = int(os.getenv('MPESA_EVENTS_TIMEOUT', '300'))
+MPESA_EVENTS_KEEPALIVE = int(os.getenv('MPESA_EVENTS_KEEPALIVE', '15'))
+MPESA_EVENTS_RETRY_MS = int(os.getenv('MPESA_EVENTS_RETRY_MS', '3000'))
+
+# Connection pool of the async Daraja client (per ASGI event loop)
+MPESA_ASYNC_POOL_MAXSIZE = int(os.getenv('MPESA_ASYNC_POOL_MAXSIZE', '200'))
+
+# Callback log retention: processed logs older than this many days are
+# archived to gzip-compressed JSONL under MPESA_CALLBACK_ARCHIVE_DIR and
+# deleted, in batches, with a cap on batches per run
+MPESA_CALLBACK_RETENTION_DAYS = int(os.getenv('MPESA_CALLBACK_RETENTION_DAYS', '90'))
+MPESA_CALLBACK_ARCHIVE_DIR = os.getenv('MPESA_CALLBACK_ARCHIVE_DIR', str(BASE_DIR / 'archive' / 'callbacks'))
+MPESA_CALLBACK_ARCHIVE_BATCH_SIZE = int(os.getenv('MPESA_CALLBACK_ARCHIVE_BATCH_SIZE', '1000'))
+MPESA_CALLBACK_ARCHIVE_MAX_BATCHES = int(os.getenv('MPESA_CALLBACK_ARCHIVE_MAX_BATCHES', '500'))
+
+# Prometheus metrics: optional bearer token for /metrics, PENDING age buckets
+# (seconds) and the port Celery workers serve their own metrics on (0 = off).
+# Set PROMETHEUS_MULTIPROC_DIR in the environment to aggregate across
+# gunicorn / Celery processes (see payments.metrics).
+MPESA_METRICS_TOKEN = os.getenv('MPESA_METRICS_TOKEN', '')
+MPESA_METRICS_PENDING_AGE_BUCKETS = [
+    int(b) for b in os.getenv('MPESA_METRICS_PENDING_AGE_BUCKETS', '60,300,900,3600').split(',')
+]
+MPESA_METRICS_WORKER_PORT = int(os.getenv('MPESA_METRICS_WORKER_PORT', '0'))
+
+# Per-request query profiling: "off", "headers", "buffer" or "both", with
+# the number of slowest statements kept and the ring buffer size
+MPESA_QUERY_PROFILING = os.getenv('MPESA_QUERY_PROFILING', 'off')
+MPESA_QUERY_PROFILING_SLOWEST = int(os.getenv('MPESA_QUERY_PROFILING_SLOWEST', '3'))
+MPESA_QUERY_PROFILING_BUFFER = int(os.getenv('MPESA_QUERY_PROFILING_BUFFER', '200'))
+
+# Queue Celery tasks from the request path in an outbox table, published by
+# `manage.py relay_outbox` (and every 10s by the beat-scheduled
+# relay_task_outbox as a fallback); off publishes to the broker on commit instead
+MPESA_TASK_OUTBOX = os.getenv('MPESA_TASK_OUTBOX', 'True') == 'True'
+MPESA_OUTBOX_BATCH_SIZE = int(os.getenv('MPESA_OUTBOX_BATCH_SIZE', '200'))
+MPESA_OUTBOX_MAX_BATCHES = int(os.getenv('MPESA_OUTBOX_MAX_BATCHES', '50'))
+
+# Admin changelists count at most this many rows (and page no deeper)
+MPESA_ADMIN_COUNT_LIMIT = int(os.getenv('MPESA_ADMIN_COUNT_LIMIT', '10000'))
+
+# OAuth token cache: refresh this many seconds before the token expires
+MPESA_TOKEN_REFRESH_MARGIN = int(os.getenv('MPESA_TOKEN_REFRESH_MARGIN', '300'))
+MPESA_TOKEN_LOCK_TIMEOUT = int(os.getenv('MPESA_TOKEN_LOCK_TIMEOUT', '15'))
+MPESA_TOKEN_WAIT_TIMEOUT = int(os.getenv('MPESA_TOKEN_WAIT_TIMEOUT', '5'))
+
 
 CELERY_BROKER_URL = "redis://localhost:6379/0"
 CELERY_ACCEPT_CONTENT = ["json"]
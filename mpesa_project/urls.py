@@ -18,7 +18,7 @@ from django.contrib import admin
 from django.urls import path, include
 from django.http import HttpResponse
 
-from payments.views import admin_retry_callback
+from payments.views import admin_retry_callback, metrics_view
 
 
 def index(request):
@@ -31,4 +31,6 @@ urlpatterns = [
     path('admin/payments/paymenttransaction/<uuid:transaction_id>/retry/', admin_retry_callback, name='admin_retry_callback'),
     path('admin/', admin.site.urls),
     path('payments/', include('payments.urls')),
+    # Prometheus scrape target
+    path('metrics', metrics_view, name='metrics'),
 ]
@@ -1,15 +1,153 @@
-from django.contrib import admin
+"""
+Admin for the payments tables, built to stay fast on tables with millions
+of rows:
+
+* Counts stop at MPESA_ADMIN_COUNT_LIMIT (PostgreSQL's row estimate is shown
+  for unfiltered lists) and there is no second "full result" count.
+* Date drill-down filters are ranges on an indexed column, and the
+  drill-down links come from the column's first and last value (see
+  ``templatetags/payments_admin.py``).
+* Search is exact, or a prefix search with a trailing ``*``, so it can use
+  an index instead of ``LIKE '%term%'``.
+* Changelist rows load only the columns they display.
+
+Bulk actions hand the work to Celery in chunks: retrying transactions
+starts a CallbackReplayJob (progress on its own admin page), reprocessing
+callback logs requeues them for the drain_callback_logs batch processor.
+"""
+
+import math
+
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.db.models import Q
+from django.urls import reverse
+from django.utils.functional import cached_property
 from django.utils.html import format_html
 
-from .models import PaymentTransaction, CallbackLog
-from .tasks import process_stk_callback
+from . import callbacks, outbox
+from .models import PaymentTransaction, CallbackLog, CallbackReplayJob, ReconciliationState
+from .tasks import ReplaySelectionTooLarge, drain_callback_logs, start_callback_replay
+
+
+def _estimated_rows(queryset):
+    """Planner estimate of the table's row count (PostgreSQL), or None."""
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass", [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] >= 0 else None
+
+
+class CappedCountPaginator(Paginator):
+    """
+    Paginator that never counts past MPESA_ADMIN_COUNT_LIMIT rows.
+
+    Filtered lists are counted with ``COUNT(*)`` over a LIMITed subquery;
+    an unfiltered one uses the planner estimate when that is larger. Pages
+    stop at the limit either way, which also bounds the OFFSET.
+    """
+
+    @cached_property
+    def limit(self):
+        return getattr(settings, "MPESA_ADMIN_COUNT_LIMIT", 10000)
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = _estimated_rows(queryset)
+            if estimate is not None and estimate > self.limit:
+                return estimate
+        return queryset.order_by()[: self.limit].count()
+
+    @cached_property
+    def num_pages(self):
+        count = min(self.count, self.limit)
+        if count == 0 and not self.allow_empty_first_page:
+            return 0
+        return math.ceil(max(1, count - self.orphans) / self.per_page)
+
+
+class ProjectedChangeList(ChangeList):
+    """Changelist that selects only ``model_admin.list_only`` columns."""
+
+    def get_queryset(self, request, *args, **kwargs):
+        queryset = super().get_queryset(request, *args, **kwargs)
+        if self.model_admin.list_only:
+            queryset = queryset.only(*self.model_admin.list_only)
+        return queryset
 
 
-class PaymentTransactionAdmin(admin.ModelAdmin):
+class ScalableAdminMixin:
+    """
+    Capped counts, column projection and index-friendly search.
+
+    ``exact_search_fields`` are matched with ``=``; a term ending in ``*``
+    is a prefix search on ``prefix_search_fields``, run as a range so a
+    plain B-tree index serves it on every database.
+    """
+
+    paginator = CappedCountPaginator
+    show_full_result_count = False
+    list_only = ()
+    exact_search_fields = ()
+    prefix_search_fields = ()
+
+    def get_changelist(self, request, **kwargs):
+        return ProjectedChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+
+        condition = Q()
+        if term.endswith("*"):
+            prefix = term.rstrip("*")
+            if prefix:
+                upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+                for name in self.prefix_search_fields:
+                    condition |= Q(**{f"{name}__gte": prefix, f"{name}__lt": upper, f"{name}__startswith": prefix})
+        else:
+            for name in self.exact_search_fields:
+                try:
+                    value = self.model._meta.get_field(name).to_python(term)
+                except ValidationError:
+                    continue
+                condition |= Q(**{name: value})
+        return (queryset.filter(condition) if condition else queryset.none()), False
+
+
+class PaymentTransactionAdmin(ScalableAdminMixin, admin.ModelAdmin):
     list_display = ("id", "phone_number", "amount", "status", "mpesa_checkout_request_id", "created_at", "retry_button")
+    list_only = ("id", "phone_number", "amount", "status", "mpesa_checkout_request_id", "created_at")
     list_filter = ("status", "created_at")
-    search_fields = ("phone_number", "mpesa_checkout_request_id")
+    date_hierarchy = "created_at"
+    search_fields = ("phone_number", "mpesa_checkout_request_id", "id")
+    exact_search_fields = search_fields
+    prefix_search_fields = ("phone_number",)
+    search_help_text = "Exact phone number, CheckoutRequestID or id; end a phone number with * for a prefix search."
     readonly_fields = ("created_at", "updated_at")
+    actions = ["retry_selected"]
+
+    @admin.action(description="Retry selected PENDING transactions")
+    def retry_selected(self, request, queryset):
+        selection = {"changelist": request.GET.urlencode(), "select_across": request.POST.get("select_across") == "1"}
+        try:
+            job = start_callback_replay(queryset, "admin", selection, created_by=request.user.get_username())
+        except ReplaySelectionTooLarge as e:
+            self.message_user(request, f"Nothing replayed: {e}. Narrow the filters.", messages.ERROR)
+            return
+        url = reverse("admin:payments_callbackreplayjob_change", args=[job.pk])
+        message = format_html('Replay job <a href="{}">{}</a>: {} PENDING transactions enqueued.', url, job.pk, job.total)
+        self.message_user(request, message)
 
     def retry_button(self, obj):
         if obj.status == "PENDING":
@@ -22,12 +160,48 @@ class PaymentTransactionAdmin(admin.ModelAdmin):
     retry_button.allow_tags = True
 
 
-class CallbackLogAdmin(admin.ModelAdmin):
-    list_display = ("id", "checkout_request_id", "received_at", "processed")
+class CallbackLogAdmin(ScalableAdminMixin, admin.ModelAdmin):
+    list_display = ("id", "checkout_request_id", "received_at", "processed", "processing_status")
+    # The payload JSON is only loaded on the change page
+    list_only = list_display
     readonly_fields = ("id", "received_at", "payload")
     list_filter = ("processed",)
-    search_fields = ("checkout_request_id",)
+    date_hierarchy = "received_at"
+    search_fields = ("checkout_request_id", "id")
+    exact_search_fields = search_fields
+    search_help_text = "Exact CheckoutRequestID or id."
+    actions = ["reprocess_selected"]
+
+    @admin.action(description="Reprocess selected unprocessed callbacks")
+    def reprocess_selected(self, request, queryset):
+        with transaction.atomic():
+            count = queryset.filter(processed=False).update(processing_status=callbacks.RECEIVED, details="")
+            if count:
+                batch_size = getattr(settings, "MPESA_CALLBACK_BATCH_SIZE", 500)
+                outbox.enqueue(drain_callback_logs, max_batches=math.ceil(count / batch_size))
+        self.message_user(request, f"{count} callbacks queued for the batch processor.")
+
+
+class CallbackReplayJobAdmin(admin.ModelAdmin):
+    list_display = (
+        "id", "created_at", "source", "created_by", "total", "processed", "applied", "failed", "finished_at"
+    )
+    list_filter = ("source",)
+    readonly_fields = list_display + ("selection",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+class ReconciliationStateAdmin(admin.ModelAdmin):
+    list_display = ("name", "watermark", "last_run_at", "last_run_full", "last_rows_scanned", "last_duration_ms", "last_full_sweep_at")
+    readonly_fields = ("last_run_at", "last_run_full", "last_rows_scanned", "last_duration_ms")
 
 
 admin.site.register(PaymentTransaction, PaymentTransactionAdmin)
 admin.site.register(CallbackLog, CallbackLogAdmin)
+admin.site.register(CallbackReplayJob, CallbackReplayJobAdmin)
+admin.site.register(ReconciliationState, ReconciliationStateAdmin)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class PaymentsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = 'payments'
+
+    def ready(self):
+        # Connects the Celery queue-lag signal handlers in web and worker processes
+        from . import metrics  # noqa: F401
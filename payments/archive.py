@@ -0,0 +1,153 @@
+"""
+CallbackLog retention: archive old callbacks to compressed JSONL, then prune.
+
+Processed callbacks older than MPESA_CALLBACK_RETENTION_DAYS are moved out
+of the database in batches of MPESA_CALLBACK_ARCHIVE_BATCH_SIZE rows, oldest
+first. Each batch is appended to a file partitioned by the day it was
+received::
+
+    <MPESA_CALLBACK_ARCHIVE_DIR>/2024/05/17/callbacks-<run stamp>.jsonl.gz
+    <MPESA_CALLBACK_ARCHIVE_DIR>/2024/05/17/callbacks-<run stamp>.idx
+
+and only deleted once the data file and its index are fsynced, so a crash
+can at worst archive a batch twice, never lose it. Each delete touches one
+batch of primary keys, which keeps row locks short on a busy table.
+
+Every batch is written as its own gzip member (concatenated members are
+still one valid .gz file that ``zcat`` reads end to end). The ``.idx``
+sidecar is a tab-separated line per callback: CheckoutRequestID, byte offset
+of its member, and line number inside the member, so ``find_archived``
+seeks straight to the right block instead of decompressing whole days.
+"""
+
+import datetime
+import gzip
+import json
+import logging
+import os
+from pathlib import Path
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .models import CallbackLog
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FIELDS = ["id", "received_at", "checkout_request_id", "payload", "processed", "processing_status", "details"]
+
+
+def archive_dir(directory=None):
+    return Path(directory or getattr(settings, "MPESA_CALLBACK_ARCHIVE_DIR", "archive/callbacks"))
+
+
+def retention_cutoff(now=None):
+    """Receive time before which a processed callback is archived."""
+    days = getattr(settings, "MPESA_CALLBACK_RETENTION_DAYS", 90)
+    return (now or timezone.now()) - datetime.timedelta(days=days)
+
+
+class _PartitionWriter:
+    """Appends gzip members to one day's data file and its sidecar index."""
+
+    def __init__(self, directory, day, stamp):
+        base = directory / f"{day:%Y/%m/%d}"
+        base.mkdir(parents=True, exist_ok=True)
+        self.data_path = base / f"callbacks-{stamp}.jsonl.gz"
+        self.index_path = base / f"callbacks-{stamp}.idx"
+        self._data = open(self.data_path, "ab")
+        self._index = open(self.index_path, "a", encoding="utf-8")
+
+    def write(self, rows):
+        offset = self._data.tell()
+        lines = [json.dumps(row, cls=DjangoJSONEncoder, separators=(",", ":")) for row in rows]
+        self._data.write(gzip.compress(("\n".join(lines) + "\n").encode("utf-8"), mtime=0))
+        self._index.writelines(
+            f"{row['checkout_request_id']}\t{offset}\t{n}\n"
+            for n, row in enumerate(rows)
+            if row["checkout_request_id"]
+        )
+        for fh in (self._data, self._index):
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+
+def archive_callbacks(cutoff=None, directory=None, batch_size=None, max_batches=None, now=None):
+    """
+    Archive and delete processed CallbackLog rows received before ``cutoff``.
+
+    Unprocessed rows are left alone whatever their age, so nothing the batch
+    processor still has to apply disappears. Stops after ``max_batches``
+    batches (MPESA_CALLBACK_ARCHIVE_MAX_BATCHES) so one run stays bounded;
+    the next run continues where it left off. Returns the number of rows
+    archived and the data files written.
+    """
+    now = now or timezone.now()
+    cutoff = cutoff or retention_cutoff(now)
+    directory = archive_dir(directory)
+    batch_size = batch_size or getattr(settings, "MPESA_CALLBACK_ARCHIVE_BATCH_SIZE", 1000)
+    max_batches = max_batches or getattr(settings, "MPESA_CALLBACK_ARCHIVE_MAX_BATCHES", 500)
+    stamp = now.strftime("%Y%m%dT%H%M%S%fZ")
+
+    queryset = CallbackLog.objects.filter(processed=True, received_at__lt=cutoff).order_by("received_at", "id")
+    writers = {}
+    archived = 0
+    try:
+        for _ in range(max_batches):
+            rows = list(queryset.values(*ARCHIVE_FIELDS)[:batch_size])
+            if not rows:
+                break
+            by_day = {}
+            for row in rows:
+                by_day.setdefault(timezone.localdate(row["received_at"], datetime.timezone.utc), []).append(row)
+            for day, day_rows in by_day.items():
+                if day not in writers:
+                    writers[day] = _PartitionWriter(directory, day, stamp)
+                writers[day].write(day_rows)
+            CallbackLog.objects.filter(pk__in=[row["id"] for row in rows]).delete()
+            archived += len(rows)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    files = [str(writer.data_path) for writer in writers.values()]
+    return {"archived": archived, "files": files}
+
+
+def _read_line(data_path, offset, line_no):
+    with open(data_path, "rb") as fh:
+        fh.seek(offset)
+        with gzip.GzipFile(fileobj=fh) as member:
+            for n, line in enumerate(member):
+                if n == line_no:
+                    return json.loads(line)
+    return None
+
+
+def find_archived(checkout_id, directory=None, day=None):
+    """
+    Yield archived callbacks for ``checkout_id``, oldest partition first.
+
+    Only the small ``.idx`` sidecars are scanned; a data file is opened just
+    for a hit. Pass ``day`` (a date) to search a single partition.
+    """
+    directory = archive_dir(directory)
+    pattern = f"{day:%Y/%m/%d}/*.idx" if day else "*/*/*/*.idx"
+    prefix = f"{checkout_id}\t"
+    for index_path in sorted(directory.glob(pattern)):
+        with open(index_path, encoding="utf-8") as fh:
+            hits = [line.rstrip("\n").split("\t") for line in fh if line.startswith(prefix)]
+        data_path = index_path.with_name(index_path.name[: -len(".idx")] + ".jsonl.gz")
+        for _, offset, line_no in hits:
+            try:
+                record = _read_line(data_path, int(offset), int(line_no))
+            except (OSError, EOFError, ValueError):
+                logger.warning("Unreadable archive entry %s@%s in %s", line_no, offset, data_path, exc_info=True)
+                continue
+            if record is not None:
+                yield record
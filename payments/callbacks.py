@@ -0,0 +1,127 @@
+"""
+Validation and application of M-Pesa STK callbacks.
+
+Shared by the synchronous callback view and the background workers that
+process callbacks ingested by the fast path, so the rules live in one place.
+"""
+
+import logging
+from collections import namedtuple
+
+from . import transitions
+from .models import PaymentTransaction
+
+logger = logging.getLogger(__name__)
+
+# CallbackLog.processing_status of a callback stored by the ingest fast path
+RECEIVED = "received"
+
+# Outcomes of applying a callback
+IGNORED = "ignored"
+NOT_FOUND = "transaction not found"
+DUPLICATE = "already processed"
+AMOUNT_MISMATCH = "amount mismatch"
+AMOUNT_ERROR = "amount verification error"
+PROCESSED = "processed"
+
+CallbackResult = namedtuple("CallbackResult", ["outcome", "checkout_id", "status", "result_desc"])
+
+
+def parse_stk_callback(data):
+    """
+    Pull the fields we use out of an STK callback payload.
+
+    Returns a dict with checkout_id, result_code, result_desc and amount
+    (a float, or None when the callback carries no usable Amount item).
+    """
+    callback = data.get("Body", {}).get("stkCallback", {}) if isinstance(data, dict) else {}
+
+    callback_amount = None
+    items = callback.get("CallbackMetadata", {}).get("Item", [])
+    for item in items:
+        if item.get("Name") == "Amount":
+            try:
+                callback_amount = float(item.get("Value", 0))
+            except Exception:
+                callback_amount = None
+
+    return {
+        "checkout_id": callback.get("CheckoutRequestID"),
+        "result_code": callback.get("ResultCode"),
+        "result_desc": callback.get("ResultDesc"),
+        "amount": callback_amount,
+    }
+
+
+def evaluate_stk_callback(parsed, tx):
+    """
+    Decide what a parsed callback should do to ``tx`` without touching the DB.
+
+    Returns ``(outcome, status)``: the target status for PROCESSED and the
+    amount outcomes, the current status for duplicates, otherwise None.
+    """
+    checkout_id = parsed["checkout_id"]
+    if not checkout_id:
+        logger.warning("Callback ignored: no CheckoutRequestID")
+        return IGNORED, None
+
+    if not tx:
+        logger.warning("Transaction not found for ID: %s", checkout_id)
+        return NOT_FOUND, None
+
+    # Idempotency / duplicate callback protection
+    if tx.status in transitions.TERMINAL_STATUSES:
+        logger.info(
+            "Duplicate callback received for %s. Current status: %s",
+            checkout_id, tx.status
+        )
+        return DUPLICATE, tx.status
+
+    # Amount verification
+    callback_amount = parsed["amount"]
+    if callback_amount is not None:
+        try:
+            expected_amount = float(tx.amount)
+            if expected_amount != callback_amount:
+                logger.warning(
+                    "Amount mismatch for %s: expected %.2f, callback %.2f",
+                    checkout_id, expected_amount, callback_amount
+                )
+                return AMOUNT_MISMATCH, transitions.FAILED
+        except Exception:
+            logger.exception("Error verifying amount for %s", checkout_id)
+            return AMOUNT_ERROR, transitions.FAILED
+
+    return PROCESSED, transitions.status_for_result_code(parsed["result_code"])
+
+
+def apply_stk_callback(data, tx=None):
+    """
+    Validate a callback payload and apply the resulting status transition.
+
+    ``tx`` may be passed when the caller already loaded the transaction
+    (needs ``id``, ``status`` and ``amount``). Returns a ``CallbackResult``.
+    """
+    parsed = parse_stk_callback(data)
+    checkout_id = parsed["checkout_id"]
+    result_desc = parsed["result_desc"]
+
+    if tx is None and checkout_id:
+        tx = PaymentTransaction.objects.filter(
+            mpesa_checkout_request_id=checkout_id
+        ).only("id", "status", "amount").first()
+
+    outcome, status_str = evaluate_stk_callback(parsed, tx)
+    if outcome in (IGNORED, NOT_FOUND, DUPLICATE):
+        return CallbackResult(outcome, checkout_id, status_str, result_desc)
+
+    # Losing the race means a concurrent duplicate already applied a transition
+    if not transitions.transition(tx, status_str):
+        logger.info("Duplicate callback received for %s (lost transition race)", checkout_id)
+        return CallbackResult(DUPLICATE, checkout_id, None, result_desc)
+
+    logger.info(
+        "Callback %s: %s -> %s, desc: %s",
+        outcome, checkout_id, status_str, result_desc
+    )
+    return CallbackResult(outcome, checkout_id, status_str, result_desc)
@@ -0,0 +1,453 @@
+"""
+Shared HTTP client for the Safaricom Daraja API.
+
+A single ``DarajaClient`` per process keeps a pooled, keep-alive
+``requests.Session`` so repeated OAuth and STK calls reuse TCP/TLS
+connections. A circuit breaker fails calls fast once Daraja looks unhealthy,
+instead of tying up worker threads for the full request timeout.
+``AsyncDarajaClient`` does the same for async views on an ``aiohttp``
+connection pool, sharing the breaker and rate limiters.
+"""
+
+import asyncio
+import base64
+import datetime
+import logging
+import threading
+import time
+import weakref
+
+import aiohttp
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from . import metrics, ratelimit
+from .tokens import AccessTokenCache
+
+logger = logging.getLogger(__name__)
+
+SANDBOX_BASE_URL = "https://sandbox.safaricom.co.ke"
+PRODUCTION_BASE_URL = "https://api.safaricom.co.ke"
+
+OAUTH_PATH = "/oauth/v1/generate?grant_type=client_credentials"
+STK_PUSH_PATH = "/mpesa/stkpush/v1/processrequest"
+STK_QUERY_PATH = "/mpesa/stkpushquery/v1/query"
+
+# STK Push Query error returned while the customer has not answered yet
+STK_QUERY_PROCESSING_ERROR = "500.001.1001"
+
+
+def mpesa_base_url():
+    """Return the Daraja base URL for MPESA_ENV, unless MPESA_BASE_URL overrides it."""
+    override = getattr(settings, "MPESA_BASE_URL", "")
+    if override:
+        return override.rstrip("/")
+    if getattr(settings, "MPESA_ENV", "sandbox").lower() == "production":
+        return PRODUCTION_BASE_URL
+    return SANDBOX_BASE_URL
+
+
+def mpesa_base_urls():
+    """Return endpoint URLs depending on MPESA_ENV (sandbox or production)."""
+    base = mpesa_base_url()
+    return {
+        "oauth": base + OAUTH_PATH,
+        "stk_push": base + STK_PUSH_PATH,
+        "stk_query": base + STK_QUERY_PATH,
+    }
+
+
+def _password_and_timestamp():
+    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    password_str = f"{settings.MPESA_SHORTCODE}{settings.MPESA_PASSKEY}{timestamp}"
+    return base64.b64encode(password_str.encode()).decode("utf-8"), timestamp
+
+
+def build_stk_push_payload(phone, amount):
+    """Build the STK push request body for a phone number and Decimal amount."""
+    password, timestamp = _password_and_timestamp()
+
+    callback_url = getattr(settings, "MPESA_CALLBACK_URL", "")
+    return {
+        "BusinessShortCode": settings.MPESA_SHORTCODE,
+        "Password": password,
+        "Timestamp": timestamp,
+        "TransactionType": "CustomerPayBillOnline",
+        "Amount": int(amount),  # M-Pesa expects integer amounts
+        "PartyA": phone,
+        "PartyB": settings.MPESA_SHORTCODE,
+        "PhoneNumber": phone,
+        "CallBackURL": callback_url,
+        "AccountReference": "Payment",
+        "TransactionDesc": "Payment",
+    }
+
+
+def build_stk_query_payload(checkout_id):
+    """Build the STK Push Query request body for a CheckoutRequestID."""
+    password, timestamp = _password_and_timestamp()
+    return {
+        "BusinessShortCode": settings.MPESA_SHORTCODE,
+        "Password": password,
+        "Timestamp": timestamp,
+        "CheckoutRequestID": checkout_id,
+    }
+
+
+class DarajaUnavailable(requests.RequestException):
+    """Raised without a network call while the circuit breaker is open."""
+
+
+class DarajaRateLimited(DarajaUnavailable):
+    """Raised without a network call when the outbound rate limit sheds the request."""
+
+
+class CircuitBreaker:
+    """
+    Classic closed / open / half-open breaker.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    rejects calls for ``reset_timeout`` seconds. It then lets a single trial
+    call through; success closes it again, failure re-opens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """Return True if a call may proceed right now."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            # half-open: allow exactly one trial call at a time
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning("Daraja circuit breaker opened after %d failures", self._failures)
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def reset(self):
+        self.record_success()
+
+
+def _is_processing_reply(resp):
+    """True for STK Push Query's 500 meaning "the customer has not answered yet"."""
+    try:
+        return resp.status_code == 500 and resp.json().get("errorCode") == STK_QUERY_PROCESSING_ERROR
+    except ValueError:
+        return False
+
+
+class DarajaClient:
+    """Pooled, keep-alive client for Daraja with a circuit breaker."""
+
+    def __init__(self, base_url=None, pool_connections=None, pool_maxsize=None,
+                 connect_timeout=None, read_timeout=None, breaker=None):
+        self.base_url = (base_url or mpesa_base_url()).rstrip("/")
+        self.connect_timeout = connect_timeout or getattr(settings, "MPESA_CONNECT_TIMEOUT", 3.05)
+        self.read_timeout = read_timeout or getattr(settings, "MPESA_READ_TIMEOUT", 15)
+        self.breaker = breaker or CircuitBreaker(
+            failure_threshold=getattr(settings, "MPESA_BREAKER_FAILURE_THRESHOLD", 5),
+            reset_timeout=getattr(settings, "MPESA_BREAKER_RESET_TIMEOUT", 30),
+        )
+
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections or getattr(settings, "MPESA_POOL_CONNECTIONS", 4),
+            pool_maxsize=pool_maxsize or getattr(settings, "MPESA_POOL_MAXSIZE", 20),
+            max_retries=0,
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, path, timeout=None, expected_statuses=(), endpoint=None,
+                rate_limit_timeout=None, accept=None, **kwargs):
+        """
+        Send a request through the pooled session and return the response.
+
+        Raises ``DarajaUnavailable`` when the breaker is open and
+        ``requests.RequestException`` on transport errors or HTTP errors.
+        Connection errors, timeouts and 5xx responses count as breaker
+        failures and raise, unless ``accept(response)`` returns True for the
+        5xx: that is an answer from Daraja rather than an outage, so it
+        counts as a success and is returned. 4xx responses count as
+        successes; those in ``expected_statuses`` are returned as-is.
+
+        ``endpoint`` names the MPESA_RATE_LIMITS bucket to draw from. The call
+        waits up to ``rate_limit_timeout`` seconds (default
+        MPESA_RATE_LIMIT_WAIT) for a token and raises ``DarajaRateLimited``
+        otherwise; pass 0 to shed load immediately.
+        """
+        limiter = ratelimit.get_limiter(endpoint) if endpoint else None
+        if limiter is not None:
+            if rate_limit_timeout is None:
+                rate_limit_timeout = getattr(settings, "MPESA_RATE_LIMIT_WAIT", 2)
+            try:
+                limiter.acquire(timeout=rate_limit_timeout)
+            except ratelimit.RateLimitExceeded as e:
+                raise DarajaRateLimited(f"Daraja rate limit for {endpoint}: {e}") from None
+
+        if not self.breaker.allow():
+            raise DarajaUnavailable(f"Daraja circuit open; refusing {method} {path}")
+
+        url = self.base_url + path
+        started = time.perf_counter()
+        try:
+            resp = self.session.request(
+                method, url, timeout=timeout or (self.connect_timeout, self.read_timeout), **kwargs
+            )
+        except requests.RequestException:
+            metrics.observe_daraja(endpoint, started)
+            self.breaker.record_failure()
+            raise
+        metrics.observe_daraja(endpoint, started, resp.status_code)
+
+        if resp.status_code >= 500 and not (accept is not None and accept(resp)):
+            self.breaker.record_failure()
+            resp.raise_for_status()
+        self.breaker.record_success()
+        if resp.status_code < 500 and resp.status_code not in expected_statuses:
+            resp.raise_for_status()
+        return resp
+
+    def _authorized(self, method, path, access_token, expected_statuses=(), **kwargs):
+        """
+        ``request`` with a bearer token. A 401 means the token was revoked or
+        expired early: it is dropped from the token cache and the call is
+        retried once with a fresh one.
+        """
+        resp = self.request(
+            method, path, expected_statuses=(401, *expected_statuses),
+            headers={"Authorization": f"Bearer {access_token}"}, **kwargs,
+        )
+        if resp.status_code == 401:
+            logger.warning("Daraja rejected the access token for %s; refreshing it", path)
+            token_cache.invalidate(rejected=access_token)
+            resp = self.request(
+                method, path, expected_statuses=expected_statuses,
+                headers={"Authorization": f"Bearer {token_cache.get_token()}"}, **kwargs,
+            )
+        return resp
+
+    def fetch_access_token(self):
+        """Request a new OAuth token; returns ``(access_token, expires_in)``."""
+        resp = self.request(
+            "GET", OAUTH_PATH,
+            endpoint="oauth",
+            auth=(settings.MPESA_CONSUMER_KEY, settings.MPESA_CONSUMER_SECRET),
+        )
+        data = resp.json()
+        return data.get("access_token"), data.get("expires_in")
+
+    def stk_push(self, payload, access_token, rate_limit_timeout=None):
+        """Send an STK push request and return the decoded response body."""
+        resp = self._authorized(
+            "POST", STK_PUSH_PATH, access_token,
+            endpoint="stk_push",
+            rate_limit_timeout=rate_limit_timeout,
+            json=payload,
+        )
+        return resp.json()
+
+    def stk_query(self, checkout_id, access_token, rate_limit_timeout=None):
+        """
+        Query the status of an STK push.
+
+        Returns the decoded body. While the customer has not answered yet
+        Daraja replies 500 with errorCode STK_QUERY_PROCESSING_ERROR; that
+        body is returned too instead of being treated as an outage. Any
+        other 5xx is a breaker failure and raises.
+        """
+        resp = self._authorized(
+            "POST", STK_QUERY_PATH, access_token,
+            endpoint="stk_query",
+            rate_limit_timeout=rate_limit_timeout,
+            json=build_stk_query_payload(checkout_id),
+            accept=_is_processing_reply,
+        )
+        return resp.json() if resp.content else {}
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide DarajaClient, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = DarajaClient()
+    return _client
+
+
+def set_client(client):
+    """Replace the process-wide client (e.g. to point at a local stub server)."""
+    global _client
+    with _client_lock:
+        if _client is not None and _client is not client:
+            _client.close()
+        _client = client
+
+
+class AsyncDarajaClient:
+    """
+    asyncio counterpart of ``DarajaClient`` on a pooled ``aiohttp`` session.
+
+    One instance per event loop keeps up to MPESA_ASYNC_POOL_MAXSIZE Daraja
+    calls in flight without a thread each. It uses the process-wide circuit
+    breaker and rate limiters, and raises the same ``requests`` exception
+    types as the sync client so callers can handle both alike.
+    """
+
+    def __init__(self, base_url=None, max_connections=None, connect_timeout=None, read_timeout=None, breaker=None):
+        self.base_url = (base_url or mpesa_base_url()).rstrip("/")
+        self.breaker = breaker or get_client().breaker
+        self.max_connections = max_connections or getattr(settings, "MPESA_ASYNC_POOL_MAXSIZE", 200)
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=connect_timeout or getattr(settings, "MPESA_CONNECT_TIMEOUT", 3.05),
+            sock_read=read_timeout or getattr(settings, "MPESA_READ_TIMEOUT", 15),
+        )
+        self._session = None
+
+    @property
+    def session(self):
+        # aiohttp sessions must be created inside the event loop that uses them
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections), timeout=self.timeout
+            )
+        return self._session
+
+    async def request(self, method, path, expected_statuses=(), endpoint=None, rate_limit_timeout=None, **kwargs):
+        """
+        Send a request and return the response with its body read.
+
+        Same error contract as ``DarajaClient.request``, except that every
+        5xx is a breaker failure (the async client never queries STK status).
+        """
+        limiter = ratelimit.get_limiter(endpoint) if endpoint else None
+        if limiter is not None:
+            if rate_limit_timeout is None:
+                rate_limit_timeout = getattr(settings, "MPESA_RATE_LIMIT_WAIT", 2)
+            try:
+                await limiter.aacquire(timeout=rate_limit_timeout)
+            except ratelimit.RateLimitExceeded as e:
+                raise DarajaRateLimited(f"Daraja rate limit for {endpoint}: {e}") from None
+
+        if not self.breaker.allow():
+            raise DarajaUnavailable(f"Daraja circuit open; refusing {method} {path}")
+
+        started = time.perf_counter()
+        try:
+            async with self.session.request(method, self.base_url + path, **kwargs) as resp:
+                await resp.read()
+        except asyncio.TimeoutError as e:
+            metrics.observe_daraja(endpoint, started)
+            self.breaker.record_failure()
+            raise requests.Timeout(f"{method} {path} timed out") from e
+        except aiohttp.ClientError as e:
+            metrics.observe_daraja(endpoint, started)
+            self.breaker.record_failure()
+            raise requests.ConnectionError(f"{method} {path} failed: {e}") from e
+        metrics.observe_daraja(endpoint, started, resp.status)
+
+        if resp.status >= 500:
+            self.breaker.record_failure()
+            raise requests.HTTPError(f"{resp.status} error for {method} {path}")
+        self.breaker.record_success()
+        if resp.status >= 400 and resp.status not in expected_statuses:
+            raise requests.HTTPError(f"{resp.status} error for {method} {path}")
+        return resp
+
+    async def stk_push(self, payload, access_token, rate_limit_timeout=None):
+        """Send an STK push request and return the decoded response body; retried once on 401."""
+        for retry in (False, True):
+            resp = await self.request(
+                "POST", STK_PUSH_PATH,
+                endpoint="stk_push",
+                rate_limit_timeout=rate_limit_timeout,
+                json=payload,
+                headers={"Authorization": f"Bearer {access_token}"},
+                expected_statuses=() if retry else (401,),
+            )
+            if resp.status != 401:
+                break
+            logger.warning("Daraja rejected the access token for %s; refreshing it", STK_PUSH_PATH)
+            await sync_to_async(token_cache.invalidate, thread_sensitive=False)(rejected=access_token)
+            access_token = await sync_to_async(token_cache.get_token, thread_sensitive=False)()
+        return await resp.json(content_type=None)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """Return the AsyncDarajaClient for the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncDarajaClient()
+    return client
+
+
+async def close_async_client():
+    """Close the running event loop's AsyncDarajaClient, if it has one."""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+token_cache = AccessTokenCache(lambda: get_client().fetch_access_token())
+
+
+def get_access_token():
+    """Obtain an OAuth access token, served from the shared token cache."""
+    return token_cache.get_token()
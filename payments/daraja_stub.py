@@ -0,0 +1,291 @@
+"""
+Local stand-in for the Daraja API, for benchmarks and tests.
+
+Run it in-process and point the client at it::
+
+    server = StubDarajaServer(latency=0.2).start()
+    set_client(DarajaClient(base_url=server.url))
+    ...
+    server.stop()
+
+With ``callback_delay`` set, every accepted STK push is answered like M-Pesa
+does: after the delay the stub POSTs an stkCallback to the push's
+CallBackURL. ``GET /stub/stats`` reports call counts and how those callbacks
+went, for stubs running in another process.
+"""
+
+import heapq
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .daraja import OAUTH_PATH, STK_PUSH_PATH, STK_QUERY_PATH, STK_QUERY_PROCESSING_ERROR
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this, Nagle plus
+    # delayed ACKs add ~40ms to every keep-alive response.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(raw or b"{}")
+        except ValueError:
+            return {}
+
+    def do_GET(self):
+        stub = self.server.stub
+        if self.path == "/stub/stats":
+            return self._send_json(200, stub.stats())
+        stub.record(self.path)
+        if self.path.startswith(OAUTH_PATH.split("?")[0]):
+            stub.simulate_latency()
+            return self._send_json(200, {"access_token": stub.access_token, "expires_in": str(stub.expires_in)})
+        self._send_json(404, {"errorMessage": "not found"})
+
+    def do_POST(self):
+        stub = self.server.stub
+        stub.record(self.path)
+        body = self._read_json()
+        stub.simulate_latency()
+
+        if stub.should_fail():
+            return self._send_json(503, {"errorMessage": "Service unavailable"})
+        if self.headers.get("Authorization", "").removeprefix("Bearer ") in stub.rejected_tokens:
+            return self._send_json(401, {"errorCode": "404.001.04", "errorMessage": "Invalid Access Token"})
+
+        if self.path.startswith(STK_PUSH_PATH):
+            checkout_id = f"ws_CO_{uuid.uuid4().hex[:20]}"
+            stub.pushes[checkout_id] = body
+            stub.schedule_callback(checkout_id, body)
+            return self._send_json(200, {
+                "MerchantRequestID": uuid.uuid4().hex[:12],
+                "CheckoutRequestID": checkout_id,
+                "ResponseCode": "0",
+                "ResponseDescription": "Success. Request accepted for processing",
+                "CustomerMessage": "Success. Request accepted for processing",
+            })
+        if self.path.startswith(STK_QUERY_PATH):
+            checkout_id = body.get("CheckoutRequestID")
+            result_code = stub.query_results.get(checkout_id, stub.default_query_result)
+            if result_code is None:
+                return self._send_json(500, {
+                    "requestId": uuid.uuid4().hex[:12],
+                    "errorCode": STK_QUERY_PROCESSING_ERROR,
+                    "errorMessage": "The transaction is being processed",
+                })
+            return self._send_json(200, {
+                "ResponseCode": "0",
+                "ResponseDescription": "The service request has been accepted successsfully",
+                "MerchantRequestID": uuid.uuid4().hex[:12],
+                "CheckoutRequestID": checkout_id,
+                "ResultCode": str(result_code),
+                "ResultDesc": "Stub result",
+            })
+        self._send_json(404, {"errorMessage": "not found"})
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Room for a load test's worth of simultaneous connects
+    request_queue_size = 1024
+
+
+def stk_callback_payload(checkout_id, result_code, amount=None, phone=None):
+    """An stkCallback body as M-Pesa posts it; metadata only on success."""
+    callback = {
+        "MerchantRequestID": uuid.uuid4().hex[:12],
+        "CheckoutRequestID": checkout_id,
+        "ResultCode": result_code,
+        "ResultDesc": "The service request is processed successfully." if result_code == 0 else "Stub failure",
+    }
+    if result_code == 0:
+        callback["CallbackMetadata"] = {"Item": [
+            {"Name": "Amount", "Value": amount},
+            {"Name": "MpesaReceiptNumber", "Value": uuid.uuid4().hex[:10].upper()},
+            {"Name": "TransactionDate", "Value": int(time.strftime("%Y%m%d%H%M%S"))},
+            {"Name": "PhoneNumber", "Value": phone},
+        ]}
+    return {"Body": {"stkCallback": callback}}
+
+
+class _CallbackSender:
+    """Fires due callbacks from one scheduler thread onto a small pool."""
+
+    def __init__(self, workers):
+        self._due = []
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(workers)
+        self._closed = False
+        self.sent = 0
+        self.failed = 0
+        self.outcomes = {}
+        self.latencies_ms = []
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self, delay, url, payload):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            heapq.heappush(self._due, (time.monotonic() + delay, uuid.uuid4().int, url, payload))
+            self._cond.notify()
+
+    def _run(self):
+        with self._cond:
+            while not self._closed:
+                if not self._due:
+                    self._cond.wait()
+                    continue
+                wait = self._due[0][0] - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                _, _, url, payload = heapq.heappop(self._due)
+                self._pool.submit(self._post, url, payload)
+
+    def _post(self, url, payload):
+        request = urllib.request.Request(
+            url, data=json.dumps(payload).encode("utf-8"), headers={"Content-Type": "application/json"}
+        )
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                outcome = json.loads(response.read() or b"{}").get("status", str(response.status))
+        except (OSError, ValueError) as e:
+            outcome = None
+            error = getattr(e, "code", type(e).__name__)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._stats_lock:
+            if outcome is None:
+                self.failed += 1
+                outcome = f"error:{error}"
+            else:
+                self.sent += 1
+                self.latencies_ms.append(round(elapsed_ms, 2))
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def pending(self):
+        with self._cond:
+            return len(self._due)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "sent": self.sent, "failed": self.failed, "pending": self.pending(),
+                "outcomes": dict(self.outcomes), "latencies_ms": list(self.latencies_ms),
+            }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._pool.shutdown(wait=False)
+
+
+class StubDarajaServer:
+    """
+    Threaded HTTP server that mimics the Daraja endpoints used by this app.
+
+    ``latency`` (seconds) is added to every call and ``error_rate`` is the
+    fraction of POSTs answered with 503. STK Push Query answers with
+    ``query_results[checkout_id]``, falling back to ``default_query_result``;
+    a result of None means "still being processed". POSTs carrying a bearer
+    token in ``rejected_tokens`` are answered 401, like a revoked token.
+
+    ``callback_delay`` (seconds, None to disable) schedules an stkCallback
+    with ``callback_result_code`` for each accepted push, posted
+    ``1 + callback_duplicates`` times to mimic M-Pesa's retries.
+    ``callback_url`` overrides the push's CallBackURL.
+    """
+
+    handler_class = _Handler
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0,
+                 access_token="stub-token", expires_in=3599, callback_delay=None,
+                 callback_result_code=0, callback_duplicates=0, callback_url=None, callback_workers=32):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.access_token = access_token
+        self.expires_in = expires_in
+        self.pushes = {}
+        self.query_results = {}
+        self.default_query_result = 0
+        self.rejected_tokens = set()
+        self.callback_delay = callback_delay
+        self.callback_result_code = callback_result_code
+        self.callback_duplicates = callback_duplicates
+        self.callback_url = callback_url
+        self.callbacks = _CallbackSender(callback_workers)
+        self.calls = {}
+        self._calls_lock = threading.Lock()
+        self._random = random.Random()
+        self._httpd = _Server((host, port), self.handler_class)
+        self._httpd.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self.callbacks.close()
+
+    def record(self, path):
+        key = path.split("?")[0]
+        with self._calls_lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def simulate_latency(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def should_fail(self):
+        return self.error_rate and self._random.random() < self.error_rate
+
+    def schedule_callback(self, checkout_id, push_body):
+        url = self.callback_url or push_body.get("CallBackURL")
+        if self.callback_delay is None or not url:
+            return
+        payload = stk_callback_payload(
+            checkout_id, self.callback_result_code, push_body.get("Amount"), push_body.get("PhoneNumber")
+        )
+        for _ in range(1 + self.callback_duplicates):
+            self.callbacks.schedule(self.callback_delay, url, payload)
+
+    def stats(self):
+        with self._calls_lock:
+            calls = dict(self.calls)
+        return {"calls": calls, "callbacks": self.callbacks.stats()}
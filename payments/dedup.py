@@ -0,0 +1,75 @@
+"""
+Edge de-duplication of M-Pesa callback retries.
+
+M-Pesa retries callbacks aggressively. Before any database work the
+callback view claims ``CheckoutRequestID + ResultCode`` in the cache with an
+atomic add (SETNX on Redis); a second claim within MPESA_CALLBACK_DEDUP_TTL
+is a duplicate and is acknowledged straight away. If the cache is down the
+callback simply takes the normal DB path, whose conditional transitions are
+idempotent anyway.
+"""
+
+import hashlib
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_stats = {"claimed": 0, "suppressed": 0, "unavailable": 0}
+_stats_lock = threading.Lock()
+
+
+def _incr(name):
+    with _stats_lock:
+        _stats[name] += 1
+    metrics.CALLBACK_DEDUP.labels(name).inc()
+
+
+def _key(checkout_id, result_code):
+    digest = hashlib.sha1(f"{checkout_id}:{result_code}".encode("utf-8")).hexdigest()
+    return f"mpesa:cbseen:{digest}"
+
+
+def enabled():
+    return getattr(settings, "MPESA_CALLBACK_DEDUP", True)
+
+
+def claim(checkout_id, result_code):
+    """
+    Claim a callback. Returns False if the same callback was already seen,
+    True if the caller should process it (including when the cache is
+    unavailable).
+    """
+    if not enabled() or not checkout_id:
+        return True
+    try:
+        claimed = cache.add(
+            _key(checkout_id, result_code), 1, timeout=getattr(settings, "MPESA_CALLBACK_DEDUP_TTL", 24 * 60 * 60)
+        )
+    except Exception:
+        logger.warning("Callback de-dup cache unavailable; falling back to DB checks", exc_info=True)
+        _incr("unavailable")
+        return True
+    _incr("claimed" if claimed else "suppressed")
+    return claimed
+
+
+def release(checkout_id, result_code):
+    """Forget a claim so M-Pesa's next retry is processed (e.g. after an error)."""
+    if not enabled() or not checkout_id:
+        return
+    try:
+        cache.delete(_key(checkout_id, result_code))
+    except Exception:
+        logger.warning("Failed to release callback de-dup claim for %s", checkout_id, exc_info=True)
+
+
+def stats():
+    """Return claimed / suppressed / unavailable counters for this process."""
+    with _stats_lock:
+        return dict(_stats)
@@ -0,0 +1,196 @@
+"""
+Push notifications for transactions reaching a final status.
+
+``payments.transitions`` calls ``publish_final`` for every successful move to
+a terminal status. Once the DB transaction commits, the change is published
+as the transition made it (id, status, updated_at and any fields it wrote),
+without reading the row back:
+
+* ``MPESA_EVENTS_BACKEND = "redis"``: to one Redis pub/sub channel. Each ASGI
+  process runs a single subscriber that fans messages out to its own
+  waiters, so one Redis connection serves every open stream in the process.
+* ``"local"``: straight to waiters in this process (tests, or runserver with
+  eager Celery).
+
+Waiters are plain asyncio queues registered per transaction id, which keeps
+an idle stream down to a dict entry and a queue. A stream already holds the
+rest of the row from its first read and merges the message into it.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from rest_framework import serializers
+
+from .models import PaymentTransaction
+from .serializers import PaymentTransactionSerializer
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "mpesa:tx-final"
+
+
+class _Hub:
+    """Waiters in this process, keyed by transaction id."""
+
+    def __init__(self):
+        self._waiters = {}
+        self._lock = threading.Lock()
+
+    def add(self, pk):
+        waiter = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            self._waiters.setdefault(str(pk), set()).add(waiter)
+        return waiter
+
+    def remove(self, pk, waiter):
+        with self._lock:
+            waiters = self._waiters.get(str(pk))
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[str(pk)]
+
+    def dispatch(self, pk, data):
+        """Deliver ``data`` to every waiter on ``pk``; safe from any thread."""
+        with self._lock:
+            waiters = list(self._waiters.get(str(pk), ()))
+        for loop, queue in waiters:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, data)
+            except RuntimeError:
+                # the waiter's event loop has shut down
+                self.remove(pk, (loop, queue))
+
+    def count(self):
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+
+hub = _Hub()
+
+
+def _backend():
+    return getattr(settings, "MPESA_EVENTS_BACKEND", "redis")
+
+
+def _redis_url():
+    return getattr(settings, "MPESA_EVENTS_REDIS_URL", "") or settings.CELERY_BROKER_URL
+
+
+class _RedisPublisher:
+    """Sync publisher that backs off for ``retry_after`` seconds when Redis fails."""
+
+    def __init__(self, retry_after=30):
+        self.retry_after = retry_after
+        self._client = None
+        self._down_until = 0.0
+
+    def publish(self, message):
+        if time.monotonic() < self._down_until:
+            return
+        try:
+            if self._client is None:
+                import redis
+
+                self._client = redis.Redis.from_url(_redis_url(), socket_timeout=0.5, socket_connect_timeout=0.5)
+            self._client.publish(CHANNEL, message)
+        except Exception as e:
+            logger.warning("Event publish failed, pausing for %ss: %s", self.retry_after, e)
+            self._down_until = time.monotonic() + self.retry_after
+
+
+_publisher = _RedisPublisher()
+
+
+_datetime_field = serializers.DateTimeField()
+
+
+def _message(pk, status, updated_at, fields):
+    """The part of a serialized transaction that a transition changed."""
+    data = {name: value for name, value in fields.items() if name in PaymentTransactionSerializer.Meta.fields}
+    data.update(id=str(pk), status=status, updated_at=_datetime_field.to_representation(updated_at))
+    return data
+
+
+def _publish(messages, checkout_ids):
+    if _backend() != "redis" and not hub.count():
+        return
+    try:
+        if checkout_ids:
+            rows = PaymentTransaction.objects.filter(mpesa_checkout_request_id__in=checkout_ids).values_list(
+                "id", "status", "updated_at", "mpesa_checkout_request_id"
+            )
+            messages = messages + [
+                _message(pk, status, updated_at, {"mpesa_checkout_request_id": checkout_id})
+                for pk, status, updated_at, checkout_id in rows
+            ]
+        for data in messages:
+            if _backend() == "redis":
+                _publisher.publish(json.dumps(data))
+            else:
+                hub.dispatch(data["id"], data)
+    except Exception:
+        logger.exception("Failed to publish final status for %s %s", [m["id"] for m in messages], checkout_ids)
+
+
+def publish_final(rows=(), checkout_ids=()):
+    """
+    Announce, after commit, that transactions reached a final status.
+
+    ``rows`` are ``(pk, status, updated_at, fields)`` as the transition wrote
+    them and are published as they are. Transitions keyed on
+    ``checkout_ids`` do not know the pk, so those rows are looked up.
+    """
+    messages = [_message(*row) for row in rows]
+    checkout_ids = [c for c in checkout_ids if c]
+    if messages or checkout_ids:
+        transaction.on_commit(lambda: _publish(messages, checkout_ids))
+
+
+_listeners = {}
+
+
+async def _listen():
+    import redis.asyncio as aioredis
+
+    delay = 1
+    while True:
+        try:
+            client = aioredis.Redis.from_url(_redis_url())
+            async with client.pubsub() as pubsub:
+                await pubsub.subscribe(CHANNEL)
+                delay = 1
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        data = json.loads(message["data"])
+                        hub.dispatch(data["id"], data)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Event subscriber lost Redis, retrying in %ss: %s", delay, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+def _ensure_listener():
+    loop = asyncio.get_running_loop()
+    task = _listeners.get(loop)
+    if task is None or task.done():
+        _listeners[loop] = loop.create_task(_listen())
+
+
+def subscribe(pk):
+    """Register a waiter for ``pk`` on the running event loop; returns it."""
+    if _backend() == "redis":
+        _ensure_listener()
+    return hub.add(pk)
+
+
+def unsubscribe(pk, waiter):
+    hub.remove(pk, waiter)
@@ -0,0 +1,142 @@
+"""
+Idempotency-Key support for POST endpoints.
+
+The first request with a given key runs the view and its response is cached
+(Django's cache, i.e. Redis when configured) for MPESA_IDEMPOTENCY_TTL
+seconds. Repeats within that window get the stored response back without
+touching the database or Daraja. Concurrent duplicates wait on a lock
+instead of running the view a second time; it is held for at least the
+worst-case Daraja round trip, so it cannot expire under a slow request.
+
+Keys are scoped to the caller (the authenticated user, else the client
+address), so two clients picking the same key never see each other's
+responses. If the cache is down requests run as if they carried no key.
+"""
+
+import functools
+import hashlib
+import logging
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+
+def _client_scope(request):
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+    return f"addr:{request.META.get('REMOTE_ADDR', '')}"
+
+
+def _cache_keys(request, key):
+    digest = hashlib.sha256(f"{_client_scope(request)}\n{request.path}\n{key}".encode("utf-8")).hexdigest()
+    return f"mpesa:idem:{digest}", f"mpesa:idem:{digest}:lock"
+
+
+def lock_timeout():
+    """
+    Seconds the in-flight lock is held: MPESA_IDEMPOTENCY_LOCK_TIMEOUT, but
+    never less than a push can take. That is an OAuth call and an STK push,
+    twice when Daraja rejects the token, each waiting up to
+    MPESA_RATE_LIMIT_WAIT for a rate-limit token.
+    """
+    per_call = (
+        getattr(settings, "MPESA_CONNECT_TIMEOUT", 3.05)
+        + getattr(settings, "MPESA_READ_TIMEOUT", 15)
+        + getattr(settings, "MPESA_RATE_LIMIT_WAIT", 2)
+    )
+    return max(getattr(settings, "MPESA_IDEMPOTENCY_LOCK_TIMEOUT", 0), math.ceil(4 * per_call))
+
+
+def _fingerprint(request):
+    return hashlib.sha256(request.body or b"").hexdigest()
+
+
+def _replay(stored, fingerprint):
+    if stored["fingerprint"] != fingerprint:
+        return Response(
+            {"detail": f"{HEADER} was already used with a different request body"},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        )
+    response = Response(stored["data"], status=stored["status"])
+    response["Idempotent-Replayed"] = "true"
+    return response
+
+
+def idempotent(view_method):
+    """
+    Make an APIView method honour the Idempotency-Key header.
+
+    Requests without the header are passed straight through. Responses with
+    5xx status are not stored, so a client may retry after a provider
+    outage.
+    """
+
+    def unprotected(self, request, *args, **kwargs):
+        logger.warning("Idempotency cache unavailable; running %s without it", request.path, exc_info=True)
+        return view_method(self, request, *args, **kwargs)
+
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return Response({"detail": f"{HEADER} is too long"}, status=status.HTTP_400_BAD_REQUEST)
+
+        result_key, lock_key = _cache_keys(request, key)
+        fingerprint = _fingerprint(request)
+
+        try:
+            stored = cache.get(result_key)
+            if stored is not None:
+                return _replay(stored, fingerprint)
+            locked = cache.add(lock_key, 1, timeout=lock_timeout())
+        except Exception:
+            return unprotected(self, request, *args, **kwargs)
+
+        if not locked:
+            # A concurrent duplicate is in flight; wait for its result.
+            deadline = time.monotonic() + getattr(settings, "MPESA_IDEMPOTENCY_WAIT", 10)
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                try:
+                    stored = cache.get(result_key)
+                except Exception:
+                    logger.warning("Idempotency cache unavailable while waiting on %s", request.path, exc_info=True)
+                    break
+                if stored is not None:
+                    return _replay(stored, fingerprint)
+            return Response(
+                {"detail": "a request with this Idempotency-Key is still in progress"},
+                status=status.HTTP_409_CONFLICT,
+            )
+
+        try:
+            response = view_method(self, request, *args, **kwargs)
+            if response.status_code < 500:
+                try:
+                    cache.set(
+                        result_key,
+                        {"status": response.status_code, "data": response.data, "fingerprint": fingerprint},
+                        timeout=getattr(settings, "MPESA_IDEMPOTENCY_TTL", 24 * 60 * 60),
+                    )
+                except Exception:
+                    logger.warning("Failed to store idempotent response for %s", request.path, exc_info=True)
+            return response
+        finally:
+            try:
+                cache.delete(lock_key)
+            except Exception:
+                logger.warning("Failed to release idempotency lock for %s", request.path, exc_info=True)
+
+    return wrapper
@@ -0,0 +1,139 @@
+"""
+Plumbing shared by the HTTP load benchmarks: a Daraja stub in a child
+process, an in-process threaded WSGI server and latency percentiles.
+"""
+
+import json
+import multiprocessing
+import socket
+import statistics
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from payments.daraja_stub import StubDarajaServer
+
+# Phone prefix no real subscriber has, so the benchmark rows are easy to drop
+PHONE_PREFIX = "2549"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def _serve_stub(port, options):
+    StubDarajaServer(port=port, **options).serve_forever()
+
+
+class StubProcess:
+    """
+    StubDarajaServer in a forked child process, so its threads do not
+    compete with the server under test for the GIL.
+    """
+
+    def __init__(self, **options):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._process = multiprocessing.get_context("fork").Process(
+            target=_serve_stub, args=(self.port, options), daemon=True
+        )
+
+    def __enter__(self):
+        self._process.start()
+        wait_for_port(self.port)
+        return self
+
+    def __exit__(self, *exc):
+        self._process.terminate()
+        self._process.join()
+
+    def stats(self):
+        with urllib.request.urlopen(f"{self.url}/stub/stats", timeout=10) as response:
+            return json.loads(response.read())
+
+
+def relax_sqlite(sender, connection, **kwargs):
+    """connection_created receiver: skip per-commit fsyncs on sqlite."""
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA synchronous=OFF")
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    """wsgiref server that handles requests on a fixed-size thread pool."""
+
+    request_queue_size = 1024
+
+    def __init__(self, address, threads):
+        super().__init__(address, _QuietHandler)
+        self._pool = ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False)
+
+
+class WSGIThread:
+    """Serve ``app`` on a free local port from a background thread."""
+
+    def __init__(self, app, threads):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.httpd = PooledWSGIServer(("127.0.0.1", self.port), threads)
+        self.httpd.set_app(app)
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def latency_summary(latencies_s):
+    """p50/p95/p99 in milliseconds (None for an empty sample)."""
+    values = sorted(latencies_s)
+    if not values:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    return {
+        "p50_ms": round(statistics.median(values) * 1000, 1),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+    }
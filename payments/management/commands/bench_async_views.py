@@ -0,0 +1,167 @@
+"""
+Load-test STK push initiation: sync views on a threaded WSGI server vs the
+native async view on ASGI, against a local Daraja stub with fixed latency.
+
+    python manage.py bench_async_views --requests 2000 --concurrency 200 --latency 0.2
+
+Modes:
+
+* ``wsgi-sync``: STKPushView on a WSGI server with ``--threads`` worker
+  threads, like gunicorn's gthread worker.
+* ``asgi-sync``: STKPushView under uvicorn, run by Django in its sync
+  thread pool.
+* ``asgi-async``: stk_push_async under uvicorn.
+
+Each server runs in-process on its own port, the Daraja stub in a child
+process (so its threads do not compete for the GIL), and the load generator
+keeps ``--concurrency`` requests in flight. Connections are not kept alive, so
+every mode pays the same per-request connect cost.
+
+On sqlite the run sets ``PRAGMA synchronous=OFF`` on its own connections so
+per-commit fsyncs do not dominate; writes are still serialised, so point
+DATABASES at PostgreSQL for numbers that carry over to production.
+"""
+
+import asyncio
+import json
+import threading
+import time
+
+import aiohttp
+import uvicorn
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+
+from payments import ratelimit
+from payments.daraja import DarajaClient, close_async_client, get_client, set_client, token_cache
+from payments.models import PaymentTransaction
+
+from ._bench import PHONE_PREFIX, StubProcess, WSGIThread, free_port, latency_summary, relax_sqlite
+
+
+class _ASGI:
+    def __init__(self):
+        self.port = free_port()
+        config = uvicorn.Config(
+            get_asgi_application(), host="127.0.0.1", port=self.port,
+            log_level="warning", lifespan="off", backlog=1024,
+        )
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True)
+
+    async def _serve(self):
+        try:
+            await self.server.serve()
+        finally:
+            await close_async_client()
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+async def _load(url, total, concurrency):
+    latencies, errors = [], 0
+    connector = aiohttp.TCPConnector(limit=concurrency, force_close=True)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120)) as session:
+        queue = asyncio.Queue()
+        for i in range(total):
+            queue.put_nowait(i)
+
+        async def worker():
+            nonlocal errors
+            while not queue.empty():
+                i = queue.get_nowait()
+                started = time.perf_counter()
+                try:
+                    body = {"phone_number": f"{PHONE_PREFIX}{i:08d}", "amount": "10"}
+                    async with session.post(url, json=body) as resp:
+                        await resp.read()
+                        if resp.status != 200:
+                            errors += 1
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - started, latencies, errors
+
+
+class Command(BaseCommand):
+    help = "Compare sync WSGI and native async ASGI STK push throughput against a Daraja stub."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--concurrency", type=int, default=200, help="Requests kept in flight")
+        parser.add_argument("--latency", type=float, default=0.2, help="Simulated Daraja latency (s)")
+        parser.add_argument("--threads", type=int, default=8, help="WSGI worker threads")
+        parser.add_argument(
+            "--modes", nargs="+", default=["wsgi-sync", "asgi-sync", "asgi-async"],
+            choices=["wsgi-sync", "asgi-sync", "asgi-async"],
+        )
+
+    def handle(self, *args, **options):
+        results = []
+        with StubProcess(latency=options["latency"]) as stub:
+            previous_client = get_client()
+            set_client(DarajaClient(base_url=stub.url, pool_maxsize=options["concurrency"]))
+            token_cache.invalidate()
+            connection_created.connect(relax_sqlite)
+            try:
+                with override_settings(
+                    MPESA_BASE_URL=stub.url,
+                    MPESA_RATE_LIMITS={},
+                    MPESA_EVENTS_BACKEND="local",
+                    MPESA_STK_PUSH_ASYNC=False,
+                ):
+                    ratelimit.reset()
+                    for mode in options["modes"]:
+                        results.append(self._run(mode, options))
+            finally:
+                connection_created.disconnect(relax_sqlite)
+                set_client(previous_client)
+                ratelimit.reset()
+                PaymentTransaction.objects.filter(phone_number__startswith=PHONE_PREFIX).delete()
+
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def _run(self, mode, options):
+        server = WSGIThread(get_wsgi_application(), options["threads"]) if mode == "wsgi-sync" else _ASGI()
+        path = "/payments/async/stk-push/" if mode == "asgi-async" else "/payments/stk-push/"
+        peak_threads = threading.active_count()
+        with server:
+            url = f"http://127.0.0.1:{server.port}{path}"
+            done = threading.Event()
+
+            def sample_threads():
+                nonlocal peak_threads
+                while not done.wait(0.05):
+                    peak_threads = max(peak_threads, threading.active_count())
+
+            sampler = threading.Thread(target=sample_threads, daemon=True)
+            sampler.start()
+            elapsed, latencies, errors = asyncio.run(_load(url, options["requests"], options["concurrency"]))
+            done.set()
+            sampler.join()
+
+        return {
+            "mode": mode,
+            "requests": options["requests"],
+            "concurrency": options["concurrency"],
+            "daraja_latency_s": options["latency"],
+            "errors": errors,
+            "elapsed_s": round(elapsed, 3),
+            "requests_per_s": round(options["requests"] / elapsed, 1) if elapsed else None,
+            **latency_summary(latencies),
+            "peak_threads": peak_threads,
+        }
@@ -0,0 +1,88 @@
+"""
+Benchmark the bulk STK push path end to end against a local Daraja stub.
+
+    python manage.py bench_bulk_stk_push --count 10000 --latency 0.05
+
+Celery runs eagerly in-process and the task outbox is relayed right after
+the request, so the chunks are processed one after the other, each with
+MPESA_BULK_CONCURRENCY concurrent Daraja calls. That is the throughput of
+a single worker; N workers divide the fan-out time by ~N.
+"""
+
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+from rest_framework.test import force_authenticate
+
+from mpesa_project.celery import app
+from payments import outbox, ratelimit
+from payments.daraja import DarajaClient, get_client, set_client, token_cache
+from payments.daraja_stub import StubDarajaServer
+from payments.models import PaymentBatch, PaymentTransaction
+from payments.views import BulkSTKPushView
+
+
+class Command(BaseCommand):
+    help = "Time N bulk STK pushes end to end against a local Daraja stub."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=10000)
+        parser.add_argument("--latency", type=float, default=0.05, help="Simulated Daraja latency (s)")
+        parser.add_argument("--concurrency", type=int, default=20, help="Concurrent Daraja calls per chunk")
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument("--rate", type=float, default=0, help="stk_push rate limit (calls/s, 0 = off)")
+        parser.add_argument("--keep", action="store_true", help="Keep the benchmark rows afterwards")
+
+    def handle(self, *args, **options):
+        count = options["count"]
+        server = StubDarajaServer(latency=options["latency"]).start()
+        previous_client = get_client()
+        set_client(DarajaClient(base_url=server.url, pool_maxsize=options["concurrency"]))
+        token_cache.invalidate()
+        eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+
+        items = [{"phone_number": f"2547{i:08d}", "amount": "10"} for i in range(count)]
+        request = RequestFactory().post("/payments/stk-push/bulk/", json.dumps(items), content_type="application/json")
+        force_authenticate(request, user=User(username="bench", is_staff=True))
+
+        try:
+            with override_settings(
+                MPESA_BULK_MAX_ITEMS=max(count, 1),
+                MPESA_BULK_CONCURRENCY=options["concurrency"],
+                MPESA_BULK_CHUNK_SIZE=options["chunk_size"],
+                MPESA_RATE_LIMITS={"stk_push": options["rate"]},
+                MPESA_RATE_LIMIT_BACKEND="local",
+            ):
+                ratelimit.reset()
+                started = time.perf_counter()
+                response = BulkSTKPushView.as_view()(request)
+                # The chunk tasks wait in the outbox; relaying runs them eagerly
+                outbox.relay()
+                elapsed = time.perf_counter() - started
+        finally:
+            app.conf.task_always_eager = eager
+            ratelimit.reset()
+            set_client(previous_client)
+            server.stop()
+
+        batch_id = response.data["batch_id"]
+        pending = PaymentTransaction.objects.filter(batch_id=batch_id, status="PENDING").count()
+        result = {
+            "count": count,
+            "latency_s": options["latency"],
+            "concurrency": options["concurrency"],
+            "chunk_size": options["chunk_size"],
+            "elapsed_s": round(elapsed, 3),
+            "pushes_per_s": round(count / elapsed, 1) if elapsed else None,
+            "pending": pending,
+            "daraja_calls": server.calls,
+        }
+        self.stdout.write(json.dumps(result, indent=2))
+
+        if not options["keep"]:
+            PaymentTransaction.objects.filter(batch_id=batch_id).delete()
+            PaymentBatch.objects.filter(id=batch_id).delete()
@@ -0,0 +1,97 @@
+"""
+Compare callback processing throughput: one task per callback vs batches.
+
+    python manage.py bench_callback_processing --count 5000 --batch-sizes 50 500
+
+Each mode gets a fresh set of PENDING transactions and unprocessed callback
+logs. Tasks are called in-process, so broker overhead is not included; the
+numbers show the DB cost per callback alone.
+"""
+
+import json
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from payments import callbacks
+from payments.models import CallbackLog, PaymentTransaction
+from payments.tasks import process_callback_batch, process_callback_log
+
+
+class Command(BaseCommand):
+    help = "Benchmark single-task vs batched processing of ingested callbacks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=5000)
+        parser.add_argument("--batch-sizes", type=int, nargs="+", default=[50, 500])
+
+    def handle(self, *args, **options):
+        count = options["count"]
+        results = [self._run(count, "single", None)]
+        for size in options["batch_sizes"]:
+            results.append(self._run(count, f"batch-{size}", size))
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def _seed(self, count):
+        prefix = f"bench_{uuid.uuid4().hex[:8]}_"
+        PaymentTransaction.objects.bulk_create(
+            [
+                PaymentTransaction(
+                    phone_number="254700000000", amount="10.00", status="PENDING",
+                    mpesa_checkout_request_id=f"{prefix}{i}",
+                )
+                for i in range(count)
+            ],
+            batch_size=1000,
+        )
+        logs = CallbackLog.objects.bulk_create(
+            [
+                CallbackLog(
+                    checkout_request_id=f"{prefix}{i}",
+                    processing_status=callbacks.RECEIVED,
+                    payload={"Body": {"stkCallback": {
+                        "CheckoutRequestID": f"{prefix}{i}", "ResultCode": 0, "ResultDesc": "ok",
+                        "CallbackMetadata": {"Item": [{"Name": "Amount", "Value": 10}]},
+                    }}},
+                )
+                for i in range(count)
+            ],
+            batch_size=1000,
+        )
+        return prefix, [str(log.pk) for log in logs]
+
+    def _run(self, count, mode, batch_size):
+        prefix, log_ids = self._seed(count)
+        try:
+            queries = []
+
+            def count_query(execute, sql, params, many, context):
+                queries.append(sql)
+                return execute(sql, params, many, context)
+
+            with connection.execute_wrapper(count_query):
+                started = time.perf_counter()
+                if batch_size is None:
+                    for log_id in log_ids:
+                        process_callback_log(log_id)
+                else:
+                    while process_callback_batch(batch_size):
+                        pass
+                elapsed = time.perf_counter() - started
+            succeeded = PaymentTransaction.objects.filter(
+                mpesa_checkout_request_id__startswith=prefix, status="SUCCESS"
+            ).count()
+        finally:
+            CallbackLog.objects.filter(checkout_request_id__startswith=prefix).delete()
+            PaymentTransaction.objects.filter(mpesa_checkout_request_id__startswith=prefix).delete()
+
+        return {
+            "mode": mode,
+            "callbacks": count,
+            "succeeded": succeeded,
+            "elapsed_s": round(elapsed, 3),
+            "callbacks_per_s": round(count / elapsed, 1) if elapsed else None,
+            "queries_per_callback": round(len(queries) / count, 2),
+        }
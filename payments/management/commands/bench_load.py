@@ -0,0 +1,279 @@
+"""
+Load-test the payment flow end to end against a local Daraja stub.
+
+    python manage.py bench_load --requests 500 --rate 50 --latency 0.2 --callback-delay 2
+
+STK pushes are posted to /payments/stk-push/ at ``--rate`` per second (open
+loop, at most ``--concurrency`` in flight; ``--rate 0`` sends as fast as the
+concurrency allows). The stub answers each accepted push like M-Pesa would:
+``--callback-delay`` seconds later it POSTs an stkCallback to
+/payments/callback/, repeated ``--callback-duplicates`` extra times, so the
+callback rate follows the push rate.
+
+Reported per endpoint: throughput, p50/p95/p99 latency and DB queries per
+request; plus time from sending a push to its transaction reaching a final
+status. Push latency is measured from the request's scheduled send time, so
+a server that falls behind the rate shows it in the percentiles. Tasks the
+views queue in the outbox are published by a relay thread and run eagerly
+there, so their queries are not counted against the request.
+
+The report is written as JSON to ``--output`` (default
+``bench-results/load-<commit>-<time>.json``) to compare runs between commits.
+On sqlite, see bench_async_views about fsync and write serialisation.
+"""
+
+import asyncio
+import datetime
+import json
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+import aiohttp
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+
+from mpesa_project.celery import app
+from payments import outbox, ratelimit
+from payments.daraja import DarajaClient, get_client, set_client, token_cache
+from payments.models import CallbackLog, PaymentTransaction
+from payments.transitions import TERMINAL_STATUSES
+
+from ._bench import PHONE_PREFIX, StubProcess, WSGIThread, latency_summary, relax_sqlite
+
+PUSH_PATH = "/payments/stk-push/"
+CALLBACK_PATH = "/payments/callback/"
+
+
+class _Instrumented:
+    """WSGI wrapper counting requests, DB queries and server time per path."""
+
+    def __init__(self, app):
+        self.app = app
+        self.paths = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        queries = 0
+
+        def count(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count):
+            response = self.app(environ, start_response)
+            try:
+                body = b"".join(response)
+            finally:
+                response.close()
+        elapsed = time.perf_counter() - started
+
+        with self._lock:
+            stats = self.paths.setdefault(environ["PATH_INFO"], {"requests": 0, "queries": 0, "server_s": []})
+            stats["requests"] += 1
+            stats["queries"] += queries
+            stats["server_s"].append(elapsed)
+        return [body]
+
+    def summary(self, path):
+        stats = self.paths.get(path, {"requests": 0, "queries": 0, "server_s": []})
+        return {
+            "requests": stats["requests"],
+            "queries_per_request": round(stats["queries"] / stats["requests"], 2) if stats["requests"] else None,
+            "server_time": latency_summary(stats["server_s"]),
+        }
+
+
+def _relay_outbox(stop):
+    """Relay the task outbox until ``stop`` is set, then once more to drain it."""
+    while not stop.is_set():
+        if not outbox.relay():
+            stop.wait(0.05)
+    outbox.relay()
+    connection.close()
+
+
+async def _push(url, total, rate, concurrency, sent_at):
+    """Post ``total`` STK pushes; returns elapsed seconds, latencies and errors."""
+    latencies, errors = [], 0
+    connector = aiohttp.TCPConnector(limit=concurrency, force_close=True)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120)) as session:
+        slots = asyncio.Semaphore(concurrency)
+        started = time.perf_counter()
+        wall_started = time.time()
+
+        async def one(i, scheduled):
+            nonlocal errors
+            phone = f"{PHONE_PREFIX}{i:08d}"
+            sent_at[phone] = wall_started + (scheduled - started)
+            try:
+                async with session.post(url, json={"phone_number": phone, "amount": "10"}) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        errors += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                errors += 1
+            finally:
+                slots.release()
+            latencies.append(time.perf_counter() - scheduled)
+
+        tasks = []
+        for i in range(total):
+            if rate:
+                scheduled = started + i / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await slots.acquire()
+            else:
+                await slots.acquire()
+                scheduled = time.perf_counter()
+            tasks.append(asyncio.create_task(one(i, scheduled)))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started, latencies, errors
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "Drive STK pushes and stub callbacks at a controlled rate and report latency, queries and push-to-final time."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500, help="STK pushes to send")
+        parser.add_argument("--rate", type=float, default=50, help="Pushes per second (0 = closed loop)")
+        parser.add_argument("--concurrency", type=int, default=100, help="Max pushes in flight")
+        parser.add_argument("--threads", type=int, default=16, help="WSGI worker threads")
+        parser.add_argument("--latency", type=float, default=0.2, help="Simulated Daraja latency (s)")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of Daraja POSTs answered 503")
+        parser.add_argument("--callback-delay", type=float, default=2.0, help="Seconds from push to callback")
+        parser.add_argument("--callback-result", type=int, default=0, help="ResultCode of stub callbacks")
+        parser.add_argument("--callback-duplicates", type=int, default=0, help="Extra copies of each callback")
+        parser.add_argument("--drain-timeout", type=float, default=60, help="Max wait for final statuses (s)")
+        parser.add_argument("--output", help="Report path (default bench-results/load-<commit>-<time>.json)")
+
+    def handle(self, *args, **options):
+        started_at = datetime.datetime.now(datetime.timezone.utc)
+        commit = _commit()
+        server_app = _Instrumented(get_wsgi_application())
+        stub_options = {
+            "latency": options["latency"],
+            "error_rate": options["error_rate"],
+            "callback_delay": options["callback_delay"],
+            "callback_result_code": options["callback_result"],
+            "callback_duplicates": options["callback_duplicates"],
+        }
+        eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        previous_client = get_client()
+        connection_created.connect(relax_sqlite)
+        try:
+            with StubProcess(**stub_options) as stub, WSGIThread(server_app, options["threads"]) as server:
+                set_client(DarajaClient(base_url=stub.url, pool_maxsize=options["threads"]))
+                token_cache.invalidate()
+                with override_settings(
+                    MPESA_BASE_URL=stub.url,
+                    MPESA_CALLBACK_URL=f"{server.url}{CALLBACK_PATH}",
+                    MPESA_RATE_LIMITS={},
+                    MPESA_EVENTS_BACKEND="local",
+                    MPESA_STK_PUSH_ASYNC=False,
+                    MPESA_CALLBACK_INGEST_ONLY=False,
+                ):
+                    ratelimit.reset()
+                    stop_relay = threading.Event()
+                    relay = threading.Thread(target=_relay_outbox, args=(stop_relay,), daemon=True)
+                    relay.start()
+                    try:
+                        sent_at = {}
+                        elapsed, latencies, errors = asyncio.run(_push(
+                            f"{server.url}{PUSH_PATH}", options["requests"], options["rate"],
+                            options["concurrency"], sent_at,
+                        ))
+                        accepted, finals, stub_stats = self._drain(stub, options)
+                    finally:
+                        stop_relay.set()
+                        relay.join()
+        finally:
+            connection_created.disconnect(relax_sqlite)
+            set_client(previous_client)
+            app.conf.task_always_eager = eager
+            ratelimit.reset()
+            self._cleanup()
+
+        callbacks = stub_stats["callbacks"]
+        to_final = [updated_at.timestamp() - sent_at[phone] for phone, updated_at in finals]
+        report = {
+            "commit": commit,
+            "started_at": started_at.isoformat(),
+            "database": connection.vendor,
+            "options": {k: options[k] for k in (
+                "requests", "rate", "concurrency", "threads", "latency", "error_rate",
+                "callback_delay", "callback_result", "callback_duplicates",
+            )},
+            "stk_push": {
+                **server_app.summary(PUSH_PATH),
+                "errors": errors,
+                "elapsed_s": round(elapsed, 3),
+                "requests_per_s": round(options["requests"] / elapsed, 1) if elapsed else None,
+                **latency_summary(latencies),
+            },
+            "callback": {
+                **server_app.summary(CALLBACK_PATH),
+                "sent": callbacks["sent"],
+                "errors": callbacks["failed"],
+                "outcomes": callbacks["outcomes"],
+                **latency_summary([ms / 1000 for ms in callbacks["latencies_ms"]]),
+            },
+            "push_to_final": {
+                "accepted": accepted,
+                "completed": len(to_final),
+                "incomplete": accepted - len(to_final),
+                **latency_summary(to_final),
+            },
+            "daraja_calls": stub_stats["calls"],
+        }
+
+        output = Path(options["output"] or (
+            f"bench-results/load-{commit or 'nogit'}-{started_at:%Y%m%dT%H%M%SZ}.json"
+        ))
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, indent=2))
+        self.stdout.write(json.dumps(report, indent=2))
+        self.stderr.write(f"Report written to {output}")
+
+    def _drain(self, stub, options):
+        """Wait until accepted pushes are final and the stub has fired every callback."""
+        accepted = PaymentTransaction.objects.filter(
+            phone_number__startswith=PHONE_PREFIX, mpesa_checkout_request_id__isnull=False
+        )
+        accepted_count = accepted.count()
+        expected_callbacks = accepted_count * (1 + options["callback_duplicates"])
+        deadline = time.monotonic() + options["callback_delay"] + options["drain_timeout"]
+        while True:
+            stub_stats = stub.stats()
+            fired = stub_stats["callbacks"]["sent"] + stub_stats["callbacks"]["failed"]
+            open_rows = accepted.exclude(status__in=TERMINAL_STATUSES).exists()
+            if (fired >= expected_callbacks and not open_rows) or time.monotonic() > deadline:
+                break
+            time.sleep(0.2)
+        finals = list(accepted.filter(status__in=TERMINAL_STATUSES).values_list("phone_number", "updated_at"))
+        return accepted_count, finals, stub_stats
+
+    def _cleanup(self):
+        rows = PaymentTransaction.objects.filter(phone_number__startswith=PHONE_PREFIX)
+        CallbackLog.objects.filter(
+            checkout_request_id__in=rows.exclude(mpesa_checkout_request_id=None).values("mpesa_checkout_request_id")
+        ).delete()
+        rows.delete()
@@ -0,0 +1,96 @@
+"""
+Measure DB reads per status poll with and without the status cache.
+
+    python manage.py bench_status_polls --transactions 100 --polls 20 --interval 1
+
+Each transaction is polled ``--polls`` times through TransactionDetailView,
+one round every ``--interval`` seconds like a client waiting for the PIN;
+halfway through, its callback is applied with process_stk_callback, so the
+run also checks that no poll returns a status older than the callback.
+Uses whatever cache backend CACHES configures (Redis in production); the
+default LocMemCache keeps only 300 entries, two per transaction, so stay
+under 150 transactions without Redis. The cache is shared with the broker,
+locks and tokens, so the run only ever deletes the entries of its own rows.
+"""
+
+import json
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory
+
+from payments import status_cache
+from payments.models import PaymentTransaction
+from payments.tasks import process_stk_callback
+from payments.views import TransactionDetailView
+
+
+class Command(BaseCommand):
+    help = "Benchmark transaction status polling with the status cache off and on."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--transactions", type=int, default=100)
+        parser.add_argument("--polls", type=int, default=20)
+        parser.add_argument("--interval", type=float, default=1.0, help="seconds between poll rounds")
+
+    def handle(self, *args, **options):
+        results = []
+        for enabled in (False, True):
+            with override_settings(MPESA_STATUS_CACHE=enabled):
+                results.append(self._run(options["transactions"], options["polls"], options["interval"], enabled))
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def _run(self, count, polls, interval, enabled):
+        prefix = f"bench_{uuid.uuid4().hex[:8]}_"
+        txs = PaymentTransaction.objects.bulk_create(
+            [
+                PaymentTransaction(
+                    phone_number="254700000000", amount="10.00", status="PENDING",
+                    mpesa_checkout_request_id=f"{prefix}{i}",
+                )
+                for i in range(count)
+            ],
+            batch_size=1000,
+        )
+        view = TransactionDetailView.as_view()
+        factory = APIRequestFactory()
+        try:
+            queries = []
+            stale = 0
+
+            def count_query(execute, sql, params, many, context):
+                queries.append(sql)
+                return execute(sql, params, many, context)
+
+            elapsed = 0.0
+            for poll in range(polls):
+                if poll:
+                    time.sleep(interval)
+                if poll == polls // 2:
+                    for tx in txs:
+                        process_stk_callback({"Body": {"stkCallback": {
+                            "CheckoutRequestID": tx.mpesa_checkout_request_id, "ResultCode": 0,
+                        }}})
+                with connection.execute_wrapper(count_query):
+                    started = time.perf_counter()
+                    for tx in txs:
+                        response = view(factory.get(f"/payments/transactions/{tx.pk}/"), pk=tx.pk)
+                        if poll >= polls // 2 and response.data["status"] != "SUCCESS":
+                            stale += 1
+                    elapsed += time.perf_counter() - started
+        finally:
+            PaymentTransaction.objects.filter(mpesa_checkout_request_id__startswith=prefix).delete()
+            status_cache.delete([tx.pk for tx in txs], [tx.mpesa_checkout_request_id for tx in txs])
+
+        total = count * polls
+        return {
+            "status_cache": enabled,
+            "polls": total,
+            "elapsed_s": round(elapsed, 3),
+            "polls_per_s": round(total / elapsed, 1) if elapsed else None,
+            "queries_per_poll": round(len(queries) / total, 3),
+            "stale_after_callback": stale,
+        }
@@ -0,0 +1,32 @@
+"""
+Look up archived callback payloads by CheckoutRequestID.
+
+    python manage.py find_archived_callback ws_CO_123 [--date 2024-05-17]
+
+Scans the ``.idx`` sidecars under MPESA_CALLBACK_ARCHIVE_DIR (or ``--dir``)
+and prints each matching record as one JSON line.
+"""
+
+import datetime
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.archive import find_archived
+
+
+class Command(BaseCommand):
+    help = "Find archived M-Pesa callbacks by CheckoutRequestID."
+
+    def add_arguments(self, parser):
+        parser.add_argument("checkout_id")
+        parser.add_argument("--dir", help="Archive root (default MPESA_CALLBACK_ARCHIVE_DIR)")
+        parser.add_argument("--date", type=datetime.date.fromisoformat, help="Only search this day (YYYY-MM-DD, UTC)")
+
+    def handle(self, *args, **options):
+        found = 0
+        for record in find_archived(options["checkout_id"], directory=options["dir"], day=options["date"]):
+            self.stdout.write(json.dumps(record))
+            found += 1
+        if not found:
+            raise CommandError(f"No archived callback for {options['checkout_id']}")
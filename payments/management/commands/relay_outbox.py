@@ -0,0 +1,49 @@
+"""
+Publish queued Celery tasks from the transactional outbox.
+
+    python manage.py relay_outbox [--interval 0.2] [--batch-size 200] [--once]
+
+Runs until interrupted, publishing due OutboxMessage rows in batches and
+sleeping ``--interval`` seconds whenever the outbox is empty. Run one or
+more next to the Celery workers; see ``payments.outbox``.
+"""
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from payments import outbox
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Publish Celery tasks queued in the transactional outbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=0.2, help="Seconds to sleep when the outbox is empty")
+        parser.add_argument("--batch-size", type=int, help="Messages per batch (default MPESA_OUTBOX_BATCH_SIZE)")
+        parser.add_argument("--once", action="store_true", help="Drain the outbox once and exit")
+
+    def handle(self, *args, **options):
+        if options["once"]:
+            published = outbox.relay(batch_size=options["batch_size"])
+            self.stdout.write(f"Published {published} outbox messages")
+            return
+
+        self.stderr.write("Relaying the task outbox (Ctrl-C to stop)")
+        try:
+            while True:
+                close_old_connections()
+                try:
+                    published = outbox.relay(batch_size=options["batch_size"])
+                except Exception:
+                    # e.g. a dropped DB connection; keep relaying once it is back
+                    logger.exception("Outbox relay failed")
+                    published = 0
+                if not published:
+                    time.sleep(options["interval"])
+        except KeyboardInterrupt:
+            pass
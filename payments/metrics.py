@@ -0,0 +1,182 @@
+"""
+Prometheus metrics for the payment hot paths, served at ``/metrics``.
+
+* ``mpesa_daraja_request_seconds{endpoint,outcome}``: Daraja calls (OAuth,
+  STK push, STK query; sync and async clients) by HTTP status class.
+* ``mpesa_callback_handling_seconds{mode}`` and
+  ``mpesa_callbacks_total{mode,outcome}``: callback view time and replies.
+* ``mpesa_callback_dedup_total{result}``: edge de-dup claims taken,
+  retries suppressed, and callbacks let through because the cache was down.
+* ``mpesa_celery_queue_lag_seconds{task}``: publish to task start, from a
+  header stamped at publish time (so it needs roughly synced clocks).
+* ``mpesa_transactions_final_total{status}``: committed moves to a final
+  status, counted in ``payments.transitions``.
+* ``mpesa_rate_limit_requests_total{bucket,outcome}`` and
+  ``mpesa_rate_limit_wait_seconds{bucket}``: Daraja rate-limit tokens
+  granted at once, granted after a wait, or shed, and the time waited.
+* ``mpesa_token_cache_total{result}``: OAuth token cache hits, shared
+  (cross-worker) hits, misses, refreshes and refresh errors.
+* ``mpesa_outbox_messages_total{outcome}``: tasks published (or failed to
+  publish) by the outbox relay, see ``payments.outbox``.
+* ``mpesa_pending_transactions{age}``: PENDING rows per age bucket
+  (MPESA_METRICS_PENDING_AGE_BUCKETS), one aggregate query per scrape.
+
+Multi-process: start gunicorn and Celery with ``PROMETHEUS_MULTIPROC_DIR``
+pointing at an empty, writable directory shared by the processes on a host.
+prometheus_client then keeps each process's values in files there and a
+scrape merges them. Celery workers on their own hosts serve the merged view
+of their pool on MPESA_METRICS_WORKER_PORT. Without the variable every
+process reports only itself.
+"""
+
+import datetime
+import hmac
+import logging
+import os
+import time
+from collections import Counter as _Tally
+
+from celery.signals import before_task_publish, task_prerun, worker_ready
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess,
+    start_http_server,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+ENQUEUED_AT_HEADER = "mpesa_enqueued_at"
+
+DARAJA_SECONDS = Histogram(
+    "mpesa_daraja_request_seconds", "Daraja API call latency.", ["endpoint", "outcome"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+CALLBACK_SECONDS = Histogram(
+    "mpesa_callback_handling_seconds", "Time to handle an M-Pesa callback request.", ["mode"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+CALLBACKS = Counter("mpesa_callbacks_total", "M-Pesa callbacks by reply status.", ["mode", "outcome"])
+CALLBACK_DEDUP = Counter("mpesa_callback_dedup_total", "Callback de-dup claims by result.", ["result"])
+QUEUE_LAG_SECONDS = Histogram(
+    "mpesa_celery_queue_lag_seconds", "Time from publishing a Celery task to it starting.", ["task"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 15, 60, 300),
+)
+FINAL_TRANSACTIONS = Counter(
+    "mpesa_transactions_final_total", "Transactions moved to a final status.", ["status"]
+)
+RATE_LIMIT_REQUESTS = Counter(
+    "mpesa_rate_limit_requests_total", "Daraja rate-limit token requests by outcome.", ["bucket", "outcome"]
+)
+RATE_LIMIT_WAIT_SECONDS = Histogram(
+    "mpesa_rate_limit_wait_seconds", "Time spent waiting for a Daraja rate-limit token.", ["bucket"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 30),
+)
+TOKEN_CACHE = Counter("mpesa_token_cache_total", "OAuth access token cache lookups and refreshes.", ["result"])
+OUTBOX_MESSAGES = Counter("mpesa_outbox_messages_total", "Outbox messages handled by the relay.", ["outcome"])
+
+
+def observe_daraja(endpoint, started, status_code=None):
+    """Record a Daraja call that began at ``started`` (perf_counter); no status means a transport error."""
+    outcome = f"{status_code // 100}xx" if status_code else "error"
+    DARAJA_SECONDS.labels(endpoint or "other", outcome).observe(time.perf_counter() - started)
+
+
+def observe_callback(mode, outcome, started):
+    CALLBACK_SECONDS.labels(mode).observe(time.perf_counter() - started)
+    CALLBACKS.labels(mode, outcome or "unknown").inc()
+
+
+def count_final(statuses):
+    """Count moves to final ``statuses`` once the surrounding transaction commits."""
+    tally = _Tally(statuses)
+    if tally:
+        transaction.on_commit(lambda: [FINAL_TRANSACTIONS.labels(s).inc(n) for s, n in tally.items()])
+
+
+@before_task_publish.connect
+def _stamp_enqueue_time(headers=None, **kwargs):
+    if headers is not None:
+        headers[ENQUEUED_AT_HEADER] = time.time()
+
+
+@task_prerun.connect
+def _observe_queue_lag(task=None, **kwargs):
+    enqueued_at = task.request.get(ENQUEUED_AT_HEADER) if task is not None else None
+    if enqueued_at:
+        QUEUE_LAG_SECONDS.labels(task.name).observe(max(0.0, time.time() - enqueued_at))
+
+
+def _age_label(low, high):
+    return f"{low}s-{high}s" if high else f"{low}s+"
+
+
+class _PendingCollector:
+    """PENDING transactions per age bucket, queried at scrape time."""
+
+    name = "mpesa_pending_transactions"
+    documentation = "PENDING transactions by age since creation."
+
+    def describe(self):
+        return [GaugeMetricFamily(self.name, self.documentation, labels=["age"])]
+
+    def collect(self):
+        from .models import PaymentTransaction
+
+        bounds = sorted(getattr(settings, "MPESA_METRICS_PENDING_AGE_BUCKETS", [60, 300, 900, 3600]))
+        now = timezone.now()
+        try:
+            # younger_than_N counts rows created less than N seconds ago
+            counts = PaymentTransaction.objects.filter(status="PENDING").aggregate(
+                total=Count("id"),
+                **{
+                    f"younger_than_{b}": Count("id", filter=Q(created_at__gt=now - datetime.timedelta(seconds=b)))
+                    for b in bounds
+                },
+            )
+        except Exception:
+            logger.warning("Could not count PENDING transactions for metrics", exc_info=True)
+            return
+        family = GaugeMetricFamily(self.name, self.documentation, labels=["age"])
+        previous, low = 0, 0
+        for high in bounds + [None]:
+            cumulative = counts[f"younger_than_{high}"] if high else counts["total"]
+            family.add_metric([_age_label(low, high)], cumulative - previous)
+            previous, low = cumulative, high
+        yield family
+
+
+_pending_registry = CollectorRegistry()
+_pending_registry.register(_PendingCollector())
+
+
+def _process_registry():
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render():
+    """Return ``(body, content_type)`` in the Prometheus text format."""
+    return generate_latest(_process_registry()) + generate_latest(_pending_registry), CONTENT_TYPE_LATEST
+
+
+def authorized(request):
+    """True if MPESA_METRICS_TOKEN is unset or sent as a bearer token."""
+    token = getattr(settings, "MPESA_METRICS_TOKEN", "")
+    if not token:
+        return True
+    return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")
+
+
+@worker_ready.connect
+def _serve_worker_metrics(**kwargs):
+    port = getattr(settings, "MPESA_METRICS_WORKER_PORT", 0)
+    if port:
+        start_http_server(port, registry=_process_registry())
+        logger.info("Serving Celery worker metrics on port %d", port)
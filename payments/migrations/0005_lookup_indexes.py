@@ -0,0 +1,30 @@
+# Generated by Django 6.0.1 on 2026-10-16 22:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0004_paymentbatch'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='paymenttransaction',
+            name='mpesa_checkout_request_id',
+            field=models.CharField(blank=True, max_length=50, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='callbacklog',
+            index=models.Index(fields=['checkout_request_id', 'received_at'], name='payments_cblog_checkout_recv'),
+        ),
+        migrations.AddIndex(
+            model_name='paymenttransaction',
+            index=models.Index(fields=['status', 'created_at'], name='payments_tx_status_created'),
+        ),
+        migrations.AddIndex(
+            model_name='paymenttransaction',
+            index=models.Index(fields=['created_at'], name='payments_tx_created'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.0.1 on 2026-10-16 22:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0006_cancelled_timeout_statuses'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='callbacklog',
+            index=models.Index(condition=models.Q(('processed', False)), fields=['received_at'], name='payments_cblog_unprocessed'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 6.0.1 on 2026-10-16 22:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0007_callbacklog_unprocessed_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReconciliationState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('watermark', models.DateTimeField(blank=True, null=True)),
+                ('last_full_sweep_at', models.DateTimeField(blank=True, null=True)),
+                ('last_run_at', models.DateTimeField(blank=True, null=True)),
+                ('last_run_full', models.BooleanField(default=False)),
+                ('last_rows_scanned', models.PositiveIntegerField(default=0)),
+                ('last_duration_ms', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='paymenttransaction',
+            index=models.Index(fields=['status', 'updated_at'], name='payments_tx_status_updated'),
+        ),
+    ]
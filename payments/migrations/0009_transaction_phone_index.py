@@ -0,0 +1,17 @@
+# Generated by Django 6.0.1 on 2026-10-16 22:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0008_reconciliationstate'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='paymenttransaction',
+            index=models.Index(fields=['phone_number', 'created_at'], name='payments_tx_phone_created'),
+        ),
+    ]
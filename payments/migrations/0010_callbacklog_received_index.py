@@ -0,0 +1,17 @@
+# Generated by Django 6.0.1 on 2026-10-16 23:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0009_transaction_phone_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='callbacklog',
+            index=models.Index(fields=['received_at', 'id'], name='payments_cblog_received'),
+        ),
+    ]
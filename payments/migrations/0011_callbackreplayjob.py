@@ -0,0 +1,31 @@
+# Generated by Django 6.0.1 on 2026-10-16 23:34
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0010_callbacklog_received_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CallbackReplayJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('created_by', models.CharField(blank=True, max_length=150)),
+                ('source', models.CharField(choices=[('admin', 'Admin action'), ('api', 'API')], max_length=10)),
+                ('selection', models.JSONField(blank=True, default=dict)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('applied', models.PositiveIntegerField(default=0)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0.1 on 2026-10-16 23:10
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0012_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='callbacklog',
+            name='id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-17 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0013_alter_callbacklog_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='callbackreplayjob',
+            name='failed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
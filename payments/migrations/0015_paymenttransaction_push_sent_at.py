@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-17 12:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0014_callbackreplayjob_failed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymenttransaction',
+            name='push_sent_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,29 +1,57 @@
 from django.db import models
+from django.utils import timezone
 import uuid
 
 # Create your models here.
 
+class PaymentBatch(models.Model):
+    """A group of STK pushes submitted together through the bulk API."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    total = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"PaymentBatch {self.id} - {self.total} items"
+
+
 class PaymentTransaction(models.Model):
     STATUS_CHOICES = [
         ("INITIATED", "Initiated"),
         ("PENDING", "Pending"),
         ("SUCCESS", "Success"),
         ("FAILED", "Failed"),
+        ("CANCELLED", "Cancelled"),
+        ("TIMEOUT", "Timeout"),
     ]
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     phone_number = models.CharField(max_length=12)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="INITIATED")
-    mpesa_checkout_request_id = models.CharField(max_length=50, blank=True, null=True)
+    mpesa_checkout_request_id = models.CharField(max_length=50, blank=True, null=True, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    batch = models.ForeignKey(
+        PaymentBatch, null=True, blank=True, on_delete=models.SET_NULL, related_name="transactions"
+    )
+    # Set by the Celery task that claims an INITIATED row to send its push;
+    # a redelivered task finds it set and does not prompt the customer again
+    push_sent_at = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
         return f"PaymentTransaction {self.id} - {self.status} - {self.phone_number}"
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            models.Index(fields=["status", "created_at"], name="payments_tx_status_created"),
+            models.Index(fields=["created_at"], name="payments_tx_created"),
+            models.Index(fields=["status", "updated_at"], name="payments_tx_status_updated"),
+            models.Index(fields=["phone_number", "created_at"], name="payments_tx_phone_created"),
+        ]
 
 
 class CallbackLog(models.Model):
@@ -37,6 +65,74 @@ class CallbackLog(models.Model):
 
     class Meta:
         ordering = ["-received_at"]
+        indexes = [
+            models.Index(fields=["checkout_request_id", "received_at"], name="payments_cblog_checkout_recv"),
+            # Queue of callbacks waiting for the batch processor
+            models.Index(
+                fields=["received_at"], condition=models.Q(processed=False), name="payments_cblog_unprocessed"
+            ),
+            # Oldest-first scan of the retention archiver
+            models.Index(fields=["received_at", "id"], name="payments_cblog_received"),
+        ]
 
     def __str__(self):
         return f"CallbackLog {self.id} - {self.checkout_request_id} - processed={self.processed}"
+
+
+class CallbackReplayJob(models.Model):
+    """A bulk replay of success callbacks over PENDING transactions, run in Celery chunks."""
+    SOURCE_CHOICES = [("admin", "Admin action"), ("api", "API")]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    created_by = models.CharField(max_length=150, blank=True)
+    source = models.CharField(max_length=10, choices=SOURCE_CHOICES)
+    selection = models.JSONField(default=dict, blank=True)
+    total = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    applied = models.PositiveIntegerField(default=0)
+    # Rows in chunks that still failed after their last retry
+    failed = models.PositiveIntegerField(default=0)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"CallbackReplayJob {self.id} - {self.processed}/{self.total}"
+
+
+class OutboxMessage(models.Model):
+    """A Celery task to publish, written in the transaction of the change it follows."""
+    id = models.BigAutoField(primary_key=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    task_name = models.CharField(max_length=200)
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ["id"]
+        indexes = [
+            # Relay scan: oldest due messages first
+            models.Index(fields=["available_at", "id"], name="payments_outbox_due"),
+        ]
+
+    def __str__(self):
+        return f"OutboxMessage {self.id} - {self.task_name} - attempts={self.attempts}"
+
+
+class ReconciliationState(models.Model):
+    """Persisted progress of an incremental reconciliation job."""
+    name = models.CharField(max_length=64, unique=True)
+    watermark = models.DateTimeField(blank=True, null=True)
+    last_full_sweep_at = models.DateTimeField(blank=True, null=True)
+    last_run_at = models.DateTimeField(blank=True, null=True)
+    last_run_full = models.BooleanField(default=False)
+    last_rows_scanned = models.PositiveIntegerField(default=0)
+    last_duration_ms = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"ReconciliationState {self.name} - watermark={self.watermark}"
@@ -0,0 +1,125 @@
+"""
+Transactional outbox for Celery task publication.
+
+``enqueue(task, *args)`` writes an OutboxMessage in the caller's database
+transaction instead of publishing to the broker: the request never waits on
+Redis, and the task exists exactly when the change it follows commits.
+``relay_outbox`` (``python manage.py relay_outbox``) publishes due messages
+oldest first, a batch at a time over one broker connection, and deletes
+them in the same transaction. Celery beat also runs the
+``relay_task_outbox`` task every 10 seconds, so tasks still go out, only
+later, when no relay process is running.
+
+Delivery is at least once. A relay that dies after publishing but before
+its commit publishes the batch again, so tasks sent through here must be
+idempotent (the callback tasks are, through conditional transitions). Rows
+are claimed with ``SELECT ... FOR UPDATE SKIP LOCKED``, so several relays
+can run side by side. A message that cannot be published is retried with
+backoff and never dropped.
+
+With MPESA_TASK_OUTBOX off, ``enqueue`` publishes on commit instead.
+"""
+
+import contextlib
+import datetime
+import logging
+
+from celery import current_app
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import metrics
+from .models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+_MAX_RETRY_DELAY = 300
+
+
+def enabled():
+    return getattr(settings, "MPESA_TASK_OUTBOX", True)
+
+
+def enqueue(task, *args, **kwargs):
+    """Queue ``task(*args, **kwargs)`` for publication when the current transaction commits."""
+    if not enabled():
+        transaction.on_commit(lambda: task.apply_async(args, kwargs))
+        return None
+    return OutboxMessage.objects.create(task_name=task.name, args=list(args), kwargs=kwargs)
+
+
+def _producer():
+    # Eager tasks run in-process and must not open a broker connection
+    if current_app.conf.task_always_eager:
+        return contextlib.nullcontext()
+    return current_app.producer_or_acquire()
+
+
+def _publish(message, producer):
+    task = current_app.tasks[message.task_name]
+    if producer is None:
+        # Eager: the task runs right here, in a savepoint so its DB errors stay its own
+        with transaction.atomic():
+            task.apply_async(message.args, message.kwargs)
+    else:
+        task.apply_async(message.args, message.kwargs, producer=producer)
+
+
+def _defer(message, exc, now):
+    delay = min(_MAX_RETRY_DELAY, 2 ** message.attempts)
+    OutboxMessage.objects.filter(pk=message.pk).update(
+        attempts=F("attempts") + 1,
+        available_at=now + datetime.timedelta(seconds=delay),
+        last_error=f"{type(exc).__name__}: {exc}"[:1000],
+    )
+    logger.warning(
+        "Could not publish outbox message %s (%s), retrying in %ds: %s", message.pk, message.task_name, delay, exc
+    )
+
+
+def relay_batch(batch_size=None):
+    """
+    Publish up to ``batch_size`` due messages and delete them in one
+    transaction. Stops at the first publish error, leaving the rest for the
+    next batch. Returns the number of messages published.
+    """
+    batch_size = batch_size or getattr(settings, "MPESA_OUTBOX_BATCH_SIZE", 200)
+    now = timezone.now()
+    published = []
+    with transaction.atomic():
+        messages = list(
+            OutboxMessage.objects.select_for_update(skip_locked=True)
+            .filter(available_at__lte=now)
+            .order_by("available_at", "id")[:batch_size]
+        )
+        if not messages:
+            return 0
+
+        with _producer() as producer:
+            for message in messages:
+                try:
+                    _publish(message, producer)
+                except Exception as exc:
+                    _defer(message, exc, now)
+                    metrics.OUTBOX_MESSAGES.labels("failed").inc()
+                    break
+                published.append(message.pk)
+
+        OutboxMessage.objects.filter(pk__in=published).delete()
+    metrics.OUTBOX_MESSAGES.labels("published").inc(len(published))
+    return len(published)
+
+
+def relay(batch_size=None, max_batches=None):
+    """Publish due messages batch after batch until the outbox is drained; returns the count."""
+    batch_size = batch_size or getattr(settings, "MPESA_OUTBOX_BATCH_SIZE", 200)
+    max_batches = max_batches or getattr(settings, "MPESA_OUTBOX_MAX_BATCHES", 50)
+    total = 0
+    for _ in range(max_batches):
+        published = relay_batch(batch_size)
+        total += published
+        if published < batch_size:
+            break
+    return total
@@ -0,0 +1,165 @@
+"""
+Per-request database query profiling.
+
+``capture()`` counts the queries run on a connection, their total time and
+the slowest statements. ``QueryProfilingMiddleware`` wraps every request in
+it when MPESA_QUERY_PROFILING is switched on:
+
+* ``"headers"``: ``X-DB-Queries``, ``X-DB-Time-Ms`` and a ``Server-Timing``
+  entry on the response (visible in browser dev tools).
+* ``"buffer"``: a summary per request, with the slowest statements, kept in
+  an in-process ring buffer of MPESA_QUERY_PROFILING_BUFFER entries (read it
+  with ``recent()`` or at /payments/debug/queries/ as a staff user).
+* ``"both"``, or ``"off"`` (the default).
+
+Statements are recorded without their parameters, so phone numbers and
+amounts never end up in headers or the buffer. The middleware runs natively
+under ASGI: it hooks the connection of the request's thread-sensitive
+worker thread, where the async ORM runs, so async views are profiled too.
+Queries sent to other threads (``thread_sensitive=False``) are not seen.
+"""
+
+import collections
+import contextlib
+import heapq
+import itertools
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_MAX_SQL_LENGTH = 500
+
+_buffer = collections.deque(maxlen=200)
+_buffer_lock = threading.Lock()
+
+
+class QueryStats:
+    """``execute_wrapper`` that tallies queries; keeps every statement if ``keep_all``."""
+
+    def __init__(self, keep_slowest=3, keep_all=False):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = [] if keep_all else None
+        self._keep_slowest = keep_slowest
+        self._slowest = []
+        self._seq = itertools.count()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.seconds += elapsed
+            if self.statements is not None:
+                self.statements.append(sql)
+            if self._keep_slowest:
+                entry = (elapsed, next(self._seq), sql[:_MAX_SQL_LENGTH])
+                if len(self._slowest) < self._keep_slowest:
+                    heapq.heappush(self._slowest, entry)
+                else:
+                    heapq.heappushpop(self._slowest, entry)
+
+    @property
+    def milliseconds(self):
+        return round(self.seconds * 1000, 2)
+
+    def slowest(self):
+        """The slowest statements, slowest first, as ``{"ms", "sql"}`` dicts."""
+        return [
+            {"ms": round(elapsed * 1000, 2), "sql": sql}
+            for elapsed, _, sql in sorted(self._slowest, reverse=True)
+        ]
+
+
+@contextlib.contextmanager
+def capture(using=DEFAULT_DB_ALIAS, keep_slowest=3, keep_all=False):
+    """Profile queries on connection ``using`` (this thread) inside the block."""
+    stats = QueryStats(keep_slowest=keep_slowest, keep_all=keep_all)
+    with connections[using].execute_wrapper(stats):
+        yield stats
+
+
+def output_mode():
+    return getattr(settings, "MPESA_QUERY_PROFILING", "off") or "off"
+
+
+def recent(limit=None):
+    """Newest-first profiles from this process's ring buffer."""
+    with _buffer_lock:
+        entries = list(_buffer)
+    entries.reverse()
+    return entries[:limit] if limit else entries
+
+
+def _record(request, response, stats):
+    match = getattr(request, "resolver_match", None)
+    size = getattr(settings, "MPESA_QUERY_PROFILING_BUFFER", 200)
+    entry = {
+        "at": time.time(),
+        "method": request.method,
+        "path": request.path,
+        "view": match.view_name if match else None,
+        "status": response.status_code,
+        "queries": stats.count,
+        "sql_ms": stats.milliseconds,
+        "slowest": stats.slowest(),
+    }
+    global _buffer
+    with _buffer_lock:
+        if _buffer.maxlen != size:
+            _buffer = collections.deque(_buffer, maxlen=size)
+        _buffer.append(entry)
+
+
+def _report(mode, request, response, stats):
+    if mode in ("headers", "both"):
+        response["X-DB-Queries"] = str(stats.count)
+        response["X-DB-Time-Ms"] = str(stats.milliseconds)
+        response["Server-Timing"] = f'db;dur={stats.milliseconds};desc="{stats.count} queries"'
+    if mode in ("buffer", "both"):
+        _record(request, response, stats)
+
+
+class QueryProfilingMiddleware:
+    """Opt-in query profiling per request; see the module docstring."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        mode = output_mode()
+        if mode == "off":
+            return self.get_response(request)
+
+        with capture(keep_slowest=getattr(settings, "MPESA_QUERY_PROFILING_SLOWEST", 3)) as stats:
+            response = self.get_response(request)
+        _report(mode, request, response, stats)
+        return response
+
+    async def __acall__(self, request):
+        mode = output_mode()
+        if mode == "off":
+            return await self.get_response(request)
+
+        # Install the wrapper on the thread the async ORM uses for this request
+        profile = capture(keep_slowest=getattr(settings, "MPESA_QUERY_PROFILING_SLOWEST", 3))
+        stats = await sync_to_async(profile.__enter__)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(profile.__exit__)(None, None, None)
+        _report(mode, request, response, stats)
+        return response
@@ -0,0 +1,256 @@
+"""
+Token-bucket rate limiting for outbound Daraja calls.
+
+Safaricom enforces per-app TPS limits, so the buckets live in Redis (the
+Celery broker instance by default) and are shared by every gunicorn and
+Celery process. If Redis is unreachable each process falls back to a local
+in-memory bucket until Redis answers again.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Atomically refill and take from a bucket stored as a Redis hash.
+# Returns the seconds to wait (as a string to keep the fraction), 0 if granted.
+_TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a token could not be obtained before the deadline."""
+
+
+def _acquire(bucket, tokens, timeout):
+    """Take ``tokens`` from ``bucket``, sleeping as needed; returns the seconds waited (0.0 if none)."""
+    started = time.monotonic()
+    deadline = None if timeout is None else started + timeout
+    waited = False
+    while True:
+        wait = bucket.try_acquire(tokens)
+        if not wait:
+            return time.monotonic() - started if waited else 0.0
+        if deadline is not None and time.monotonic() + wait > deadline:
+            raise RateLimitExceeded(f"no token within {timeout}s")
+        time.sleep(wait)
+        waited = True
+
+
+async def _aacquire(bucket, tokens, timeout):
+    started = time.monotonic()
+    deadline = None if timeout is None else started + timeout
+    waited = False
+    while True:
+        wait = await bucket.atry_acquire(tokens)
+        if not wait:
+            return time.monotonic() - started if waited else 0.0
+        if deadline is not None and time.monotonic() + wait > deadline:
+            raise RateLimitExceeded(f"no token within {timeout}s")
+        await asyncio.sleep(wait)
+        waited = True
+
+
+class LocalTokenBucket:
+    """
+    In-process token bucket: ``rate`` tokens per second, up to ``burst``.
+
+    Thread-safe; each process gets its own budget.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, tokens=1):
+        """Take ``tokens`` if available; otherwise return the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    async def atry_acquire(self, tokens=1):
+        # Only a lock held for a few arithmetic steps; fine on the event loop
+        return self.try_acquire(tokens)
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        Block until ``tokens`` are available and return the time waited.
+
+        Raises ``RateLimitExceeded`` if that would take longer than ``timeout``
+        seconds (``timeout=0`` sheds load immediately).
+        """
+        return _acquire(self, tokens, timeout)
+
+
+class RedisTokenBucket:
+    """
+    Cluster-wide token bucket stored in Redis, with a local fallback.
+
+    While Redis is failing, calls use a ``LocalTokenBucket`` with the same
+    rate and Redis is retried every ``retry_after`` seconds.
+    """
+
+    def __init__(self, name, rate, burst=None, client=None, retry_after=30):
+        self.key = f"mpesa:ratelimit:{name}"
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.retry_after = retry_after
+        self._client = client
+        self._script = None
+        self._fallback = LocalTokenBucket(rate, burst)
+        self._down_until = 0.0
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+
+            url = getattr(settings, "MPESA_RATE_LIMIT_REDIS_URL", "") or settings.CELERY_BROKER_URL
+            self._client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        return self._client
+
+    @property
+    def using_fallback(self):
+        return time.monotonic() < self._down_until
+
+    def try_acquire(self, tokens=1):
+        if self.using_fallback:
+            return self._fallback.try_acquire(tokens)
+        try:
+            if self._script is None:
+                self._script = self.client.register_script(_TOKEN_BUCKET_LUA)
+            return float(self._script(keys=[self.key], args=[self.rate, self.burst, tokens]))
+        except Exception as e:
+            logger.warning("Rate limiter Redis unavailable, using local bucket for %ss: %s", self.retry_after, e)
+            self._down_until = time.monotonic() + self.retry_after
+            return self._fallback.try_acquire(tokens)
+
+    async def atry_acquire(self, tokens=1):
+        """``try_acquire`` with the blocking Redis round trip moved off the event loop."""
+        if self.using_fallback:
+            return self._fallback.try_acquire(tokens)
+        return await sync_to_async(self.try_acquire, thread_sensitive=False)(tokens)
+
+    def acquire(self, tokens=1, timeout=None):
+        return _acquire(self, tokens, timeout)
+
+
+class RateLimiter:
+    """
+    Named limiter that records how long callers waited and how many were shed,
+    in ``stats()`` and as Prometheus metrics labelled with the bucket name.
+
+    ``acquire(timeout=...)`` waits up to ``timeout`` seconds for a token;
+    pass ``timeout=0`` to shed load immediately.
+    """
+
+    def __init__(self, name, bucket):
+        self.name = name
+        self.bucket = bucket
+        self._lock = threading.Lock()
+        self._stats = {"acquired": 0, "shed": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+
+    def acquire(self, tokens=1, timeout=None):
+        try:
+            waited = self.bucket.acquire(tokens, timeout)
+        except RateLimitExceeded:
+            self._record_shed()
+            raise
+        self._record_wait(waited)
+        return waited
+
+    async def aacquire(self, tokens=1, timeout=None):
+        """Like ``acquire`` but waits with ``asyncio.sleep`` instead of blocking."""
+        try:
+            waited = await _aacquire(self.bucket, tokens, timeout)
+        except RateLimitExceeded:
+            self._record_shed()
+            raise
+        self._record_wait(waited)
+        return waited
+
+    def _record_shed(self):
+        with self._lock:
+            self._stats["shed"] += 1
+        metrics.RATE_LIMIT_REQUESTS.labels(self.name, "shed").inc()
+
+    def _record_wait(self, waited):
+        with self._lock:
+            self._stats["acquired"] += 1
+            self._stats["wait_seconds_total"] += waited
+            self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], waited)
+        metrics.RATE_LIMIT_REQUESTS.labels(self.name, "waited" if waited else "immediate").inc()
+        metrics.RATE_LIMIT_WAIT_SECONDS.labels(self.name).observe(waited)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, fallback=getattr(self.bucket, "using_fallback", False))
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name):
+    """
+    Return the limiter for a Daraja endpoint (``oauth``, ``stk_push``,
+    ``stk_query``), or None when MPESA_RATE_LIMITS sets no rate for it.
+    """
+    rate = getattr(settings, "MPESA_RATE_LIMITS", {}).get(name)
+    if not rate:
+        return None
+    limiter = _limiters.get(name)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(name)
+            if limiter is None:
+                if getattr(settings, "MPESA_RATE_LIMIT_BACKEND", "redis") == "redis":
+                    bucket = RedisTokenBucket(name, rate)
+                else:
+                    bucket = LocalTokenBucket(rate)
+                limiter = _limiters[name] = RateLimiter(name, bucket)
+    return limiter
+
+
+def stats():
+    """Return wait/shed counters for every limiter created in this process."""
+    return {name: limiter.stats() for name, limiter in _limiters.items()}
+
+
+def reset():
+    """Forget all limiters (e.g. after changing MPESA_RATE_LIMITS)."""
+    with _limiters_lock:
+        _limiters.clear()
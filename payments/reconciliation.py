@@ -0,0 +1,113 @@
+"""
+Reconciliation helpers: PENDING-transaction summaries, CSV export and the
+watermark that makes periodic runs incremental.
+
+The export streams rows straight from the database cursor into the output
+file, so memory use stays flat however many transactions are pending.
+"""
+
+import csv
+import datetime
+import gzip
+import logging
+import os
+from pathlib import Path
+
+from django.conf import settings
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from .models import PaymentTransaction, ReconciliationState
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FIELDS = ["id", "phone_number", "amount", "status", "mpesa_checkout_request_id", "created_at", "updated_at"]
+
+
+def stale_cutoff(now=None):
+    """Creation time before which a PENDING transaction counts as stale."""
+    minutes = getattr(settings, "MPESA_RECONCILE_STALE_MINUTES", 10)
+    return (now or timezone.now()) - datetime.timedelta(minutes=minutes)
+
+
+def pending_summary(queryset=None, now=None):
+    """Return total, stale and oldest-created figures for PENDING rows in one query."""
+    if queryset is None:
+        queryset = PaymentTransaction.objects.all()
+    return queryset.filter(status="PENDING").aggregate(
+        total=Count("id"),
+        stale=Count("id", filter=Q(created_at__lt=stale_cutoff(now))),
+        oldest=Min("created_at"),
+    )
+
+
+def export_path(directory=None, compress=None, now=None):
+    """Build a timestamped report path so concurrent runs never overwrite each other."""
+    directory = Path(directory or getattr(settings, "MPESA_RECONCILE_EXPORT_DIR", "reports"))
+    if compress is None:
+        compress = getattr(settings, "MPESA_RECONCILE_GZIP", False)
+    stamp = (now or timezone.now()).strftime("%Y%m%dT%H%M%S%fZ")
+    return directory / f"reconciliation_report_{stamp}.csv{'.gz' if compress else ''}"
+
+
+def export_transactions(queryset, path, chunk_size=None):
+    """
+    Stream ``queryset`` to a CSV (gzip-compressed if ``path`` ends in .gz).
+
+    Rows are fetched with ``values_list`` in chunks of ``chunk_size`` and
+    written in a single pass. The file is written under a temporary name
+    and renamed into place when complete. Returns the number of rows.
+    """
+    chunk_size = chunk_size or getattr(settings, "MPESA_RECONCILE_CHUNK_SIZE", 2000)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+
+    opener = gzip.open if path.suffix == ".gz" else open
+    rows = 0
+    try:
+        with opener(tmp_path, "wt", newline="") as fh:
+            writer = csv.writer(fh)
+            writer.writerow(EXPORT_FIELDS)
+            for row in queryset.values_list(*EXPORT_FIELDS).iterator(chunk_size=chunk_size):
+                writer.writerow(row)
+                rows += 1
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return rows
+
+
+def needs_full_sweep(state, now=None):
+    """True when the job has no watermark yet or the last full sweep is too old."""
+    if state.watermark is None or state.last_full_sweep_at is None:
+        return True
+    hours = getattr(settings, "MPESA_RECONCILE_FULL_SWEEP_HOURS", 24)
+    return (now or timezone.now()) - state.last_full_sweep_at >= datetime.timedelta(hours=hours)
+
+
+def next_watermark(started_at):
+    """
+    Watermark to store after a run that started at ``started_at``.
+
+    It trails the start time by MPESA_RECONCILE_WATERMARK_LAG seconds so rows
+    committed by transactions that were still open during the run are
+    picked up again next time.
+    """
+    lag = getattr(settings, "MPESA_RECONCILE_WATERMARK_LAG", 60)
+    return started_at - datetime.timedelta(seconds=lag)
+
+
+def record_run(state, started_at, full, rows_scanned, duration_ms):
+    """Persist the watermark and the cost of a finished run."""
+    state.watermark = next_watermark(started_at)
+    state.last_run_at = started_at
+    state.last_run_full = full
+    state.last_rows_scanned = rows_scanned
+    state.last_duration_ms = duration_ms
+    fields = ["watermark", "last_run_at", "last_run_full", "last_rows_scanned", "last_duration_ms"]
+    if full:
+        state.last_full_sweep_at = started_at
+        fields.append("last_full_sweep_at")
+    ReconciliationState.objects.filter(pk=state.pk).update(**{name: getattr(state, name) for name in fields})
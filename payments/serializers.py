@@ -5,5 +5,5 @@ from .models import PaymentTransaction
 class PaymentTransactionSerializer(serializers.ModelSerializer):
     class Meta:
         model = PaymentTransaction
-        fields = ("id", "phone_number", "amount", "status", "mpesa_checkout_request_id", "created_at")
+        fields = ("id", "phone_number", "amount", "status", "mpesa_checkout_request_id", "created_at", "updated_at")
 
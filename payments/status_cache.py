@@ -0,0 +1,130 @@
+"""
+Read-through cache of transaction status for polling clients.
+
+Entries hold the serialized transaction under its id; a second key maps the
+M-Pesa CheckoutRequestID to that id. Every status change goes through
+``payments.transitions``, which calls ``invalidate`` after the update (and
+again on commit). Invalidation writes a short-lived marker instead of
+deleting the key, so a reader that loaded the old row just before the
+change cannot put it back with ``cache.add``. Entries also expire after
+MPESA_STATUS_CACHE_TTL seconds, which bounds any missed invalidation.
+
+Cache errors are logged and the caller falls back to the database.
+"""
+
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import PaymentTransaction
+from .serializers import PaymentTransactionSerializer
+
+logger = logging.getLogger(__name__)
+
+_INVALIDATED = "invalidated"
+
+
+def enabled():
+    return getattr(settings, "MPESA_STATUS_CACHE", True)
+
+
+def _id_key(pk):
+    return f"mpesa:txstatus:{pk}"
+
+
+def _checkout_key(checkout_id):
+    return f"mpesa:txstatus:co:{checkout_id}"
+
+
+def _ttl():
+    return getattr(settings, "MPESA_STATUS_CACHE_TTL", 60)
+
+
+def _load(**lookup):
+    tx = PaymentTransaction.objects.only(*PaymentTransactionSerializer.Meta.fields).filter(**lookup).first()
+    return dict(PaymentTransactionSerializer(tx).data) if tx else None
+
+
+def _fill(data, current):
+    """Cache freshly loaded ``data`` unless the key was just invalidated."""
+    if current == _INVALIDATED:
+        return
+    try:
+        if data["mpesa_checkout_request_id"]:
+            cache.set(_checkout_key(data["mpesa_checkout_request_id"]), data["id"], timeout=_ttl())
+        cache.add(_id_key(data["id"]), data, timeout=_ttl())
+    except Exception:
+        logger.warning("Status cache unavailable; not caching %s", data["id"], exc_info=True)
+
+
+def _get(key):
+    try:
+        return cache.get(key)
+    except Exception:
+        logger.warning("Status cache unavailable; reading from the database", exc_info=True)
+        return _INVALIDATED
+
+
+def get_by_id(pk):
+    """Serialized transaction ``pk`` (cache first), or None if it does not exist."""
+    if not enabled():
+        return _load(pk=pk)
+    current = _get(_id_key(pk))
+    if isinstance(current, dict):
+        return current
+    data = _load(pk=pk)
+    if data:
+        _fill(data, current)
+    return data
+
+
+def get_by_checkout_id(checkout_id):
+    """Serialized transaction for an M-Pesa CheckoutRequestID, or None."""
+    if not enabled():
+        return _load(mpesa_checkout_request_id=checkout_id)
+    pk = _get(_checkout_key(checkout_id))
+    if pk and pk != _INVALIDATED:
+        data = get_by_id(pk)
+        if data and data["mpesa_checkout_request_id"] == checkout_id:
+            return data
+    data = _load(mpesa_checkout_request_id=checkout_id)
+    if data:
+        _fill(data, _get(_id_key(data["id"])))
+    return data
+
+
+def _mark(pks, checkout_ids):
+    try:
+        if checkout_ids:
+            pointers = cache.get_many([_checkout_key(c) for c in checkout_ids])
+            pks = set(pks) | {pk for pk in pointers.values() if pk != _INVALIDATED}
+        hold = getattr(settings, "MPESA_STATUS_CACHE_INVALIDATE_HOLD", 1)
+        cache.set_many({_id_key(pk): _INVALIDATED for pk in pks}, timeout=hold)
+    except Exception:
+        logger.warning("Failed to invalidate status cache for %s %s", pks, checkout_ids, exc_info=True)
+
+
+def delete(pks=(), checkout_ids=()):
+    """Remove the entries for these transactions outright, e.g. after a benchmark."""
+    keys = [_id_key(pk) for pk in pks] + [_checkout_key(c) for c in checkout_ids if c]
+    if keys:
+        cache.delete_many(keys)
+
+
+def invalidate(pks=(), checkout_ids=()):
+    """
+    Drop cached status for transactions by id and/or CheckoutRequestID.
+
+    Runs immediately and again once the surrounding DB transaction commits,
+    so readers never cache a row version that is about to change.
+    """
+    if not enabled():
+        return
+    pks = [str(pk) for pk in pks]
+    checkout_ids = [c for c in checkout_ids if c]
+    if not pks and not checkout_ids:
+        return
+    _mark(pks, checkout_ids)
+    transaction.on_commit(lambda: _mark(pks, checkout_ids))
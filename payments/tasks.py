@@ -1,14 +1,27 @@
-import csv
-import json
+import datetime
 import logging
+import time
+import uuid
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Q
 from django.utils import timezone
-from pathlib import Path
 
-from .models import PaymentTransaction
+from .daraja import DarajaUnavailable, build_stk_push_payload, get_access_token, get_client
+from . import archive, callbacks, dedup, outbox, reconciliation, transitions
+from .models import CallbackLog, CallbackReplayJob, PaymentTransaction, ReconciliationState
 
 logger = logging.getLogger(__name__)
 
+RECONCILE_STATE_NAME = "pending-export"
+RECONCILE_LOCK_KEY = "mpesa:reconcile:lock"
+ARCHIVE_LOCK_KEY = "mpesa:cblog-archive:lock"
+STALE_PENDING_LOCK_KEY = "mpesa:stale-pending:lock"
+
 
 @shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=5, retry_kwargs={"max_retries": 5})
 def process_stk_callback(self, payload):
@@ -24,74 +37,566 @@ def process_stk_callback(self, payload):
         logger.warning("Callback ignored: missing CheckoutRequestID")
         return
 
-    tx = PaymentTransaction.objects.filter(
-        mpesa_checkout_request_id=checkout_id
-    ).first()
+    status_str = transitions.status_for_result_code(result_code)
+
+    # Idempotency: the conditional update only matches a non-final row
+    if not transitions.transition_by_checkout_id(checkout_id, status_str):
+        logger.info("Callback ignored (not found or already processed): %s", checkout_id)
+        return
+
+    logger.info("Transaction %s processed → %s", checkout_id, status_str)
+
+
+@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=5, retry_kwargs={"max_retries": 5})
+def process_callback_log(self, log_id):
+    """Validate and apply a callback stored by the ingest-only fast path.
+
+    The log row is locked before the transaction row (the same order the
+    batch drainer uses) and only unprocessed rows are picked up, so a
+    redelivered task cannot apply the same callback twice. A callback for a
+    checkout id not saved yet releases its de-dup claim, as the synchronous
+    view does, so M-Pesa's retry is taken instead of dropped.
+    """
+    with transaction.atomic():
+        log = (
+            CallbackLog.objects.select_for_update()
+            .filter(pk=log_id, processed=False)
+            .only("id", "payload")
+            .first()
+        )
+        if not log:
+            logger.info("Callback log %s already processed", log_id)
+            return
+
+        result = callbacks.apply_stk_callback(log.payload)
+        CallbackLog.objects.filter(pk=log.pk).update(
+            processed=True,
+            processing_status=result.status or result.outcome,
+            details=result.result_desc or result.outcome,
+        )
+
+    if result.outcome == callbacks.NOT_FOUND:
+        dedup.release(result.checkout_id, callbacks.parse_stk_callback(log.payload)["result_code"])
+    logger.info("Callback log %s processed: %s", log_id, result.outcome)
+
+
+def process_callback_batch(batch_size):
+    """
+    Process up to ``batch_size`` unprocessed callback logs in one transaction.
+
+    All checkout ids are resolved with one IN query and the transitions are
+    applied with one conditional bulk update; the logs are then marked with
+    a single bulk_update. De-dup claims of callbacks whose checkout id is
+    not known yet are released afterwards, so their retries are taken.
+    Returns the number of logs processed.
+    """
+    with transaction.atomic():
+        logs = list(
+            CallbackLog.objects.select_for_update(skip_locked=True)
+            .filter(processed=False, processing_status=callbacks.RECEIVED)
+            .order_by("received_at")
+            .only("id", "payload")[:batch_size]
+        )
+        if not logs:
+            return 0
+
+        parsed = {log.pk: callbacks.parse_stk_callback(log.payload) for log in logs}
+        checkout_ids = {p["checkout_id"] for p in parsed.values() if p["checkout_id"]}
+        txs = {
+            tx.mpesa_checkout_request_id: tx
+            for tx in PaymentTransaction.objects.filter(mpesa_checkout_request_id__in=checkout_ids)
+            .only("id", "status", "amount", "mpesa_checkout_request_id")
+        }
+
+        # Decide every log first; a later callback for the same transaction
+        # in this batch is a duplicate of the first one.
+        decisions, changes, claimed = {}, {}, set()
+        for log in logs:
+            p = parsed[log.pk]
+            tx = txs.get(p["checkout_id"])
+            outcome, status_str = callbacks.evaluate_stk_callback(p, tx)
+            if status_str and outcome != callbacks.DUPLICATE:
+                if tx.pk in claimed:
+                    outcome, status_str = callbacks.DUPLICATE, None
+                else:
+                    claimed.add(tx.pk)
+                    changes[tx.pk] = (status_str, {})
+            decisions[log.pk] = (outcome, status_str, tx)
+
+        applied = transitions.bulk_transition(changes)
+
+        for log in logs:
+            outcome, status_str, tx = decisions[log.pk]
+            if tx is not None and tx.pk in changes and tx.pk not in applied and outcome != callbacks.DUPLICATE:
+                outcome, status_str = callbacks.DUPLICATE, None
+            log.processed = True
+            log.processing_status = status_str or outcome
+            log.details = parsed[log.pk]["result_desc"] or outcome
+
+        CallbackLog.objects.bulk_update(logs, ["processed", "processing_status", "details"])
+
+    for log in logs:
+        if decisions[log.pk][0] == callbacks.NOT_FOUND:
+            dedup.release(parsed[log.pk]["checkout_id"], parsed[log.pk]["result_code"])
+    logger.info("Processed %d callbacks in batch (%d transitions)", len(logs), len(applied))
+    return len(logs)
+
+
+@shared_task
+def drain_callback_logs(batch_size=None, max_batches=None):
+    """Drain unprocessed callback logs in chunks of MPESA_CALLBACK_BATCH_SIZE."""
+    batch_size = batch_size or getattr(settings, "MPESA_CALLBACK_BATCH_SIZE", 500)
+    max_batches = max_batches or getattr(settings, "MPESA_CALLBACK_MAX_BATCHES", 20)
+    total = 0
+    for _ in range(max_batches):
+        processed = process_callback_batch(batch_size)
+        total += processed
+        if processed < batch_size:
+            break
+    return total
+
+
+@shared_task
+def relay_task_outbox():
+    """Beat-scheduled fallback for ``manage.py relay_outbox``: publish every due outbox message."""
+    return outbox.relay()
+
+
+# Bulk pushes run off the request path, so they can wait longer for a token
+BULK_RATE_LIMIT_WAIT = 30
+
+# Marks a bulk push that was refused by the circuit breaker and must be retried
+_DEFERRED = object()
+
 
+def _push_transition(response_data):
+    """Return ``(to_status, fields)`` for an STK push response (None means the push failed)."""
+    if response_data and response_data.get("ResponseCode") == "0":
+        return transitions.PENDING, {"mpesa_checkout_request_id": response_data.get("CheckoutRequestID")}
+    return transitions.FAILED, {}
+
+
+def _claim_push(transaction_id):
+    """Claim an INITIATED row for sending; False if another delivery of the task already has."""
+    return bool(
+        PaymentTransaction.objects.filter(
+            id=transaction_id, status=transitions.INITIATED, push_sent_at__isnull=True
+        ).update(push_sent_at=timezone.now())
+    )
+
+
+def _release_push_claims(transaction_ids):
+    """Undo claims on pushes that never reached Daraja, so their retries can claim them."""
+    PaymentTransaction.objects.filter(id__in=transaction_ids, status=transitions.INITIATED).update(push_sent_at=None)
+
+
+def _retry_or_fail(task, tx, exc):
+    """Retry a push that never reached Daraja, or mark it FAILED when out of retries."""
+    if task.request.retries >= task.max_retries:
+        logger.error("Giving up on STK push for %s: %s", tx.id, exc)
+        transitions.transition(tx, transitions.FAILED)
+        return
+    raise task.retry(exc=exc, countdown=5 * 2 ** task.request.retries)
+
+
+@shared_task(bind=True, max_retries=5)
+def initiate_stk_push(self, transaction_id):
+    """Send the STK push for an INITIATED transaction created by STKPushView.
+
+    Failures that happen before the push reaches Daraja (token errors, open
+    circuit breaker) are retried with backoff; once the push itself fails the
+    transaction is marked FAILED so the customer is never prompted twice.
+    The row is claimed (push_sent_at) right before the Daraja call, so a
+    redelivered task skips it.
+    """
+    tx = PaymentTransaction.objects.filter(id=transaction_id).first()
     if not tx:
-        logger.warning("Transaction not found: %s", checkout_id)
+        logger.warning("Transaction not found: %s", transaction_id)
         return
 
-    # Idempotency
-    if tx.status in ["SUCCESS", "FAILED"]:
-        logger.info("Duplicate callback ignored: %s", checkout_id)
+    if tx.status != transitions.INITIATED:
+        logger.info("STK push already sent for %s (status %s)", transaction_id, tx.status)
         return
 
+    payload = build_stk_push_payload(tx.phone_number, tx.amount)
     try:
-        result_code_int = int(result_code)
-    except Exception:
-        result_code_int = None
+        access_token = get_access_token()
+    except requests.RequestException as e:
+        return _retry_or_fail(self, tx, e)
+
+    if not _claim_push(tx.id):
+        logger.info("STK push for %s already claimed by another delivery", transaction_id)
+        return
 
-    tx.status = "SUCCESS" if result_code_int == 0 else "FAILED"
-    # optional audit field can be set here if present
     try:
-        if hasattr(tx, "last_event"):
-            tx.last_event = f"Processed via Celery: {tx.status}"
+        response_data = get_client().stk_push(payload, access_token)
+    except DarajaUnavailable as e:
+        _release_push_claims([tx.id])
+        return _retry_or_fail(self, tx, e)
+    except requests.RequestException as e:
+        logger.exception("STK push request failed for %s: %s", transaction_id, e)
+        response_data = None
+
+    to_status, fields = _push_transition(response_data)
+    transitions.transition(tx, to_status, **fields)
+
+    logger.info("STK push for %s -> %s", transaction_id, tx.status)
+
+
+@shared_task
+def initiate_stk_push_chunk(transaction_ids):
+    """Send STK pushes for a chunk of a bulk batch with bounded concurrency.
+
+    Only the Daraja calls run on the thread pool; all DB work stays on this
+    thread and the outcomes are written with one conditional bulk update. Pushes
+    that never reached Daraja fall back to individually retried tasks. Rows
+    are claimed (push_sent_at) before any push, so a redelivered chunk only
+    sends the ones nobody has claimed.
+    """
+    try:
+        access_token = get_access_token()
+    except requests.RequestException as e:
+        ids = list(
+            PaymentTransaction.objects.filter(id__in=transaction_ids, status=transitions.INITIATED)
+            .values_list("id", flat=True)
+        )
+        logger.warning("No access token for bulk chunk, deferring %d pushes: %s", len(ids), e)
+        with transaction.atomic():
+            for pk in ids:
+                outbox.enqueue(initiate_stk_push, str(pk))
+        return
+
+    with transaction.atomic():
+        txs = list(
+            PaymentTransaction.objects.select_for_update(skip_locked=True)
+            .filter(id__in=transaction_ids, status=transitions.INITIATED, push_sent_at__isnull=True)
+            .only("id", "phone_number", "amount")
+        )
+        PaymentTransaction.objects.filter(pk__in=[tx.pk for tx in txs]).update(push_sent_at=timezone.now())
+    if not txs:
+        return
+
+    client = get_client()
+
+    def push(tx):
+        try:
+            payload = build_stk_push_payload(tx.phone_number, tx.amount)
+            return tx, client.stk_push(payload, access_token, rate_limit_timeout=BULK_RATE_LIMIT_WAIT)
+        except DarajaUnavailable:
+            return tx, _DEFERRED
+        except requests.RequestException as e:
+            logger.warning("STK push request failed for %s: %s", tx.id, e)
+            return tx, None
+
+    concurrency = max(1, min(getattr(settings, "MPESA_BULK_CONCURRENCY", 10), len(txs)))
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(push, txs))
+
+    changes, deferred = {}, []
+    for tx, response_data in results:
+        if response_data is _DEFERRED:
+            deferred.append(tx)
+            continue
+        changes[tx.pk] = _push_transition(response_data)
+
+    applied = transitions.bulk_transition(changes)
+    with transaction.atomic():
+        _release_push_claims([tx.pk for tx in deferred])
+        for tx in deferred:
+            outbox.enqueue(initiate_stk_push, str(tx.id))
+
+    logger.info("Bulk chunk sent %d pushes, deferred %d", len(applied), len(deferred))
+
+
+def enqueue_stk_push_chunks(transaction_ids, chunk_size=None):
+    """Queue transaction ids as chunk tasks through the outbox, in the caller's transaction."""
+    chunk_size = chunk_size or getattr(settings, "MPESA_BULK_CHUNK_SIZE", 100)
+    ids = [str(i) for i in transaction_ids]
+    for i in range(0, len(ids), chunk_size):
+        outbox.enqueue(initiate_stk_push_chunk, ids[i:i + chunk_size])
+
+
+class ReplaySelectionTooLarge(Exception):
+    """Raised when a callback replay would cover more than MPESA_REPLAY_MAX_ROWS transactions."""
+
+
+@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=5, retry_kwargs={"max_retries": 5})
+def replay_callback_chunk(self, job_id, transaction_ids):
+    """Apply a replayed success callback to a chunk of a CallbackReplayJob.
+
+    Does what process_stk_callback does for one synthetic ResultCode 0
+    payload, for the whole chunk with one bulk transition. The job counters
+    move in the same transaction, so a retried chunk is not counted twice.
+    A chunk that still fails on its last retry is counted as failed, and
+    whichever chunk accounts for the last row finishes the job.
+    """
+    try:
+        with transaction.atomic():
+            applied = transitions.bulk_transition(
+                {uuid.UUID(pk): (transitions.SUCCESS, {}) for pk in transaction_ids}
+            )
+            CallbackReplayJob.objects.filter(pk=job_id).update(
+                processed=F("processed") + len(transaction_ids), applied=F("applied") + len(applied)
+            )
     except Exception:
-        logger.exception("Failed to set last_event for %s", checkout_id)
+        if self.request.retries < self.max_retries:
+            raise
+        logger.exception("Callback replay %s: giving up on a chunk of %d transactions", job_id, len(transaction_ids))
+        CallbackReplayJob.objects.filter(pk=job_id).update(failed=F("failed") + len(transaction_ids))
+        applied = []
+    _finish_callback_replay(job_id)
+    return len(applied)
+
+
+def _finish_callback_replay(job_id):
+    """Mark a CallbackReplayJob finished once every row is processed or failed."""
+    finished = CallbackReplayJob.objects.filter(
+        pk=job_id, finished_at__isnull=True, processed__gte=F("total") - F("failed")
+    ).update(finished_at=timezone.now())
+    if finished:
+        job = CallbackReplayJob.objects.get(pk=job_id)
+        logger.info(
+            "Callback replay %s finished: %d transactions moved to SUCCESS, %d failed", job_id, job.applied, job.failed
+        )
+
+
+def start_callback_replay(queryset, source, selection=None, created_by=""):
+    """
+    Create a CallbackReplayJob for the PENDING rows of ``queryset`` that have
+    a CheckoutRequestID, and queue its chunks with the job row.
+
+    Raises ``ReplaySelectionTooLarge`` if more than MPESA_REPLAY_MAX_ROWS
+    rows match, so an open-ended selection never loads unbounded ids here.
+    """
+    max_rows = getattr(settings, "MPESA_REPLAY_MAX_ROWS", 50000)
+    ids = [
+        str(pk) for pk in queryset.filter(status=transitions.PENDING, mpesa_checkout_request_id__isnull=False)
+        .order_by().values_list("pk", flat=True)[:max_rows + 1].iterator(chunk_size=2000)
+    ]
+    if len(ids) > max_rows:
+        raise ReplaySelectionTooLarge(f"selection matches more than {max_rows} PENDING transactions")
+    with transaction.atomic():
+        job = CallbackReplayJob.objects.create(
+            source=source, selection=selection or {}, created_by=created_by, total=len(ids),
+            finished_at=None if ids else timezone.now(),
+        )
+        enqueue_callback_replay(job.pk, ids)
+    return job
+
+
+def enqueue_callback_replay(job_id, transaction_ids, chunk_size=None):
+    """Queue a replay job's chunk tasks through the outbox, in the caller's transaction."""
+    chunk_size = chunk_size or getattr(settings, "MPESA_REPLAY_CHUNK_SIZE", 500)
+    ids = [str(i) for i in transaction_ids]
+    for i in range(0, len(ids), chunk_size):
+        outbox.enqueue(replay_callback_chunk, str(job_id), ids[i:i + chunk_size])
+
+
+def _fail_abandoned_pushes(cutoff, batch_size, max_batches):
+    """Move INITIATED rows created before ``cutoff`` to FAILED; returns how many moved."""
+    abandoned = (
+        PaymentTransaction.objects.filter(status=transitions.INITIATED, created_at__lt=cutoff)
+        .order_by("created_at", "id")
+        .values_list("id", flat=True)
+    )
+    failed = 0
+    for _ in range(max_batches):
+        ids = list(abandoned[:batch_size])
+        if not ids:
+            break
+        failed += len(transitions.bulk_transition({pk: (transitions.FAILED, {}) for pk in ids}))
+        if len(ids) < batch_size:
+            break
+    return failed
+
+
+@shared_task
+def resolve_stale_pending(batch_size=None, max_batches=None):
+    """
+    Resolve PENDING transactions whose callback never arrived.
+
+    Stale rows (older than MPESA_RECONCILE_STALE_MINUTES) are walked in
+    keyset-paginated chunks and checked with the STK Push Query API,
+    concurrently but within the shared ``stk_query`` rate limit. Results
+    go through the same result-code mapping as callbacks. Rows still
+    unresolved after MPESA_PENDING_EXPIRY_MINUTES are moved to TIMEOUT so
+    the PENDING set stays bounded.
+
+    INITIATED rows just as old never got their push out (the task was lost
+    or gave up without recording it) and are marked FAILED; a push task
+    still queued for one then finds it final and sends nothing.
+
+    A run can outlast the beat interval while it waits on the rate limiter,
+    so runs are single-flight: one that finds another in progress does
+    nothing rather than query the same rows again.
+    """
+    lock_timeout = getattr(settings, "MPESA_STK_QUERY_LOCK_TIMEOUT", 900)
+    if not cache.add(STALE_PENDING_LOCK_KEY, 1, timeout=lock_timeout):
+        logger.info("Stale PENDING resolver already running; skipping this run.")
+        return
+    try:
+        return _resolve_stale_pending(batch_size, max_batches)
+    finally:
+        cache.delete(STALE_PENDING_LOCK_KEY)
+
+
+def _resolve_stale_pending(batch_size, max_batches):
+    batch_size = batch_size or getattr(settings, "MPESA_STK_QUERY_BATCH_SIZE", 100)
+    max_batches = max_batches or getattr(settings, "MPESA_STK_QUERY_MAX_BATCHES", 10)
+    concurrency = getattr(settings, "MPESA_STK_QUERY_CONCURRENCY", 5)
+
+    now = timezone.now()
+    cutoff = reconciliation.stale_cutoff(now)
+    expiry = now - datetime.timedelta(minutes=getattr(settings, "MPESA_PENDING_EXPIRY_MINUTES", 60))
+
+    stats = {
+        "queried": 0, "resolved": 0, "expired": 0,
+        "abandoned": _fail_abandoned_pushes(cutoff, batch_size, max_batches),
+    }
+
+    try:
+        access_token = get_access_token()
+    except requests.RequestException as e:
+        logger.warning("Cannot resolve stale transactions without an access token: %s", e)
+        return stats
 
-    tx.save()
+    client = get_client()
 
-    logger.info("Transaction %s processed → %s", checkout_id, tx.status)
+    def query(row):
+        pk, checkout_id, created_at = row
+        if not checkout_id:
+            return pk, created_at, None
+        try:
+            return pk, created_at, client.stk_query(checkout_id, access_token, rate_limit_timeout=30)
+        except requests.RequestException as e:
+            logger.warning("STK query failed for %s: %s", checkout_id, e)
+            return pk, created_at, None
+
+    stale = (
+        PaymentTransaction.objects.filter(status=transitions.PENDING, created_at__lt=cutoff)
+        .order_by("created_at", "id")
+        .values_list("id", "mpesa_checkout_request_id", "created_at")
+    )
+    last = None
+    for _ in range(max_batches):
+        chunk = stale
+        if last:
+            chunk = chunk.filter(Q(created_at__gt=last[0]) | Q(created_at=last[0], id__gt=last[1]))
+        rows = list(chunk[:batch_size])
+        if not rows:
+            break
+        last = (rows[-1][2], rows[-1][0])
+
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(rows)))) as pool:
+            results = list(pool.map(query, rows))
+
+        changes, expired = {}, set()
+        for pk, created_at, data in results:
+            if data and data.get("ResponseCode") == "0" and data.get("ResultCode") is not None:
+                changes[pk] = (transitions.status_for_result_code(data["ResultCode"]), {})
+            elif created_at < expiry:
+                changes[pk] = (transitions.TIMEOUT, {})
+                expired.add(pk)
+
+        applied = transitions.bulk_transition(changes)
+        stats["queried"] += len(rows)
+        stats["expired"] += len(applied & expired)
+        stats["resolved"] += len(applied - expired)
+
+        if len(rows) < batch_size:
+            break
+
+    logger.info(
+        "Stale PENDING resolver: queried %(queried)d, resolved %(resolved)d, expired %(expired)d, "
+        "abandoned INITIATED %(abandoned)d", stats
+    )
+    return stats
 
 
 @shared_task
-def reconcile_transactions():
+def reconcile_transactions(full=False):
     """
     Periodic reconciliation task:
-    - Finds PENDING transactions older than X minutes
+    - Counts PENDING transactions and those older than
+      MPESA_RECONCILE_STALE_MINUTES in one aggregate query
     - Logs issues
-    - Exports a CSV for accounting
+    - Streams a timestamped (optionally gzipped) CSV for accounting
+
+    Runs are incremental: only PENDING rows updated since the stored
+    watermark are counted and exported, with a full sweep every
+    MPESA_RECONCILE_FULL_SWEEP_HOURS (or when ``full`` is passed).
     """
+    if not cache.add(RECONCILE_LOCK_KEY, 1, timeout=getattr(settings, "MPESA_RECONCILE_LOCK_TIMEOUT", 600)):
+        logger.info("Reconciliation already running; skipping this run.")
+        return
+    try:
+        return _reconcile(full)
+    finally:
+        cache.delete(RECONCILE_LOCK_KEY)
+
+
+def _reconcile(full):
+    started_at = timezone.now()
+    started = time.monotonic()
+    state, _ = ReconciliationState.objects.get_or_create(name=RECONCILE_STATE_NAME)
+    full = full or reconciliation.needs_full_sweep(state, started_at)
+
     pending_tx = PaymentTransaction.objects.filter(status="PENDING")
+    if not full:
+        pending_tx = pending_tx.filter(updated_at__gt=state.watermark)
 
-    if not pending_tx.exists():
+    # Summarise the window being exported, so incremental runs never aggregate the whole table
+    summary = reconciliation.pending_summary(pending_tx, now=started_at)
+
+    if not summary["total"]:
         logger.info("No pending transactions for reconciliation.")
+        reconciliation.record_run(state, started_at, full, 0, int((time.monotonic() - started) * 1000))
         return
 
-    logger.info("Reconciling %d pending transactions...", pending_tx.count())
+    logger.info("Reconciling %d pending transactions...", summary["total"])
 
-    for tx in pending_tx:
-        age_minutes = (timezone.now() - tx.created_at).total_seconds() / 60
-        if age_minutes > 10:
-            logger.warning(
-                "Transaction %s has been PENDING for %.1f minutes.", tx.id, age_minutes
-            )
+    if summary["stale"]:
+        logger.warning(
+            "%d transactions have been PENDING for more than %d minutes (oldest %.1f minutes).",
+            summary["stale"],
+            getattr(settings, "MPESA_RECONCILE_STALE_MINUTES", 10),
+            (started_at - summary["oldest"]).total_seconds() / 60,
+        )
+
+    csv_path = reconciliation.export_path(now=started_at)
+    rows = reconciliation.export_transactions(pending_tx, csv_path)
+    if not rows:
+        csv_path.unlink()
+
+    duration_ms = int((time.monotonic() - started) * 1000)
+    reconciliation.record_run(state, started_at, full, rows, duration_ms)
 
-    csv_path = Path("reconciliation_report.csv")
-    with open(csv_path, "w", newline="") as csvfile:
-        fieldnames = ["id", "phone_number", "amount", "status", "mpesa_checkout_request_id", "created_at", "updated_at"]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for tx in pending_tx:
-            writer.writerow({
-                "id": tx.id,
-                "phone_number": tx.phone_number,
-                "amount": tx.amount,
-                "status": tx.status,
-                "mpesa_checkout_request_id": tx.mpesa_checkout_request_id,
-                "created_at": tx.created_at,
-                "updated_at": tx.updated_at,
-            })
-
-    logger.info("Reconciliation report written to %s", csv_path)
+    logger.info(
+        "Reconciliation %s run scanned %d rows in %d ms%s",
+        "full" if full else "incremental",
+        rows,
+        duration_ms,
+        f"; report written to {csv_path}" if rows else "",
+    )
+    return str(csv_path) if rows else None
+
+
+@shared_task
+def archive_callback_logs(max_batches=None):
+    """
+    Move processed callback logs past MPESA_CALLBACK_RETENTION_DAYS into the
+    compressed JSONL archive and delete them (see ``payments.archive``).
+    """
+    if not cache.add(ARCHIVE_LOCK_KEY, 1, timeout=getattr(settings, "MPESA_CALLBACK_ARCHIVE_LOCK_TIMEOUT", 3600)):
+        logger.info("Callback log archival already running; skipping this run.")
+        return
+    try:
+        started = time.monotonic()
+        result = archive.archive_callbacks(max_batches=max_batches)
+    finally:
+        cache.delete(ARCHIVE_LOCK_KEY)
+    logger.info(
+        "Archived %d callback logs into %d files in %d ms",
+        result["archived"], len(result["files"]), int((time.monotonic() - started) * 1000),
+    )
+    return result
@@ -1,3 +1,1336 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import csv
+import datetime
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Create your tests here.
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import FieldError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from prometheus_client import REGISTRY
+
+from mpesa_project.celery import app
+
+from . import (
+    archive, events, idempotency, outbox, profiling, ratelimit, reconciliation, status_cache, transitions, views,
+)
+from .admin import CappedCountPaginator
+from .daraja import DarajaClient, build_stk_push_payload, get_client, set_client, token_cache
+from .daraja_stub import StubDarajaServer, _Handler, stk_callback_payload
+from .models import CallbackLog, CallbackReplayJob, OutboxMessage, PaymentTransaction, ReconciliationState
+from .tasks import (
+    STALE_PENDING_LOCK_KEY,
+    drain_callback_logs,
+    initiate_stk_push_chunk,
+    process_stk_callback,
+    reconcile_transactions,
+    relay_task_outbox,
+    replay_callback_chunk,
+    resolve_stale_pending,
+)
+from .tokens import AccessTokenCache, AccessTokenMissing
+
+
+class QueryPlanTests(TestCase):
+    """Hot lookups must be served by an index, not a full table scan."""
+
+    def assertUsesIndex(self, queryset, index_name=None):
+        plan = queryset.explain()
+        if connection.vendor == "sqlite":
+            self.assertNotIn("SCAN", plan, plan)
+        else:
+            self.assertNotIn("Seq Scan", plan, plan)
+        if index_name:
+            self.assertIn(index_name, plan)
+
+    def test_checkout_id_lookup_uses_index(self):
+        self.assertUsesIndex(PaymentTransaction.objects.filter(mpesa_checkout_request_id="ws_CO_1"))
+
+    def test_pending_by_age_uses_status_created_index(self):
+        self.assertUsesIndex(
+            PaymentTransaction.objects.filter(status="PENDING").order_by("created_at"),
+            "payments_tx_status_created",
+        )
+
+    def test_transactions_by_phone_use_phone_created_index(self):
+        self.assertUsesIndex(
+            PaymentTransaction.objects.filter(phone_number="254700000000").order_by("-created_at"),
+            "payments_tx_phone_created",
+        )
+
+    def test_callback_log_lookup_uses_index(self):
+        self.assertUsesIndex(
+            CallbackLog.objects.filter(checkout_request_id="ws_CO_1").order_by("-received_at"),
+            "payments_cblog_checkout_recv",
+        )
+
+    def test_retention_scan_uses_received_index(self):
+        self.assertUsesIndex(
+            CallbackLog.objects.filter(processed=True, received_at__lt=timezone.now()).order_by("received_at", "id"),
+            "payments_cblog_received",
+        )
+
+
+class TransitionTests(TestCase):
+    def setUp(self):
+        self.tx = PaymentTransaction.objects.create(
+            phone_number="254700000000", amount="10.00", status="PENDING", mpesa_checkout_request_id="ws_CO_1"
+        )
+
+    def test_only_first_terminal_transition_wins(self):
+        self.assertTrue(transitions.transition_by_checkout_id("ws_CO_1", transitions.SUCCESS))
+        self.assertFalse(transitions.transition_by_checkout_id("ws_CO_1", transitions.FAILED))
+        self.tx.refresh_from_db()
+        self.assertEqual(self.tx.status, "SUCCESS")
+
+    def test_stale_instance_cannot_overwrite(self):
+        stale = PaymentTransaction.objects.get(pk=self.tx.pk)
+        self.assertTrue(transitions.transition(self.tx, transitions.CANCELLED))
+        self.assertFalse(transitions.transition(stale, transitions.SUCCESS))
+        self.assertEqual(stale.status, "PENDING")
+
+    def test_bulk_transition_skips_illegal_moves(self):
+        other = PaymentTransaction.objects.create(phone_number="254700000001", amount="5.00")
+        applied = transitions.bulk_transition({
+            self.tx.pk: (transitions.TIMEOUT, {}),
+            other.pk: (transitions.PENDING, {"mpesa_checkout_request_id": "ws_CO_2"}),
+        })
+        self.assertEqual(applied, {self.tx.pk, other.pk})
+        self.assertFalse(transitions.bulk_transition({self.tx.pk: (transitions.SUCCESS, {})}))
+        other.refresh_from_db()
+        self.assertEqual((other.status, other.mpesa_checkout_request_id), ("PENDING", "ws_CO_2"))
+
+    def test_result_codes_map_to_statuses(self):
+        self.assertEqual(transitions.status_for_result_code("1032"), "TIMEOUT")
+        self.assertEqual(transitions.status_for_result_code(None), "FAILED")
+
+
+class StatusCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tx = PaymentTransaction.objects.create(
+            phone_number="254700000000", amount="10.00", status="PENDING", mpesa_checkout_request_id="ws_CO_1"
+        )
+
+    def test_polls_are_served_from_cache(self):
+        self.assertEqual(status_cache.get_by_id(self.tx.pk)["status"], "PENDING")
+        with self.assertNumQueries(0):
+            self.assertEqual(status_cache.get_by_id(self.tx.pk)["status"], "PENDING")
+            self.assertEqual(status_cache.get_by_checkout_id("ws_CO_1")["id"], str(self.tx.pk))
+
+    def test_transitions_invalidate_both_keys(self):
+        status_cache.get_by_checkout_id("ws_CO_1")
+        self.assertTrue(transitions.transition_by_checkout_id("ws_CO_1", transitions.SUCCESS))
+        self.assertEqual(status_cache.get_by_id(self.tx.pk)["status"], "SUCCESS")
+        self.assertEqual(status_cache.get_by_checkout_id("ws_CO_1")["status"], "SUCCESS")
+
+    def test_only_staff_see_customer_fields(self):
+        for url in (f"/payments/transactions/{self.tx.pk}/", "/payments/transactions/checkout/ws_CO_1/"):
+            self.assertEqual(set(self.client.get(url).data), {"id", "status", "updated_at"})
+        staff = User.objects.create_user("staff", password="pw", is_staff=True)
+        self.client.force_login(staff)
+        detail = self.client.get(f"/payments/transactions/{self.tx.pk}/").data
+        self.assertEqual((detail["phone_number"], detail["amount"]), ("254700000000", "10.00"))
+
+
+@override_settings(MPESA_EVENTS_BACKEND="local")
+class TransactionEventsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tx = PaymentTransaction.objects.create(
+            phone_number="254700000000", amount="10.00", status="PENDING", mpesa_checkout_request_id="ws_CO_1"
+        )
+
+    def _finalize(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            transitions.transition_by_checkout_id("ws_CO_1", transitions.SUCCESS)
+
+    async def test_stream_pushes_final_status(self):
+        response = await self.async_client.get(f"/payments/transactions/{self.tx.pk}/events/")
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        stream = aiter(response.streaming_content)
+        chunks = [await anext(stream) for _ in range(2)]
+        self.assertIn("event: status", chunks[1].decode())
+        self.assertEqual(events.hub.count(), 1)
+
+        await sync_to_async(self._finalize)()
+        final = (await asyncio.wait_for(anext(stream), 5)).decode()
+        self.assertTrue(final.startswith("event: final"))
+        self.assertEqual(json.loads(final.split("data: ", 1)[1])["status"], "SUCCESS")
+        with self.assertRaises(StopAsyncIteration):
+            await anext(stream)
+        self.assertEqual(events.hub.count(), 0)
+
+    async def test_final_event_is_built_without_reading_the_row(self):
+        response = await self.async_client.get(f"/payments/transactions/{self.tx.pk}/events/")
+        stream = aiter(response.streaming_content)
+        [await anext(stream) for _ in range(2)]
+
+        def finalize():
+            with self.captureOnCommitCallbacks() as callbacks:
+                transitions.transition(self.tx, transitions.CANCELLED)
+            with self.assertNumQueries(0):
+                for callback in callbacks:
+                    callback()
+
+        await sync_to_async(finalize)()
+        final = json.loads((await asyncio.wait_for(anext(stream), 5)).decode().split("data: ", 1)[1])
+        self.assertEqual(final["status"], "CANCELLED")
+        self.assertNotIn("phone_number", final)
+        detail = await self.async_client.get(f"/payments/transactions/{self.tx.pk}/")
+        self.assertEqual(final["updated_at"], detail.json()["updated_at"])
+
+    async def test_deleted_row_ends_the_stream_with_an_error(self):
+        stream = views._status_events(uuid.uuid4())
+        self.assertTrue((await anext(stream)).startswith("event: error"))
+        with self.assertRaises(StopAsyncIteration):
+            await anext(stream)
+
+
+class QueryBudgetMixin:
+    """``assertQueryBudget(n)``: fail if the block runs more than ``n`` queries."""
+
+    @contextlib.contextmanager
+    def assertQueryBudget(self, budget):
+        with profiling.capture(keep_all=True) as stats:
+            yield stats
+        if stats.count > budget:
+            self.fail(
+                f"{stats.count} queries, budget is {budget}:\n"
+                + "\n".join(f"  {n}. {sql}" for n, sql in enumerate(stats.statements, 1))
+            )
+
+
+class StubDarajaMixin:
+    """Point the shared Daraja client at a fresh in-process stub for each test."""
+
+    def setUp(self):
+        super().setUp()
+        self.server = StubDarajaServer().start()
+        self.previous_client = get_client()
+        set_client(DarajaClient(base_url=self.server.url))
+        token_cache.invalidate()
+        ratelimit.reset()
+
+    def tearDown(self):
+        set_client(self.previous_client)
+        token_cache.invalidate()
+        ratelimit.reset()
+        self.server.stop()
+        super().tearDown()
+
+
+class _CallbackInbox(BaseHTTPRequestHandler):
+    """Collects the callbacks the stub posts, for replay through the test client."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.server.received.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+@override_settings(
+    MPESA_EVENTS_BACKEND="local", MPESA_STK_PUSH_ASYNC=False, MPESA_CALLBACK_INGEST_ONLY=False,
+    MPESA_TASK_OUTBOX=False,
+)
+class DarajaStubSmokeTests(StubDarajaMixin, TestCase):
+    """OAuth, push, query and the stub's callback, end to end through the app."""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.inbox = ThreadingHTTPServer(("127.0.0.1", 0), _CallbackInbox)
+        self.inbox.received = []
+        threading.Thread(target=self.inbox.serve_forever, daemon=True).start()
+        self.server.callback_delay = 0
+        self.server.callback_url = "http://127.0.0.1:%d/" % self.inbox.server_address[1]
+        self.eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+
+    def tearDown(self):
+        app.conf.task_always_eager = self.eager
+        self.inbox.shutdown()
+        self.inbox.server_close()
+        super().tearDown()
+
+    def wait_for_callback(self):
+        deadline = time.monotonic() + 5
+        while not self.inbox.received and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(self.inbox.received, "stub never posted its callback")
+        return self.inbox.received[0]
+
+    def test_push_query_and_callback(self):
+        response = self.client.post(
+            "/payments/stk-push/", {"phone_number": "254700000000", "amount": "10"}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+        checkout_id = response.data["CheckoutRequestID"]
+        self.assertEqual(self.server.calls["/oauth/v1/generate"], 1)
+        self.assertEqual(self.server.pushes[checkout_id]["PhoneNumber"], "254700000000")
+
+        self.server.query_results[checkout_id] = None
+        processing = get_client().stk_query(checkout_id, token_cache.get_token())
+        self.assertEqual(processing["errorCode"], "500.001.1001")
+        del self.server.query_results[checkout_id]
+        self.assertEqual(get_client().stk_query(checkout_id, token_cache.get_token())["ResultCode"], "0")
+        self.assertEqual(self.server.calls["/oauth/v1/generate"], 1)
+
+        callback = self.wait_for_callback()
+        self.assertEqual(callback["Body"]["stkCallback"]["CheckoutRequestID"], checkout_id)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/payments/callback/", callback, content_type="application/json")
+        self.assertEqual(response.data["status"], "processed")
+        self.assertEqual(PaymentTransaction.objects.get(mpesa_checkout_request_id=checkout_id).status, "SUCCESS")
+        self.assertTrue(CallbackLog.objects.get(checkout_request_id=checkout_id).processed)
+
+
+@override_settings(
+    MPESA_EVENTS_BACKEND="local", MPESA_RATE_LIMIT_BACKEND="local", MPESA_STK_PUSH_ASYNC=True,
+)
+class AsyncSTKPushTests(StubDarajaMixin, TestCase):
+    """MPESA_STK_PUSH_ASYNC: 202 with a status URL, the push itself in initiate_stk_push."""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+
+    def tearDown(self):
+        app.conf.task_always_eager = self.eager
+        super().tearDown()
+
+    def push(self):
+        response = self.client.post(
+            "/payments/stk-push/", {"phone_number": "254700000000", "amount": "10"}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 202)
+        return response.data
+
+    def test_accepted_push_is_sent_by_the_task(self):
+        accepted = self.push()
+
+        self.assertEqual(accepted["status"], "INITIATED")
+        self.assertEqual(accepted["status_url"], f"/payments/transactions/{accepted['transaction_id']}/")
+        self.assertEqual(self.server.calls.get("/mpesa/stkpush/v1/processrequest", 0), 0)
+
+        outbox.relay()
+
+        self.assertEqual(self.client.get(accepted["status_url"]).data["status"], "PENDING")
+        tx = PaymentTransaction.objects.get(pk=accepted["transaction_id"])
+        self.assertIn(tx.mpesa_checkout_request_id, self.server.pushes)
+        self.assertEqual(self.server.calls["/mpesa/stkpush/v1/processrequest"], 1)
+
+    def test_push_is_retried_then_failed_without_a_token(self):
+        self.server.access_token = ""
+        accepted = self.push()
+
+        outbox.relay()
+
+        self.assertEqual(self.client.get(accepted["status_url"]).data["status"], "FAILED")
+        # the first attempt and initiate_stk_push.max_retries retries, none reaching the push endpoint
+        self.assertEqual(self.server.calls["/oauth/v1/generate"], 6)
+        self.assertNotIn("/mpesa/stkpush/v1/processrequest", self.server.calls)
+
+    def test_redelivered_task_does_not_push_a_claimed_row(self):
+        accepted = self.push()
+        # A first delivery claimed the row and is still waiting on Daraja
+        PaymentTransaction.objects.filter(pk=accepted["transaction_id"]).update(push_sent_at=timezone.now())
+
+        outbox.relay()
+
+        self.assertEqual(self.client.get(accepted["status_url"]).data["status"], "INITIATED")
+        self.assertNotIn("/mpesa/stkpush/v1/processrequest", self.server.calls)
+
+    def test_push_refused_by_the_breaker_is_released_for_its_retries(self):
+        accepted = self.push()
+        breaker = get_client().breaker
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+
+        outbox.relay()
+
+        # Each retry could claim the row again, and the last one failed it
+        self.assertEqual(self.client.get(accepted["status_url"]).data["status"], "FAILED")
+        self.assertNotIn("/mpesa/stkpush/v1/processrequest", self.server.calls)
+
+    def test_rejected_push_is_failed_without_a_retry(self):
+        self.server.error_rate = 1.0
+        accepted = self.push()
+
+        outbox.relay()
+
+        self.assertEqual(self.client.get(accepted["status_url"]).data["status"], "FAILED")
+        self.assertEqual(self.server.calls["/mpesa/stkpush/v1/processrequest"], 1)
+
+
+@override_settings(MPESA_EVENTS_BACKEND="local", MPESA_RATE_LIMIT_BACKEND="local", MPESA_BULK_CHUNK_SIZE=2)
+class BulkSTKPushTests(StubDarajaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        User.objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client.login(username="admin", password="pw")
+        self.eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+
+    def tearDown(self):
+        app.conf.task_always_eager = self.eager
+        super().tearDown()
+
+    def post(self, items):
+        return self.client.post("/payments/stk-push/bulk/", items, content_type="application/json")
+
+    def test_batch_is_accepted_then_pushed_in_chunks(self):
+        response = self.post([{"phone_number": f"25470000000{n}", "amount": "10"} for n in range(5)])
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data["total"], 5)
+        self.assertEqual(response.data["status_url"], f"/payments/stk-push/bulk/{response.data['batch_id']}/")
+        self.assertEqual(OutboxMessage.objects.count(), 3)
+        self.assertEqual(self.client.get(response.data["status_url"]).data["counts"], {"INITIATED": 5})
+
+        outbox.relay()
+
+        detail = self.client.get(response.data["status_url"]).data
+        self.assertEqual((detail["total"], detail["counts"]), (5, {"PENDING": 5}))
+        self.assertEqual({item["mpesa_checkout_request_id"] for item in detail["items"]}, set(self.server.pushes))
+        self.assertEqual(self.server.calls["/oauth/v1/generate"], 1)
+
+    def test_invalid_rows_reject_the_whole_batch(self):
+        response = self.post([
+            {"phone_number": "254700000000", "amount": "10"},
+            {"phone_number": "254700000001", "amount": "-5"},
+            {"phone_number": "254700000002", "amount": "1e20"},
+            {"phone_number": "254700000003", "amount": "10.005"},
+            {"phone_number": "", "amount": "10"},
+            {"phone_number": "254700000005"},
+            "254700000006",
+        ])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error["row"] for error in response.data["errors"]], [1, 2, 3, 4, 5, 6])
+        self.assertIn("greater than zero", response.data["errors"][0]["detail"])
+        self.assertIn("digits", response.data["errors"][1]["detail"])
+        self.assertFalse(PaymentTransaction.objects.exists())
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_requires_staff(self):
+        batch_id = self.post([{"phone_number": "254700000000", "amount": "10"}]).data["batch_id"]
+        self.client.logout()
+        self.assertEqual(self.post([{"phone_number": "254700000000", "amount": "10"}]).status_code, 403)
+        self.assertEqual(self.client.get(f"/payments/stk-push/bulk/{batch_id}/").status_code, 403)
+        self.assertEqual(PaymentTransaction.objects.count(), 1)
+
+    def test_chunk_task_pushes_only_initiated_rows(self):
+        initiated = [PaymentTransaction.objects.create(phone_number="254700000000", amount="10.00") for _ in range(3)]
+        sent = PaymentTransaction.objects.create(
+            phone_number="254700000000", amount="10.00", status="PENDING", mpesa_checkout_request_id="ws_CO_sent"
+        )
+        self.server.error_rate = 1.0
+
+        initiate_stk_push_chunk([str(tx.pk) for tx in initiated + [sent]])
+
+        self.assertEqual(self.server.calls["/mpesa/stkpush/v1/processrequest"], 3)
+        self.assertEqual(
+            dict(PaymentTransaction.objects.values_list("status").annotate(n=Count("id")).order_by()),
+            {"FAILED": 3, "PENDING": 1},
+        )
+
+    def test_redelivered_chunk_skips_rows_already_claimed(self):
+        txs = [PaymentTransaction.objects.create(phone_number="254700000000", amount="10.00") for _ in range(3)]
+        # Another delivery of the chunk claimed the first row and is still waiting on Daraja
+        PaymentTransaction.objects.filter(pk=txs[0].pk).update(push_sent_at=timezone.now())
+
+        initiate_stk_push_chunk([str(tx.pk) for tx in txs])
+        initiate_stk_push_chunk([str(tx.pk) for tx in txs])
+
+        self.assertEqual(self.server.calls["/mpesa/stkpush/v1/processrequest"], 2)
+        self.assertEqual(PaymentTransaction.objects.get(pk=txs[0].pk).status, "INITIATED")
+        self.assertEqual(PaymentTransaction.objects.filter(status="PENDING").count(), 2)
+
+
+@override_settings(MPESA_EVENTS_BACKEND="local", MPESA_RATE_LIMIT_BACKEND="local", MPESA_STK_PUSH_ASYNC=False)
+class IdempotencyTests(StubDarajaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def push(self, key="key-1", amount="10", **extra):
+        return self.client.post(
+            "/payments/stk-push/", {"phone_number": "254700000000", "amount": amount},
+            content_type="application/json", HTTP_IDEMPOTENCY_KEY=key, **extra,
+        )
+
+    def pushes_sent(self):
+        return self.server.calls.get("/mpesa/stkpush/v1/processrequest", 0)
+
+    def test_repeat_is_replayed_without_a_second_push(self):
+        first = self.push()
+        again = self.push()
+        self.assertEqual((again.status_code, again.data), (first.status_code, first.data))
+        self.assertEqual(again["Idempotent-Replayed"], "true")
+        self.assertEqual((self.pushes_sent(), PaymentTransaction.objects.count()), (1, 1))
+
+    def test_key_reused_with_another_body_is_rejected(self):
+        self.push()
+        self.assertEqual(self.push(amount="20").status_code, 422)
+        self.assertEqual(self.pushes_sent(), 1)
+
+    @override_settings(MPESA_IDEMPOTENCY_WAIT=0.1)
+    def test_duplicate_of_an_in_flight_request_gets_409(self):
+        _, lock_key = idempotency._cache_keys(RequestFactory().post("/payments/stk-push/"), "key-1")
+        cache.add(lock_key, 1)
+        self.assertEqual(self.push().status_code, 409)
+        self.assertEqual(self.pushes_sent(), 0)
+
+    def test_keys_are_scoped_per_client(self):
+        self.push(REMOTE_ADDR="10.0.0.1")
+        response = self.push(amount="20", REMOTE_ADDR="10.0.0.2")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(self.pushes_sent(), 2)
+
+    @override_settings(CACHES={"default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://127.0.0.1:1/0",
+    }})
+    def test_cache_outage_runs_the_request_unprotected(self):
+        self.assertEqual(self.push().status_code, 200)
+        self.assertEqual(self.pushes_sent(), 1)
+
+    @override_settings(MPESA_IDEMPOTENCY_LOCK_TIMEOUT=0, MPESA_CONNECT_TIMEOUT=3, MPESA_READ_TIMEOUT=15)
+    def test_lock_outlives_the_slowest_push(self):
+        # OAuth and push, each retried once after a 401, each waiting for a rate-limit token
+        self.assertEqual(idempotency.lock_timeout(), 4 * (3 + 15 + 2))
+
+
+def _redis_client():
+    """A client for the rate limiter's Redis, or None when it is not reachable."""
+    client = redis.Redis.from_url(settings.CELERY_BROKER_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    try:
+        client.ping()
+    except redis.RedisError:
+        return None
+    return client
+
+
+class _DownRedis:
+    """Stands in for a Redis client whose server is unreachable."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def register_script(self, script):
+        self.calls += 1
+        raise redis.ConnectionError("Connection refused")
+
+
+class _ThreadRecordingRedis:
+    """Stands in for a reachable Redis client; records the thread each script call runs on."""
+
+    def __init__(self):
+        self.threads = []
+
+    def register_script(self, script):
+        def run(keys, args):
+            self.threads.append(threading.get_ident())
+            return "0"
+        return run
+
+
+class RateLimitTests(SimpleTestCase):
+    def test_local_bucket_grants_the_burst_then_asks_to_wait(self):
+        bucket = ratelimit.LocalTokenBucket(rate=10, burst=2)
+        self.assertEqual([bucket.try_acquire(), bucket.try_acquire()], [0.0, 0.0])
+        self.assertAlmostEqual(bucket.try_acquire(), 0.1, delta=0.01)
+        time.sleep(0.1)
+        self.assertEqual(bucket.try_acquire(), 0.0)
+
+    def test_limiter_waits_or_sheds_and_exports_both(self):
+        limiter = ratelimit.RateLimiter("test_bucket", ratelimit.LocalTokenBucket(rate=20, burst=1))
+
+        self.assertEqual(limiter.acquire(), 0.0)
+        self.assertGreater(limiter.acquire(timeout=1), 0.02)
+        with self.assertRaises(ratelimit.RateLimitExceeded):
+            limiter.acquire(timeout=0)
+        stats = limiter.stats()
+        self.assertEqual((stats["acquired"], stats["shed"]), (2, 1))
+
+        for outcome in ("immediate", "waited", "shed"):
+            labels = {"bucket": "test_bucket", "outcome": outcome}
+            self.assertEqual(REGISTRY.get_sample_value("mpesa_rate_limit_requests_total", labels), 1)
+        self.assertEqual(REGISTRY.get_sample_value("mpesa_rate_limit_wait_seconds_count", {"bucket": "test_bucket"}), 2)
+
+    def test_redis_bucket_falls_back_to_a_local_bucket_and_retries_later(self):
+        client = _DownRedis()
+        bucket = ratelimit.RedisTokenBucket("test", rate=10, burst=1, client=client, retry_after=0.05)
+
+        self.assertEqual(bucket.try_acquire(), 0.0)
+        self.assertTrue(bucket.using_fallback)
+        self.assertGreater(bucket.try_acquire(), 0)
+        self.assertEqual(client.calls, 1)
+
+        time.sleep(0.06)
+        bucket.try_acquire()
+        self.assertEqual(client.calls, 2)
+
+    def test_async_acquire_runs_the_redis_call_off_the_event_loop(self):
+        client = _ThreadRecordingRedis()
+        limiter = ratelimit.RateLimiter("test", ratelimit.RedisTokenBucket("test", rate=10, client=client))
+
+        async def acquire():
+            await limiter.aacquire()
+            return threading.get_ident()
+
+        loop_thread = asyncio.run(acquire())
+        self.assertEqual(len(client.threads), 1)
+        self.assertNotEqual(client.threads[0], loop_thread)
+
+    def test_redis_script_shares_one_bucket(self):
+        client = _redis_client()
+        if client is None:
+            self.skipTest("Redis is not reachable")
+        name = f"test:{uuid.uuid4().hex}"
+        self.addCleanup(client.delete, f"mpesa:ratelimit:{name}")
+        first = ratelimit.RedisTokenBucket(name, rate=10, burst=2, client=client)
+        second = ratelimit.RedisTokenBucket(name, rate=10, burst=2, client=client)
+
+        self.assertEqual([first.try_acquire(), second.try_acquire()], [0.0, 0.0])
+        self.assertAlmostEqual(first.try_acquire(), 0.1, delta=0.02)
+        self.assertFalse(first.using_fallback)
+        self.assertGreater(client.ttl(f"mpesa:ratelimit:{name}"), 0)
+
+
+class AccessTokenCacheTests(StubDarajaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.fetches = []
+
+    def token_cache(self, *replies):
+        """An AccessTokenCache whose fetch hands out ``replies`` in order (exceptions are raised)."""
+        replies = list(replies)
+
+        def fetch():
+            self.fetches.append(replies[0])
+            reply = replies.pop(0)
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+
+        return AccessTokenCache(fetch, cache_key="test:token", lock_key="test:token:lock")
+
+    def test_missing_token_raises_and_is_not_cached(self):
+        tokens = self.token_cache(("", "3599"), ("fresh", "3599"))
+        with self.assertRaises(AccessTokenMissing):
+            tokens.get_token()
+        self.assertIsNone(cache.get("test:token"))
+        self.assertIsNone(cache.get("test:token:lock"))
+        self.assertEqual(tokens.get_token(), "fresh")
+        self.assertEqual(tokens.stats()["errors"], 1)
+
+    def test_failed_refresh_serves_the_still_valid_token(self):
+        # expires inside the refresh margin, so the next call refreshes
+        tokens = self.token_cache(("old", "60"), ConnectionError("down"))
+        self.assertEqual(tokens.get_token(), "old")
+        self.assertEqual(tokens.get_token(), "old")
+        self.assertEqual(len(self.fetches), 2)
+        self.assertEqual(tokens.stats()["errors"], 1)
+
+    def test_refresh_lock_is_only_released_by_its_holder(self):
+        tokens = self.token_cache()
+        owner = tokens._acquire_shared_lock()
+        self.assertIsNone(tokens._acquire_shared_lock())
+        # our lock expired and another worker took it
+        cache.set("test:token:lock", "someone-else")
+        tokens._release_shared_lock(owner)
+        self.assertEqual(cache.get("test:token:lock"), "someone-else")
+
+    def test_invalidate_keeps_a_token_that_was_already_replaced(self):
+        tokens = self.token_cache(("first", "3599"))
+        tokens.get_token()
+        tokens.invalidate(rejected="older")
+        self.assertEqual(tokens.get_token(), "first")
+        tokens.invalidate(rejected="first")
+        self.assertIsNone(cache.get("test:token"))
+
+    def test_rejected_token_is_refreshed_and_the_call_retried_once(self):
+        rejected = token_cache.get_token()
+        self.server.rejected_tokens.add(rejected)
+        self.server.access_token = "fresh-token"
+
+        body = get_client().stk_push(build_stk_push_payload("254700000000", 10), rejected)
+
+        self.assertEqual(body["ResponseCode"], "0")
+        self.assertEqual(self.server.calls["/mpesa/stkpush/v1/processrequest"], 2)
+        self.assertEqual(token_cache.get_token(), "fresh-token")
+
+    def test_counters_are_exported(self):
+        token_cache.get_token()
+        body = self.client.get("/metrics").content.decode()
+        self.assertRegex(body, r'mpesa_token_cache_total\{result="refreshes"\} [1-9]')
+
+
+@override_settings(
+    MPESA_EVENTS_BACKEND="local", MPESA_RATE_LIMIT_BACKEND="local", MPESA_STK_PUSH_ASYNC=False,
+    MPESA_CALLBACK_INGEST_ONLY=False,
+)
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    """Query budgets for the hot views; raise one only with a reason in the commit."""
+
+    def setUp(self):
+        cache.clear()
+        self.server = StubDarajaServer().start()
+        self.previous_client = get_client()
+        set_client(DarajaClient(base_url=self.server.url))
+        token_cache.invalidate()
+        ratelimit.reset()
+        # Run enqueued callback tasks in-process so their queries count too
+        self.eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+
+    def tearDown(self):
+        app.conf.task_always_eager = self.eager
+        set_client(self.previous_client)
+        token_cache.invalidate()
+        self.server.stop()
+
+    def push(self):
+        return self.client.post(
+            "/payments/stk-push/", {"phone_number": "254700000000", "amount": "10"}, content_type="application/json"
+        )
+
+    def test_stk_push(self):
+        with self.assertQueryBudget(2):
+            self.assertEqual(self.push().status_code, 200)
+
+    def test_stk_callback(self):
+        checkout_id = self.push().data["CheckoutRequestID"]
+        payload = {"Body": {"stkCallback": {
+            "CheckoutRequestID": checkout_id, "ResultCode": 0, "ResultDesc": "ok",
+            "CallbackMetadata": {"Item": [{"Name": "Amount", "Value": 10}]},
+        }}}
+        # lookup, transition, CallbackLog and outbox inserts, in one transaction
+        # (a savepoint pair here, inside the test's transaction); the on_commit
+        # status publish reuses the transitioned rows and adds none
+        with self.assertQueryBudget(6), self.captureOnCommitCallbacks(execute=True) as callbacks:
+            response = self.client.post("/payments/callback/", payload, content_type="application/json")
+        self.assertTrue(callbacks)
+        self.assertEqual(response.data["status"], "processed")
+
+    def test_replay_callback(self):
+        checkout_id = self.push().data["CheckoutRequestID"]
+        with self.assertQueryBudget(2):
+            self.assertEqual(self.client.post(f"/payments/callback/replay/{checkout_id}/").status_code, 200)
+
+    def test_admin_changelist_does_not_grow_with_rows(self):
+        User.objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client.login(username="admin", password="pw")
+        PaymentTransaction.objects.bulk_create(
+            [PaymentTransaction(phone_number="254700000000", amount="10.00") for _ in range(25)]
+        )
+        # session, user, capped count, rows, and MIN + MAX for the date drill-down
+        with self.assertQueryBudget(6):
+            self.assertEqual(self.client.get("/admin/payments/paymenttransaction/").status_code, 200)
+
+    @override_settings(MPESA_QUERY_PROFILING="both")
+    def test_profiling_middleware_reports_queries(self):
+        response = self.push()
+        self.assertEqual(response["X-DB-Queries"], "2")
+        self.assertIn("db;dur=", response["Server-Timing"])
+        profile = profiling.recent(1)[0]
+        self.assertEqual((profile["view"], profile["queries"]), ("stk_push", 2))
+        self.assertTrue(profile["slowest"][0]["sql"])
+
+    @override_settings(MPESA_QUERY_PROFILING="headers")
+    async def test_profiling_middleware_counts_async_view_queries(self):
+        await PaymentTransaction.objects.acreate(
+            phone_number="254700000000", amount="10.00", status="PENDING", mpesa_checkout_request_id="ws_CO_async"
+        )
+        payload = {"Body": {"stkCallback": {"CheckoutRequestID": "ws_CO_async", "ResultCode": 1032, "ResultDesc": "x"}}}
+        response = await self.async_client.post("/payments/async/callback/", payload, content_type="application/json")
+        self.assertEqual(json.loads(response.content)["status"], "processed")
+        # Same statements as the sync callback view in test_stk_callback
+        self.assertEqual(response["X-DB-Queries"], "6")
+
+
+@override_settings(
+    MPESA_EVENTS_BACKEND="local", MPESA_CALLBACK_INGEST_ONLY=False, MPESA_CALLBACK_DEDUP=True, MPESA_TASK_OUTBOX=True,
+)
+class CallbackDedupTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        PaymentTransaction.objects.create(
+            phone_number="254700000000", amount="10.00", status="PENDING", mpesa_checkout_request_id="ws_CO_1"
+        )
+        self.payload = stk_callback_payload("ws_CO_1", 0, amount=10, phone=254700000000)
+
+    def callback(self):
+        return self.client.post("/payments/callback/", self.payload, content_type="application/json").data["status"]
+
+    def dedup_count(self, result):
+        return REGISTRY.get_sample_value("mpesa_callback_dedup_total", {"result": result}) or 0
+
+    def test_retry_is_acknowledged_without_queries(self):
+        suppressed = self.dedup_count("suppressed")
+        self.assertEqual(self.callback(), "processed")
+        with self.assertQueryBudget(0):
+            self.assertEqual(self.callback(), "already processed")
+        self.assertEqual(self.dedup_count("suppressed"), suppressed + 1)
+        self.assertEqual(CallbackLog.objects.count(), 1)
+
+    @override_settings(CACHES={"default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://127.0.0.1:1/0",
+    }})
+    def test_cache_outage_falls_back_to_the_conditional_transition(self):
+        unavailable = self.dedup_count("unavailable")
+        self.assertEqual(self.callback(), "processed")
+        self.assertEqual(self.callback(), "already processed")
+        self.assertEqual(self.dedup_count("unavailable"), unavailable + 2)
+        self.assertEqual(PaymentTransaction.objects.get().status, "SUCCESS")
+        self.assertEqual(CallbackLog.objects.count(), 1)
+
+
+class AdminChangelistTests(TestCase):
+    url = "/admin/payments/paymenttransaction/"
+
+    def setUp(self):
+        User.objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client.login(username="admin", password="pw")
+        for phone, checkout_id in (("254711000001", "ws_CO_A"), ("254711000002", "ws_CO_B"), ("254722000003", None)):
+            PaymentTransaction.objects.create(phone_number=phone, amount="10.00", mpesa_checkout_request_id=checkout_id)
+
+    def results(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return sorted(tx.phone_number for tx in response.context["cl"].result_list)
+
+    def test_search_is_exact_or_prefix(self):
+        self.assertEqual(self.results(q="254711000001"), ["254711000001"])
+        self.assertEqual(self.results(q="2547110"), [])
+        self.assertEqual(self.results(q="254711*"), ["254711000001", "254711000002"])
+        self.assertEqual(self.results(q="ws_CO_B"), ["254711000002"])
+
+    def test_date_drill_down_links_come_from_first_and_last_row(self):
+        today = timezone.localdate()
+        response = self.client.get(self.url, {"created_at__year": today.year, "created_at__month": today.month})
+        links = [choice["link"] for choice in response.context["choices"]]
+        self.assertEqual(len(links), 1)
+        self.assertIn(f"created_at__day={today.day}", links[0])
+
+    @override_settings(MPESA_ADMIN_COUNT_LIMIT=2)
+    def test_count_stops_at_limit(self):
+        self.assertEqual(self.client.get(self.url).context["cl"].result_count, 2)
+        self.assertEqual(CappedCountPaginator(PaymentTransaction.objects.all(), 1).num_pages, 2)
+
+
+@override_settings(MPESA_EVENTS_BACKEND="local", MPESA_CALLBACK_INGEST_ONLY=True, MPESA_CALLBACK_BATCHING=False)
+class CallbackIngestTests(TestCase):
+    """MPESA_CALLBACK_INGEST_ONLY: store and acknowledge, apply in process_callback_log."""
+
+    def setUp(self):
+        cache.clear()
+        self.eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+
+    def tearDown(self):
+        app.conf.task_always_eager = self.eager
+
+    def callback(self, payload):
+        return self.client.post("/payments/callback/", payload, content_type="application/json").data["status"]
+
+    def test_callback_is_stored_then_applied_by_the_task(self):
+        tx = PaymentTransaction.objects.create(
+            phone_number="254700000000", amount="10.00", status="PENDING", mpesa_checkout_request_id="ws_CO_1"
+        )
+        payload = stk_callback_payload("ws_CO_1", 0, amount=10, phone=254700000000)
+
+        self.assertEqual(self.callback(payload), "received")
+        log = CallbackLog.objects.get()
+        self.assertEqual((log.processed, log.processing_status), (False, "received"))
+        self.assertEqual(self.callback(payload), "already processed")
+
+        outbox.relay()
+
+        log.refresh_from_db()
+        tx.refresh_from_db()
+        self.assertEqual((log.processed, log.processing_status, tx.status), (True, "SUCCESS", "SUCCESS"))
+        self.assertEqual(CallbackLog.objects.count(), 1)
+
+    def test_callback_for_an_unsaved_checkout_id_is_retried_not_dropped(self):
+        # The callback beats the push response that records the checkout id
+        tx = PaymentTransaction.objects.create(phone_number="254700000000", amount="10.00", status="PENDING")
+        payload = stk_callback_payload("ws_CO_early", 0, amount=10, phone=254700000000)
+
+        self.assertEqual(self.callback(payload), "received")
+        outbox.relay()
+        self.assertEqual(CallbackLog.objects.get().processing_status, "transaction not found")
+
+        PaymentTransaction.objects.filter(pk=tx.pk).update(mpesa_checkout_request_id="ws_CO_early")
+        self.assertEqual(self.callback(payload), "received")
+        outbox.relay()
+
+        tx.refresh_from_db()
+        self.assertEqual(tx.status, "SUCCESS")
+
+
+@override_settings(MPESA_EVENTS_BACKEND="local", MPESA_CALLBACK_INGEST_ONLY=True, MPESA_CALLBACK_BATCHING=True)
+class CallbackBatchTests(TestCase):
+    """MPESA_CALLBACK_BATCHING: ingested logs are applied by drain_callback_logs."""
+
+    def setUp(self):
+        cache.clear()
+
+    def callback(self, checkout_id, result_code, amount=10):
+        payload = stk_callback_payload(checkout_id, result_code, amount=amount, phone=254700000000)
+        return self.client.post("/payments/callback/", payload, content_type="application/json").data["status"]
+
+    def test_two_logs_for_one_transaction_apply_once(self):
+        tx = PaymentTransaction.objects.create(
+            phone_number="254700000000", amount="10.00", status="PENDING", mpesa_checkout_request_id="ws_CO_1"
+        )
+        other = PaymentTransaction.objects.create(
+            phone_number="254700000000", amount="10.00", status="PENDING", mpesa_checkout_request_id="ws_CO_2"
+        )
+        # Different result codes, so both get past the de-dup claim
+        self.assertEqual(self.callback("ws_CO_1", 0), "received")
+        self.assertEqual(self.callback("ws_CO_1", 1032), "received")
+        self.assertEqual(self.callback("ws_CO_2", 1032), "received")
+        self.assertFalse(OutboxMessage.objects.exists())
+
+        self.assertEqual(drain_callback_logs(batch_size=2), 3)
+
+        tx.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(other.status, "TIMEOUT")
+        # Whichever log came first decides; the other is recorded as a duplicate
+        logs = CallbackLog.objects.filter(checkout_request_id="ws_CO_1")
+        self.assertEqual(set(logs.values_list("processing_status", flat=True)), {tx.status, "already processed"})
+        self.assertFalse(CallbackLog.objects.filter(processed=False).exists())
+        self.assertEqual(drain_callback_logs(), 0)
+
+    def test_unknown_checkout_id_releases_its_claim(self):
+        self.callback("ws_CO_early", 0)
+        drain_callback_logs()
+        self.assertEqual(self.callback("ws_CO_early", 0), "received")
+
+
+@override_settings(MPESA_EVENTS_BACKEND="local", MPESA_REPLAY_CHUNK_SIZE=2)
+class BulkReplayTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client.login(username="admin", password="pw")
+        self.eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        self.pending = [
+            PaymentTransaction.objects.create(
+                phone_number="254700000000", amount="10.00", status="PENDING", mpesa_checkout_request_id=f"ws_CO_{n}"
+            )
+            for n in range(5)
+        ]
+        PaymentTransaction.objects.create(
+            phone_number="254700000000", amount="10.00", status="FAILED", mpesa_checkout_request_id="ws_CO_F"
+        )
+
+    def tearDown(self):
+        app.conf.task_always_eager = self.eager
+
+    def test_api_replays_selection_in_chunks_and_reports_progress(self):
+        ids = [str(tx.pk) for tx in self.pending[:3]]
+        response = self.client.post(
+            "/payments/callback/replay/bulk/", {"ids": ids, "created_after": "2000-01-01"},
+            content_type="application/json",
+        )
+        self.assertEqual((response.status_code, response.data["total"]), (202, 3))
+        self.assertEqual(outbox.relay(), 2)
+
+        progress = self.client.get(response.data["status_url"]).data
+        self.assertEqual((progress["processed"], progress["applied"], progress["finished"]), (3, 3, True))
+        self.assertEqual(PaymentTransaction.objects.filter(status="SUCCESS").count(), 3)
+
+    @override_settings(MPESA_REPLAY_MAX_ROWS=4)
+    def test_api_refuses_a_selection_over_the_row_cap(self):
+        response = self.client.post(
+            "/payments/callback/replay/bulk/", {"created_after": "2000-01-01"}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("more than 4", response.data["detail"])
+        self.assertFalse(CallbackReplayJob.objects.exists())
+
+    def test_chunk_that_keeps_failing_is_counted_and_the_job_still_finishes(self):
+        ids = [str(tx.pk) for tx in self.pending[:2]]
+        job = CallbackReplayJob.objects.create(source="api", total=3)
+        replay_callback_chunk.delay(str(job.pk), ids)
+        with self.assertLogs("payments.tasks", "ERROR"):
+            replay_callback_chunk.delay(str(job.pk), ["not-a-uuid"])
+
+        job.refresh_from_db()
+        self.assertEqual((job.processed, job.applied, job.failed), (2, 2, 1))
+        self.assertIsNotNone(job.finished_at)
+
+    def test_api_requires_a_selection_and_staff(self):
+        response = self.client.post("/payments/callback/replay/bulk/", {}, content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.client.logout()
+        response = self.client.post("/payments/callback/replay/bulk/", {"ids": []}, content_type="application/json")
+        self.assertEqual(response.status_code, 403)
+
+    def test_admin_retry_action_skips_final_rows(self):
+        self.client.post("/admin/payments/paymenttransaction/", {
+            "action": "retry_selected", "select_across": "1", "index": "0",
+            "_selected_action": [str(self.pending[0].pk)],
+        })
+        outbox.relay()
+        job = CallbackReplayJob.objects.get()
+        self.assertEqual((job.source, job.total, job.applied), ("admin", 5, 5))
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(PaymentTransaction.objects.get(mpesa_checkout_request_id="ws_CO_F").status, "FAILED")
+
+    def test_admin_reprocess_action_hands_logs_to_batch_processor(self):
+        payload = {"Body": {"stkCallback": {"CheckoutRequestID": "ws_CO_0", "ResultCode": 1032}}}
+        log = CallbackLog.objects.create(
+            checkout_request_id="ws_CO_0", payload=payload, processed=False, processing_status="error"
+        )
+        self.client.post("/admin/payments/callbacklog/", {
+            "action": "reprocess_selected", "index": "0", "_selected_action": [str(log.pk)],
+        })
+        self.assertEqual(OutboxMessage.objects.get().task_name, "payments.tasks.drain_callback_logs")
+        outbox.relay()
+        log.refresh_from_db()
+        self.assertEqual((log.processed, log.processing_status), (True, "TIMEOUT"))
+
+
+@override_settings(MPESA_EVENTS_BACKEND="local", MPESA_RATE_LIMIT_BACKEND="local", MPESA_CALLBACK_INGEST_ONLY=True)
+class TaskOutboxTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        PaymentTransaction.objects.create(
+            phone_number="254700000000", amount="10.00", status="PENDING", mpesa_checkout_request_id="ws_CO_1"
+        )
+
+    def tearDown(self):
+        app.conf.task_always_eager = self.eager
+
+    def callback(self):
+        payload = {"Body": {"stkCallback": {"CheckoutRequestID": "ws_CO_1", "ResultCode": 0}}}
+        return self.client.post("/payments/callback/", payload, content_type="application/json")
+
+    def test_callback_task_is_queued_with_the_log_and_published_by_the_relay(self):
+        self.assertEqual(self.callback().data["status"], "received")
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.task_name, "payments.tasks.process_callback_log")
+        self.assertEqual(PaymentTransaction.objects.get().status, "PENDING")
+
+        self.assertEqual(outbox.relay(), 1)
+        self.assertFalse(OutboxMessage.objects.exists())
+        self.assertEqual(PaymentTransaction.objects.get().status, "SUCCESS")
+
+    def test_beat_task_relays_when_no_relay_process_runs(self):
+        self.callback()
+        self.assertEqual(relay_task_outbox(), 1)
+        self.assertEqual(PaymentTransaction.objects.get().status, "SUCCESS")
+
+    def test_failed_publish_is_kept_and_retried_later(self):
+        self.callback()
+        OutboxMessage.objects.update(task_name="payments.tasks.no_such_task")
+
+        with self.assertLogs("payments.outbox", "WARNING"):
+            self.assertEqual(outbox.relay(), 0)
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.attempts, 1)
+        self.assertIn("no_such_task", message.last_error)
+        self.assertGreater(message.available_at, timezone.now())
+        self.assertEqual(outbox.relay(), 0)
+
+    def test_nothing_is_queued_when_the_transaction_rolls_back(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            outbox.enqueue(process_stk_callback, {})
+            raise RuntimeError
+        self.assertFalse(OutboxMessage.objects.exists())
+
+
+@override_settings(MPESA_EVENTS_BACKEND="local")
+class MetricsTests(TestCase):
+    def test_scrape_reports_pending_ages_and_final_statuses(self):
+        for checkout_id, age_minutes in (("ws_CO_1", 0), ("ws_CO_2", 3), ("ws_CO_3", 90)):
+            tx = PaymentTransaction.objects.create(
+                phone_number="254700000000", amount="10.00", status="PENDING", mpesa_checkout_request_id=checkout_id
+            )
+            PaymentTransaction.objects.filter(pk=tx.pk).update(
+                created_at=timezone.now() - datetime.timedelta(minutes=age_minutes)
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            transitions.transition_by_checkout_id("ws_CO_1", transitions.SUCCESS)
+
+        body = self.client.get("/metrics").content.decode()
+
+        self.assertIn('mpesa_pending_transactions{age="0s-60s"} 0.0', body)
+        self.assertIn('mpesa_pending_transactions{age="60s-300s"} 1.0', body)
+        self.assertIn('mpesa_pending_transactions{age="3600s+"} 1.0', body)
+        self.assertRegex(body, r'mpesa_transactions_final_total\{status="SUCCESS"\} [1-9]')
+
+    @override_settings(MPESA_METRICS_TOKEN="secret")
+    def test_scrape_requires_token_when_configured(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+
+
+class ReconciliationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def pending(self, n, updated_minutes_ago=0):
+        txs = PaymentTransaction.objects.bulk_create([
+            PaymentTransaction(phone_number="254700000000", amount="10.00", status="PENDING") for _ in range(n)
+        ])
+        PaymentTransaction.objects.filter(pk__in=[tx.pk for tx in txs]).update(
+            updated_at=timezone.now() - datetime.timedelta(minutes=updated_minutes_ago)
+        )
+        return {str(tx.pk) for tx in txs}
+
+    def read_ids(self, path):
+        opener = gzip.open if str(path).endswith(".gz") else open
+        with opener(path, "rt", newline="") as fh:
+            rows = list(csv.reader(fh))
+        self.assertEqual(rows[0], reconciliation.EXPORT_FIELDS)
+        return {row[0] for row in rows[1:]}
+
+    def test_export_streams_every_row_across_chunks(self):
+        ids = self.pending(5)
+        for name in ("report.csv", "report.csv.gz"):
+            path = f"{self.directory.name}/{name}"
+            rows = reconciliation.export_transactions(PaymentTransaction.objects.all(), path, chunk_size=2)
+            self.assertEqual(rows, 5)
+            self.assertEqual(self.read_ids(path), ids)
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ["report.csv", "report.csv.gz"])
+
+    def test_failed_export_leaves_no_file_behind(self):
+        path = f"{self.directory.name}/report.csv"
+        # CallbackLog has none of the export columns, so the query fails mid-export
+        with self.assertRaises(FieldError):
+            reconciliation.export_transactions(CallbackLog.objects.all(), path)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_runs_export_only_rows_changed_since_the_watermark(self):
+        with override_settings(MPESA_RECONCILE_EXPORT_DIR=self.directory.name, MPESA_RECONCILE_WATERMARK_LAG=0):
+            old = self.pending(3, updated_minutes_ago=60)
+            first = reconcile_transactions()
+            self.assertEqual(self.read_ids(first), old)
+            state = ReconciliationState.objects.get()
+            self.assertEqual((state.last_run_full, state.last_rows_scanned), (True, 3))
+
+            new = self.pending(1)
+            with self.assertLogs("payments.tasks", "INFO") as logs:
+                second = reconcile_transactions()
+            self.assertEqual(self.read_ids(second), new)
+            # The summary covers the same window as the export
+            self.assertIn("Reconciling 1 pending transactions...", "\n".join(logs.output))
+            state.refresh_from_db()
+            self.assertEqual((state.last_run_full, state.last_rows_scanned), (False, 1))
+
+            self.assertIsNone(reconcile_transactions())
+            self.assertEqual(self.read_ids(reconcile_transactions(full=True)), old | new)
+
+
+@override_settings(MPESA_EVENTS_BACKEND="local")
+class TransactionListTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client.login(username="admin", password="pw")
+        now = timezone.now()
+        self.txs = []
+        for n in range(5):
+            tx = PaymentTransaction.objects.create(
+                phone_number=f"25470000000{n % 2}", amount="10.00", status="PENDING" if n % 2 else "SUCCESS"
+            )
+            PaymentTransaction.objects.filter(pk=tx.pk).update(created_at=now - datetime.timedelta(days=n))
+            self.txs.append(str(tx.pk))
+
+    def ids(self, response):
+        return [row["id"] for row in response.data["results"]]
+
+    def test_requires_staff(self):
+        self.client.logout()
+        self.assertEqual(self.client.get("/payments/transactions/").status_code, 403)
+        User.objects.create_user("clerk", password="pw")
+        self.client.login(username="clerk", password="pw")
+        self.assertEqual(self.client.get("/payments/transactions/").status_code, 403)
+
+    def test_filters(self):
+        self.assertEqual(self.ids(self.client.get("/payments/transactions/?status=pending")), self.txs[1::2])
+        self.assertEqual(
+            self.ids(self.client.get("/payments/transactions/?phone_number=254700000000")), self.txs[0::2]
+        )
+        after = (timezone.now() - datetime.timedelta(days=2, hours=12)).isoformat()
+        before = (timezone.now() - datetime.timedelta(hours=12)).isoformat()
+        response = self.client.get("/payments/transactions/", {"created_after": after, "created_before": before})
+        self.assertEqual(self.ids(response), self.txs[1:3])
+        self.assertEqual(self.client.get("/payments/transactions/?status=nope").status_code, 400)
+        self.assertEqual(self.client.get("/payments/transactions/?cursor=garbage").status_code, 400)
+
+    def test_cursor_walks_every_row_once(self):
+        seen, url = [], "/payments/transactions/?limit=2"
+        while url:
+            response = self.client.get(url)
+            seen += self.ids(response)
+            url = response.data["next"]
+        self.assertEqual(seen, self.txs)
+
+    def test_unchanged_page_gets_304_until_a_row_changes(self):
+        first = self.client.get("/payments/transactions/?limit=2")
+        etag = first["ETag"]
+        self.assertEqual(self.client.get("/payments/transactions/?limit=2", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        transitions.transition(PaymentTransaction.objects.get(pk=self.txs[1]), transitions.CANCELLED)
+        changed = self.client.get("/payments/transactions/?limit=2", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed["ETag"], etag)
+
+
+class CallbackArchiveTests(TestCase):
+    def log(self, checkout_id, age_days, processed=True):
+        entry = CallbackLog.objects.create(
+            checkout_request_id=checkout_id, payload={"Body": {"stkCallback": {"CheckoutRequestID": checkout_id}}},
+            processed=processed,
+        )
+        CallbackLog.objects.filter(pk=entry.pk).update(
+            received_at=timezone.now() - datetime.timedelta(days=age_days)
+        )
+        return entry
+
+    def test_archives_old_processed_logs_and_finds_them_by_checkout_id(self):
+        old = [self.log(f"ws_CO_old{i}", 100 + i % 2) for i in range(5)]
+        stuck = self.log("ws_CO_stuck", 100, processed=False)
+        recent = self.log("ws_CO_recent", 1)
+
+        with tempfile.TemporaryDirectory() as directory:
+            result = archive.archive_callbacks(directory=directory, batch_size=2)
+
+            self.assertEqual(result["archived"], 5)
+            self.assertEqual(len(result["files"]), 2)
+            self.assertEqual(
+                set(CallbackLog.objects.values_list("pk", flat=True)), {stuck.pk, recent.pk}
+            )
+            found = list(archive.find_archived("ws_CO_old3", directory=directory))
+            self.assertEqual([record["id"] for record in found], [str(old[3].pk)])
+            self.assertEqual(found[0]["payload"]["Body"]["stkCallback"]["CheckoutRequestID"], "ws_CO_old3")
+            self.assertEqual(list(archive.find_archived("ws_CO_recent", directory=directory)), [])
+
+
+class _QueryOutageHandler(_Handler):
+    """Answers STK Push Query with a 500 that is not "still processing"."""
+
+    def do_POST(self):
+        if not self.path.startswith("/mpesa/stkpushquery/"):
+            return super().do_POST()
+        self.server.stub.record(self.path)
+        self._read_json()
+        self._send_json(500, {"errorCode": "500.003.02", "errorMessage": "System is busy"})
+
+
+class _QueryOutageStub(StubDarajaServer):
+    handler_class = _QueryOutageHandler
+
+
+@override_settings(MPESA_RATE_LIMIT_BACKEND="local", MPESA_PENDING_EXPIRY_MINUTES=60)
+class StalePendingResolverTests(StubDarajaMixin, TestCase):
+    def pending(self, checkout_id, age_minutes, status="PENDING"):
+        tx = PaymentTransaction.objects.create(
+            phone_number="254700000000", amount="10.00", status=status, mpesa_checkout_request_id=checkout_id
+        )
+        PaymentTransaction.objects.filter(pk=tx.pk).update(
+            created_at=timezone.now() - datetime.timedelta(minutes=age_minutes)
+        )
+        return tx
+
+    def status_of(self, tx):
+        tx.refresh_from_db()
+        return tx.status
+
+    def test_overlapping_run_is_skipped(self):
+        tx = self.pending("ws_CO_paid", 20)
+        cache.add(STALE_PENDING_LOCK_KEY, 1)
+        self.addCleanup(cache.delete, STALE_PENDING_LOCK_KEY)
+
+        self.assertIsNone(resolve_stale_pending())
+
+        self.assertEqual(self.status_of(tx), "PENDING")
+        self.assertNotIn("/mpesa/stkpushquery/v1/query", self.server.calls)
+        cache.delete(STALE_PENDING_LOCK_KEY)
+        resolve_stale_pending()
+        self.assertEqual(self.status_of(tx), "SUCCESS")
+
+    def test_resolves_stale_rows_from_query_results(self):
+        paid = self.pending("ws_CO_paid", 20)
+        timed_out = self.pending("ws_CO_timeout", 20)
+        waiting = self.pending("ws_CO_waiting", 20)
+        abandoned = self.pending("ws_CO_abandoned", 90)
+        fresh = self.pending("ws_CO_fresh", 1)
+        self.server.query_results.update({
+            "ws_CO_timeout": 1032, "ws_CO_waiting": None, "ws_CO_abandoned": None,
+        })
+
+        stats = resolve_stale_pending(batch_size=2)
+
+        self.assertEqual(stats, {"queried": 4, "resolved": 2, "expired": 1, "abandoned": 0})
+        self.assertEqual(self.status_of(paid), "SUCCESS")
+        self.assertEqual(self.status_of(timed_out), "TIMEOUT")
+        self.assertEqual(self.status_of(waiting), "PENDING")
+        self.assertEqual(self.status_of(abandoned), "TIMEOUT")
+        self.assertEqual(self.status_of(fresh), "PENDING")
+        self.assertEqual(self.server.calls["/mpesa/stkpushquery/v1/query"], 4)
+
+    def test_old_initiated_rows_are_failed_without_a_query(self):
+        lost = [self.pending(None, 20, status="INITIATED") for _ in range(3)]
+        queued = self.pending(None, 1, status="INITIATED")
+
+        stats = resolve_stale_pending(batch_size=2)
+
+        self.assertEqual(stats["abandoned"], 3)
+        self.assertEqual({self.status_of(tx) for tx in lost}, {"FAILED"})
+        self.assertEqual(self.status_of(queued), "INITIATED")
+        self.assertNotIn("/mpesa/stkpushquery/v1/query", self.server.calls)
+
+    def test_processing_replies_do_not_open_the_breaker(self):
+        self.server.default_query_result = None
+        for i in range(8):
+            self.pending(f"ws_CO_{i}", 20)
+        resolve_stale_pending()
+        self.assertEqual(get_client().breaker.state, "closed")
+
+    @override_settings(MPESA_STK_QUERY_CONCURRENCY=1)
+    def test_query_outage_opens_the_breaker(self):
+        self.server.stop()
+        self.server = _QueryOutageStub().start()
+        set_client(DarajaClient(base_url=self.server.url))
+        for i in range(8):
+            self.pending(f"ws_CO_{i}", 20)
+
+        stats = resolve_stale_pending()
+
+        self.assertEqual(get_client().breaker.state, "open")
+        self.assertEqual(stats["resolved"], 0)
+        # the breaker refused the rest once it opened
+        self.assertEqual(self.server.calls["/mpesa/stkpushquery/v1/query"], 5)
@@ -0,0 +1,216 @@
+"""
+Two-level, TTL-aware cache for the Daraja OAuth access token.
+
+Tokens are kept in process memory first and shared across gunicorn and Celery
+workers through Django's cache. A token is refreshed ahead of its expiry and
+only one caller per process (and, via a cache lock, per cluster) performs the
+refresh; everyone else keeps using the still-valid token or waits briefly for
+the new one.
+"""
+
+import logging
+import threading
+import time
+import uuid
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY = "mpesa:oauth:token"
+LOCK_KEY = "mpesa:oauth:token:lock"
+
+# Daraja tokens are valid for one hour; used when `expires_in` is missing.
+DEFAULT_EXPIRES_IN = 3599
+
+
+class AccessTokenMissing(requests.RequestException):
+    """OAuth answered without an access_token."""
+
+
+class AccessTokenCache:
+    """
+    Cache an access token returned by ``fetch``.
+
+    ``fetch`` is a callable returning ``(access_token, expires_in_seconds)``.
+    Any exception it raises propagates to the caller of ``get_token``, as
+    does ``AccessTokenMissing`` when it returns no token; neither is cached.
+    """
+
+    def __init__(self, fetch, cache_key=CACHE_KEY, lock_key=LOCK_KEY):
+        self._fetch = fetch
+        self.cache_key = cache_key
+        self.lock_key = lock_key
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+        self._counters = {"hits": 0, "shared_hits": 0, "misses": 0, "refreshes": 0, "errors": 0}
+        self._counters_lock = threading.Lock()
+
+    # -- settings -------------------------------------------------------
+
+    @property
+    def refresh_margin(self):
+        """Seconds before expiry at which a token is considered stale."""
+        return getattr(settings, "MPESA_TOKEN_REFRESH_MARGIN", 300)
+
+    @property
+    def lock_timeout(self):
+        """Seconds the cluster-wide refresh lock is held at most."""
+        return getattr(settings, "MPESA_TOKEN_LOCK_TIMEOUT", 15)
+
+    @property
+    def wait_timeout(self):
+        """Seconds a caller waits for another worker's refresh before fetching itself."""
+        return getattr(settings, "MPESA_TOKEN_WAIT_TIMEOUT", 5)
+
+    # -- public API -----------------------------------------------------
+
+    def get_token(self):
+        """Return a valid access token, refreshing it if needed."""
+        now = time.time()
+        token, expires_at = self._token, self._expires_at
+        if token and now < expires_at - self.refresh_margin:
+            self._incr("hits")
+            return token
+
+        with self._lock:
+            # Another thread may have refreshed while we waited on the lock.
+            now = time.time()
+            if self._token and now < self._expires_at - self.refresh_margin:
+                self._incr("hits")
+                return self._token
+
+            shared = self._read_shared()
+            if shared and now < shared[1] - self.refresh_margin:
+                self._incr("shared_hits")
+                self._token, self._expires_at = shared
+                return self._token
+
+            self._incr("misses")
+            return self._refresh(stale=shared or (self._token, self._expires_at))
+
+    def invalidate(self, rejected=None):
+        """
+        Drop the cached token, e.g. after Daraja rejects it with 401.
+
+        With ``rejected``, only drop it if it is still that token, so a
+        token another caller already replaced is kept.
+        """
+        with self._lock:
+            if rejected is not None and self._token not in (None, rejected):
+                return
+            self._token, self._expires_at = None, 0.0
+            try:
+                shared = cache.get(self.cache_key)
+                if rejected is None or not shared or shared.get("token") == rejected:
+                    cache.delete(self.cache_key)
+            except Exception:
+                logger.exception("Failed to delete shared access token")
+
+    def stats(self):
+        """Return a snapshot of the hit/miss/refresh counters."""
+        with self._counters_lock:
+            return dict(self._counters)
+
+    def reset_stats(self):
+        with self._counters_lock:
+            for key in self._counters:
+                self._counters[key] = 0
+
+    # -- internals ------------------------------------------------------
+
+    def _refresh(self, stale):
+        """Refresh the token, letting only one worker in the cluster call OAuth."""
+        stale_token, stale_expires_at = stale
+        still_valid = stale_token and time.time() < stale_expires_at
+
+        owner = self._acquire_shared_lock()
+        if not owner:
+            # Someone else is refreshing. Serve the old token while it lasts,
+            # otherwise wait for the new one to land in the shared cache.
+            if still_valid:
+                self._token, self._expires_at = stale_token, stale_expires_at
+                return stale_token
+            shared = self._wait_for_shared()
+            if shared:
+                self._token, self._expires_at = shared
+                return self._token
+            logger.warning("Timed out waiting for shared access token refresh; fetching directly")
+
+        try:
+            token, expires_in = self._fetch()
+            if not token:
+                raise AccessTokenMissing("OAuth response carried no access_token")
+        except Exception:
+            self._incr("errors")
+            if still_valid:
+                logger.exception("Access token refresh failed; reusing current token")
+                return stale_token
+            raise
+        finally:
+            self._release_shared_lock(owner)
+
+        self._incr("refreshes")
+        expires_in = int(expires_in or DEFAULT_EXPIRES_IN)
+        self._token, self._expires_at = token, time.time() + expires_in
+        self._write_shared(token, self._expires_at, expires_in)
+        logger.info("Refreshed M-Pesa access token (expires in %ss)", expires_in)
+        return token
+
+    def _read_shared(self):
+        try:
+            value = cache.get(self.cache_key)
+        except Exception:
+            logger.exception("Failed to read shared access token")
+            return None
+        if not value:
+            return None
+        return value.get("token"), float(value.get("expires_at", 0))
+
+    def _write_shared(self, token, expires_at, expires_in):
+        try:
+            cache.set(self.cache_key, {"token": token, "expires_at": expires_at}, timeout=expires_in)
+        except Exception:
+            logger.exception("Failed to store shared access token")
+
+    def _acquire_shared_lock(self):
+        """
+        Return this holder's lock token, None if another worker holds the
+        lock, or True when the cache is down and we refresh without it.
+        """
+        owner = uuid.uuid4().hex
+        try:
+            return owner if cache.add(self.lock_key, owner, timeout=self.lock_timeout) else None
+        except Exception:
+            logger.exception("Failed to acquire access token lock; refreshing without it")
+            return True
+
+    def _release_shared_lock(self, owner):
+        # Only delete our own lock: after lock_timeout it may belong to someone else
+        if not isinstance(owner, str):
+            return
+        try:
+            if cache.get(self.lock_key) == owner:
+                cache.delete(self.lock_key)
+        except Exception:
+            logger.exception("Failed to release access token lock")
+
+    def _wait_for_shared(self):
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            shared = self._read_shared()
+            if shared and shared[0] and time.time() < shared[1]:
+                self._incr("shared_hits")
+                return shared
+        return None
+
+    def _incr(self, name):
+        with self._counters_lock:
+            self._counters[name] += 1
+        metrics.TOKEN_CACHE.labels(name).inc()
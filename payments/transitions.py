@@ -0,0 +1,175 @@
+"""
+Single source of truth for PaymentTransaction status changes.
+
+Every status change is a conditional, single-statement update::
+
+    UPDATE ... SET status = 'SUCCESS', updated_at = now
+    WHERE id = ... AND status IN ('PENDING')
+
+so concurrent duplicate callbacks cannot both win, no row has to be loaded
+first, and only the changed columns are written. Successful changes
+invalidate the polling status cache (``payments.status_cache``), and moves
+to a terminal status are pushed to waiting clients (``payments.events``) and
+counted in ``payments.metrics``.
+"""
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+from . import events, metrics, status_cache
+from .models import PaymentTransaction
+
+INITIATED = "INITIATED"
+PENDING = "PENDING"
+SUCCESS = "SUCCESS"
+FAILED = "FAILED"
+CANCELLED = "CANCELLED"
+TIMEOUT = "TIMEOUT"
+
+TERMINAL_STATUSES = frozenset({SUCCESS, FAILED, CANCELLED, TIMEOUT})
+
+# target status -> statuses it may be reached from
+ALLOWED_FROM = {
+    INITIATED: frozenset(),
+    PENDING: frozenset({INITIATED}),
+    SUCCESS: frozenset({PENDING}),
+    FAILED: frozenset({INITIATED, PENDING}),
+    CANCELLED: frozenset({PENDING}),
+    TIMEOUT: frozenset({PENDING}),
+}
+
+RESULT_CODE_MAPPING = {
+    0: SUCCESS,
+    1: FAILED,
+    2: CANCELLED,
+    1032: TIMEOUT,
+}
+
+
+class InvalidTransition(ValueError):
+    """Raised for a target status the state machine does not know."""
+
+
+def status_for_result_code(result_code):
+    """Map an M-Pesa ResultCode (int or str) to a transaction status."""
+    try:
+        result_code = int(result_code)
+    except (TypeError, ValueError):
+        return FAILED
+    return RESULT_CODE_MAPPING.get(result_code, FAILED)
+
+
+def allowed_from(to_status):
+    try:
+        return ALLOWED_FROM[to_status]
+    except KeyError:
+        raise InvalidTransition(f"unknown status {to_status!r}") from None
+
+
+def can_transition(from_status, to_status):
+    return from_status in allowed_from(to_status)
+
+
+def _update(queryset, to_status, fields):
+    now = timezone.now()
+    updated = queryset.filter(status__in=allowed_from(to_status)).update(
+        status=to_status, updated_at=now, **fields
+    )
+    return updated, now
+
+
+def transition(tx, to_status, **fields):
+    """
+    Move ``tx`` to ``to_status`` if its current DB status allows it.
+
+    ``fields`` are extra columns written in the same statement. Returns True
+    if this call won the transition, in which case ``tx`` is updated in
+    memory as well.
+    """
+    updated, now = _update(PaymentTransaction.objects.filter(pk=tx.pk), to_status, fields)
+    if not updated:
+        return False
+    status_cache.invalidate(pks=[tx.pk])
+    if to_status in TERMINAL_STATUSES:
+        events.publish_final(rows=[(tx.pk, to_status, now, fields)])
+        metrics.count_final([to_status])
+    tx.status = to_status
+    tx.updated_at = now
+    for name, value in fields.items():
+        setattr(tx, name, value)
+    return True
+
+
+async def atransition(tx, to_status, **fields):
+    """``transition`` for async views; the update runs in Django's sync thread."""
+    return await sync_to_async(transition)(tx, to_status, **fields)
+
+
+def transition_by_checkout_id(checkout_id, to_status, **fields):
+    """Like ``transition`` but keyed on the M-Pesa CheckoutRequestID."""
+    if not checkout_id:
+        return False
+    updated, _ = _update(
+        PaymentTransaction.objects.filter(mpesa_checkout_request_id=checkout_id), to_status, fields
+    )
+    if updated:
+        status_cache.invalidate(checkout_ids=[checkout_id])
+        if to_status in TERMINAL_STATUSES:
+            events.publish_final(checkout_ids=[checkout_id])
+            metrics.count_final([to_status])
+    return bool(updated)
+
+
+def bulk_transition(changes):
+    """
+    Apply many transitions with one locking read and one UPDATE.
+
+    ``changes`` maps a transaction pk to ``(to_status, fields)``. Rows whose
+    current status does not allow their move are left untouched. Returns the
+    set of pks that transitioned.
+    """
+    if not changes:
+        return set()
+    for to_status, _ in changes.values():
+        allowed_from(to_status)
+
+    with transaction.atomic():
+        current = dict(
+            PaymentTransaction.objects.select_for_update()
+            .filter(pk__in=list(changes))
+            .values_list("pk", "status")
+        )
+        eligible = {
+            pk: change for pk, change in changes.items()
+            if pk in current and can_transition(current[pk], change[0])
+        }
+        if not eligible:
+            return set()
+
+        now = timezone.now()
+        field_names = {name for _, fields in eligible.values() for name in fields}
+        values = {
+            "status": Case(
+                *[When(pk=pk, then=Value(to_status)) for pk, (to_status, _) in eligible.items()],
+                default=F("status"),
+            ),
+            "updated_at": now,
+        }
+        for name in field_names:
+            whens = [
+                When(pk=pk, then=Value(fields[name]))
+                for pk, (_, fields) in eligible.items() if name in fields
+            ]
+            values[name] = Case(*whens, default=F(name))
+
+        PaymentTransaction.objects.filter(pk__in=list(eligible)).update(**values)
+        status_cache.invalidate(pks=eligible)
+        final = [
+            (pk, to_status, now, fields)
+            for pk, (to_status, fields) in eligible.items() if to_status in TERMINAL_STATUSES
+        ]
+        events.publish_final(rows=final)
+        metrics.count_final([to_status for _, to_status, _, _ in final])
+    return set(eligible)
@@ -1,9 +1,44 @@
 from django.urls import path
 
-from .views import STKPushView, STKCallbackView, ReplayCallbackView
+from .views import (
+    BulkReplayCallbackDetailView,
+    BulkReplayCallbackView,
+    BulkSTKPushDetailView,
+    BulkSTKPushView,
+    ReplayCallbackView,
+    STKCallbackView,
+    STKPushView,
+    TransactionByCheckoutView,
+    TransactionDetailView,
+    TransactionListView,
+    query_profiles,
+    stk_callback_async,
+    stk_push_async,
+    transaction_events,
+)
 
 urlpatterns = [
     path('stk-push/', STKPushView.as_view(), name='stk_push'),
+    path('stk-push/bulk/', BulkSTKPushView.as_view(), name='stk_push_bulk'),
+    path('stk-push/bulk/<uuid:pk>/', BulkSTKPushDetailView.as_view(), name='stk_push_bulk_detail'),
     path('callback/', STKCallbackView.as_view(), name='stk_callback'),
+    # Native async variants for ASGI deployments
+    path('async/stk-push/', stk_push_async, name='stk_push_async'),
+    path('async/callback/', stk_callback_async, name='stk_callback_async'),
+    path('transactions/', TransactionListView.as_view(), name='transaction_list'),
+    path('transactions/<uuid:pk>/', TransactionDetailView.as_view(), name='transaction_detail'),
+    path('transactions/<uuid:pk>/events/', transaction_events, name='transaction_events'),
+    path(
+        'transactions/checkout/<str:checkout_id>/',
+        TransactionByCheckoutView.as_view(),
+        name='transaction_by_checkout',
+    ),
+    path('callback/replay/bulk/', BulkReplayCallbackView.as_view(), name='stk_callback_replay_bulk'),
+    path(
+        'callback/replay/bulk/<uuid:pk>/',
+        BulkReplayCallbackDetailView.as_view(),
+        name='stk_callback_replay_bulk_detail',
+    ),
     path('callback/replay/<str:checkout_id>/', ReplayCallbackView.as_view(), name='stk_callback_replay'),
+    path('debug/queries/', query_profiles, name='query_profiles'),
 ]
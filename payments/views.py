@@ -2,57 +2,76 @@
 Implement M-Pesa STK Push initiation and webhook callback handling.
 """
 
+import asyncio
 import base64
+import csv
 import datetime
+import hashlib
+import io
 import json
 import logging
+import time
+import uuid
 from decimal import Decimal
 
 import requests
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, Q
+from django.http import Http404, HttpResponse, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, get_object_or_404
 from django.contrib import messages
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.decorators import method_decorator
+from django.utils.http import http_date
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import status
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .models import PaymentTransaction
-from .tasks import process_stk_callback
+from .models import CallbackLog, CallbackReplayJob, PaymentBatch, PaymentTransaction
+from .serializers import PaymentTransactionSerializer
+from . import callbacks, dedup, events, metrics, outbox, profiling, status_cache, transitions
+from .tasks import (
+    ReplaySelectionTooLarge,
+    enqueue_stk_push_chunks,
+    initiate_stk_push,
+    process_callback_log,
+    process_stk_callback,
+    start_callback_replay,
+)
+from .idempotency import idempotent
+from .daraja import (
+    CircuitBreaker,
+    DarajaRateLimited,
+    build_stk_push_payload,
+    get_access_token,
+    get_async_client,
+    get_client,
+)
 
 logger = logging.getLogger(__name__)
 
 
-def _mpesa_base_urls():
-    """Return base URLs depending on MPESA_ENV (sandbox or production)."""
-    if getattr(settings, "MPESA_ENV", "sandbox").lower() == "production":
-        return {
-            "oauth": "https://api.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials",
-            "stk_push": "https://api.safaricom.co.ke/mpesa/stkpush/v1/processrequest",
-        }
-    # sandbox
-    return {
-        "oauth": "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials",
-        "stk_push": "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest",
-    }
-
-
 def _get_access_token():
-    """Obtain an OAuth access token from Safaricom/M-Pesa."""
-    urls = _mpesa_base_urls()
-    resp = requests.get(urls["oauth"], auth=(settings.MPESA_CONSUMER_KEY, settings.MPESA_CONSUMER_SECRET), timeout=10)
-    resp.raise_for_status()
-    data = resp.json()
-    return data.get("access_token")
+    """Obtain an OAuth access token, served from the shared token cache."""
+    return get_access_token()
 
 
 class STKPushView(APIView):
     """
     POST: { "phone_number": "2547XXXXXXXX", "amount": "100" }
     Initiates M-Pesa STK Push and creates/updates a PaymentTransaction.
+    Send an Idempotency-Key header to make client retries safe.
     """
 
+    @idempotent
     def post(self, request):
         phone = request.data.get("phone_number")
         amount = request.data.get("amount")
@@ -65,26 +84,15 @@ class STKPushView(APIView):
         except Exception:
             return Response({"detail": "invalid amount"}, status=status.HTTP_400_BAD_REQUEST)
 
-        tx = PaymentTransaction.objects.create(phone_number=phone, amount=amount)
+        # Fail fast without creating a transaction while Daraja is known to be down
+        if get_client().breaker.state == CircuitBreaker.OPEN:
+            return Response({"detail": "payment provider unavailable"}, status=status.HTTP_502_BAD_GATEWAY)
 
-        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        password_str = f"{settings.MPESA_SHORTCODE}{settings.MPESA_PASSKEY}{timestamp}"
-        password = base64.b64encode(password_str.encode()).decode("utf-8")
+        if getattr(settings, "MPESA_STK_PUSH_ASYNC", False):
+            return self._post_async(phone, amount)
 
-        callback_url = getattr(settings, "MPESA_CALLBACK_URL", "")
-        payload = {
-            "BusinessShortCode": settings.MPESA_SHORTCODE,
-            "Password": password,
-            "Timestamp": timestamp,
-            "TransactionType": "CustomerPayBillOnline",
-            "Amount": int(amount),  # M-Pesa expects integer amounts
-            "PartyA": phone,
-            "PartyB": settings.MPESA_SHORTCODE,
-            "PhoneNumber": phone,
-            "CallBackURL": callback_url,
-            "AccountReference": "Payment",
-            "TransactionDesc": "Payment",
-        }
+        tx = PaymentTransaction.objects.create(phone_number=phone, amount=amount)
+        payload = build_stk_push_payload(phone, amount)
 
         try:
             access_token = _get_access_token()
@@ -92,36 +100,464 @@ class STKPushView(APIView):
             logger.exception("Failed to get access token: %s", e)
             return Response({"detail": "failed to obtain access token"}, status=status.HTTP_502_BAD_GATEWAY)
 
-        headers = {"Authorization": f"Bearer {access_token}"}
         try:
-            urls = _mpesa_base_urls()
-            resp = requests.post(urls["stk_push"], json=payload, headers=headers, timeout=15)
-            resp.raise_for_status()
-            response_data = resp.json()
+            response_data = get_client().stk_push(payload, access_token)
+        except DarajaRateLimited as e:
+            logger.warning("STK push shed by rate limiter: %s", e)
+            transitions.transition(tx, transitions.FAILED)
+            response = Response({"detail": "too many requests, retry later"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            response["Retry-After"] = "1"
+            return response
         except requests.RequestException as e:
             logger.exception("STK push request failed: %s", e)
-            tx.status = "FAILED"
-            tx.save()
+            transitions.transition(tx, transitions.FAILED)
             return Response({"detail": "stk push failed"}, status=status.HTTP_502_BAD_GATEWAY)
 
         # update transaction if push accepted
         if response_data.get("ResponseCode") == "0":
-            tx.mpesa_checkout_request_id = response_data.get("CheckoutRequestID")
-            tx.status = "PENDING"
-            tx.save()
+            transitions.transition(
+                tx, transitions.PENDING, mpesa_checkout_request_id=response_data.get("CheckoutRequestID")
+            )
         else:
-            tx.status = "FAILED"
-            tx.save()
+            transitions.transition(tx, transitions.FAILED)
 
         return Response(response_data, status=status.HTTP_200_OK)
 
+    def _post_async(self, phone, amount):
+        """Record the transaction and hand the Daraja round trip to Celery."""
+        with transaction.atomic():
+            tx = PaymentTransaction.objects.create(phone_number=phone, amount=amount)
+            outbox.enqueue(initiate_stk_push, str(tx.id))
+        return Response(
+            {
+                "transaction_id": str(tx.id),
+                "status": tx.status,
+                "status_url": reverse("transaction_detail", args=[tx.id]),
+                "events_url": reverse("transaction_events", args=[tx.id]),
+            },
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+
+@csrf_exempt
+async def stk_push_async(request):
+    """
+    POST: { "phone_number": "2547XXXXXXXX", "amount": "100" }
+
+    Same contract as STKPushView, served natively on the event loop: the
+    Daraja round trip goes through AsyncDarajaClient and the DB writes
+    through Django's async ORM, so a push waiting on Daraja holds no
+    thread. Needs an ASGI server. Idempotency-Key is only honoured by
+    STKPushView.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return JsonResponse({"detail": "expected a JSON object"}, status=status.HTTP_400_BAD_REQUEST)
+
+    phone = data.get("phone_number")
+    amount = data.get("amount")
+    if not phone or amount is None:
+        return JsonResponse({"detail": "phone_number and amount are required"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        amount = Decimal(str(amount))
+    except Exception:
+        return JsonResponse({"detail": "invalid amount"}, status=status.HTTP_400_BAD_REQUEST)
+
+    client = get_async_client()
+    if client.breaker.state == CircuitBreaker.OPEN:
+        return JsonResponse({"detail": "payment provider unavailable"}, status=status.HTTP_502_BAD_GATEWAY)
+
+    tx = await PaymentTransaction.objects.acreate(phone_number=phone, amount=amount)
+    payload = build_stk_push_payload(phone, amount)
+
+    try:
+        access_token = await sync_to_async(get_access_token, thread_sensitive=False)()
+    except requests.RequestException as e:
+        logger.exception("Failed to get access token: %s", e)
+        return JsonResponse({"detail": "failed to obtain access token"}, status=status.HTTP_502_BAD_GATEWAY)
+
+    try:
+        response_data = await client.stk_push(payload, access_token)
+    except DarajaRateLimited as e:
+        logger.warning("STK push shed by rate limiter: %s", e)
+        await transitions.atransition(tx, transitions.FAILED)
+        response = JsonResponse(
+            {"detail": "too many requests, retry later"}, status=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+        response["Retry-After"] = "1"
+        return response
+    except requests.RequestException as e:
+        logger.exception("STK push request failed: %s", e)
+        await transitions.atransition(tx, transitions.FAILED)
+        return JsonResponse({"detail": "stk push failed"}, status=status.HTTP_502_BAD_GATEWAY)
+
+    if response_data.get("ResponseCode") == "0":
+        await transitions.atransition(
+            tx, transitions.PENDING, mpesa_checkout_request_id=response_data.get("CheckoutRequestID")
+        )
+    else:
+        await transitions.atransition(tx, transitions.FAILED)
+
+    return JsonResponse(response_data, status=status.HTTP_200_OK)
+
+
+def _parse_bulk_amount(value):
+    """Return ``value`` as a positive Decimal that fits PaymentTransaction.amount, or raise ValidationError."""
+    value = str(value).strip() if value is not None else ""
+    if not value:
+        raise ValidationError("amount is required")
+    amount = PaymentTransaction._meta.get_field("amount").clean(value, None)
+    if amount <= 0:
+        raise ValidationError("amount must be greater than zero")
+    return amount
+
+
+def _parse_bulk_rows(request):
+    """Return phone/amount rows from a JSON array or an uploaded CSV file."""
+    upload = request.FILES.get("file")
+    if upload is not None:
+        text = io.TextIOWrapper(upload.file, encoding="utf-8-sig")
+        return list(csv.DictReader(text))
+    data = request.data
+    if isinstance(data, dict):
+        data = data.get("items")
+    if not isinstance(data, list):
+        raise ValueError("expected a list of items or a CSV file")
+    return data
+
+
+class BulkSTKPushView(APIView):
+    """
+    POST: [{ "phone_number": "2547XXXXXXXX", "amount": "100" }, ...]
+    or { "items": [...] } or a multipart CSV upload in "file" with
+    phone_number,amount columns.
+
+    Creates every PaymentTransaction in one bulk insert, fans the Daraja calls
+    out to Celery in chunks and returns the batch id for progress polling.
+    Every row is validated first; any invalid row rejects the whole batch
+    with per-row errors. Staff only.
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        try:
+            rows = _parse_bulk_rows(request)
+        except (ValueError, csv.Error) as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not rows:
+            return Response({"detail": "no items supplied"}, status=status.HTTP_400_BAD_REQUEST)
+
+        max_items = getattr(settings, "MPESA_BULK_MAX_ITEMS", 10000)
+        if len(rows) > max_items:
+            return Response({"detail": f"at most {max_items} items per batch"}, status=status.HTTP_400_BAD_REQUEST)
+
+        items, errors = [], []
+        for index, row in enumerate(rows):
+            if not isinstance(row, dict):
+                errors.append({"row": index, "detail": "expected an object with phone_number and amount"})
+                continue
+            phone = str(row.get("phone_number") or "").strip()
+            if not phone:
+                errors.append({"row": index, "detail": "phone_number is required"})
+                continue
+            try:
+                amount = _parse_bulk_amount(row.get("amount"))
+            except ValidationError as e:
+                errors.append({"row": index, "detail": " ".join(e.messages)})
+                continue
+            items.append((phone, amount))
+
+        if errors:
+            return Response({"detail": "invalid items", "errors": errors[:100]}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            batch = PaymentBatch.objects.create(total=len(items))
+            txs = PaymentTransaction.objects.bulk_create(
+                [PaymentTransaction(phone_number=phone, amount=amount, batch=batch) for phone, amount in items],
+                batch_size=1000,
+            )
+            enqueue_stk_push_chunks([tx.id for tx in txs])
+
+        return Response(
+            {
+                "batch_id": str(batch.id),
+                "total": batch.total,
+                "status_url": reverse("stk_push_bulk_detail", args=[batch.id]),
+            },
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+
+class BulkSTKPushDetailView(APIView):
+    """GET: per-status counts and per-item progress for a bulk STK push batch. Staff only."""
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, pk):
+        batch = get_object_or_404(PaymentBatch, pk=pk)
+        txs = batch.transactions.order_by()
+        counts = {row["status"]: row["n"] for row in txs.values("status").annotate(n=Count("id"))}
+        items = [
+            {**item, "amount": str(item["amount"])}
+            for item in txs.values("id", "phone_number", "amount", "status", "mpesa_checkout_request_id")
+        ]
+        return Response(
+            {
+                "batch_id": str(batch.id),
+                "created_at": batch.created_at,
+                "total": batch.total,
+                "counts": counts,
+                "items": items,
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
+def _etag(items, *extra):
+    """Weak validator over the ids and updated_at of serialized transactions."""
+    digest = hashlib.sha1()
+    for item in items:
+        digest.update(f"{item['id']}:{item['updated_at']}\n".encode("utf-8"))
+    for part in extra:
+        digest.update(f"{part}\n".encode("utf-8"))
+    return f'W/"{digest.hexdigest()}"'
+
+
+def _with_validators(response, etag, last_modified):
+    response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified.timestamp())
+    return response
+
+
+# All that callers other than staff see of a polled transaction: enough to
+# follow a push, without the customer's phone number or the amount
+PUBLIC_STATUS_FIELDS = ("id", "status", "updated_at")
+
+
+def _visible_status(data, staff):
+    """The serialized transaction for staff, its PUBLIC_STATUS_FIELDS for anyone else."""
+    if data is None or staff:
+        return data
+    return {field: data[field] for field in PUBLIC_STATUS_FIELDS}
+
+
+def _status_response(request, data):
+    """200 with the transaction, or 304 if the client's validators still match."""
+    if data is None:
+        return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+    staff = request.user.is_staff
+    data = _visible_status(data, staff)
+    etag = _etag([data], "full" if staff else "public")
+    updated_at = parse_datetime(data["updated_at"])
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(updated_at.timestamp()))
+    if not_modified is not None:
+        return _with_validators(not_modified, etag, updated_at)
+    return _with_validators(Response(data, status=status.HTTP_200_OK), etag, updated_at)
+
+
+class TransactionDetailView(APIView):
+    """
+    GET: current state of a PaymentTransaction, for clients polling an
+    asynchronous STK push (INITIATED -> PENDING -> SUCCESS / FAILED ...).
+
+    Served from the status cache, so steady polling costs no DB reads.
+    Sends ETag / Last-Modified from updated_at; a poll with a matching
+    If-None-Match or If-Modified-Since gets 304. Only staff see the phone
+    number and amount; other callers get PUBLIC_STATUS_FIELDS.
+    """
+
+    def get(self, request, pk):
+        return _status_response(request, status_cache.get_by_id(pk))
+
 
-RESULT_CODE_MAPPING = {
-    0: "SUCCESS",
-    1: "FAILED",
-    2: "CANCELLED",
-    1032: "TIMEOUT",
-}
+class TransactionByCheckoutView(APIView):
+    """GET: like TransactionDetailView, looked up by M-Pesa CheckoutRequestID."""
+
+    def get(self, request, checkout_id):
+        return _status_response(request, status_cache.get_by_checkout_id(checkout_id))
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _status_events(pk, staff=False):
+    """
+    Yield the current status, then wait for the final one. The waiter is
+    registered before the status is re-read so a change in between is not
+    missed. A row deleted meanwhile ends the stream with an ``error`` event.
+    """
+    waiter = events.subscribe(pk)
+    try:
+        data = await sync_to_async(status_cache.get_by_id)(pk)
+        if data is None:
+            yield _sse("error", {"id": str(pk), "detail": "Not found."})
+            return
+        if data["status"] in transitions.TERMINAL_STATUSES:
+            yield _sse("final", _visible_status(data, staff))
+            return
+        yield f"retry: {getattr(settings, 'MPESA_EVENTS_RETRY_MS', 3000)}\n\n"
+        yield _sse("status", _visible_status(data, staff))
+
+        loop = asyncio.get_running_loop()
+        keepalive = getattr(settings, "MPESA_EVENTS_KEEPALIVE", 15)
+        deadline = loop.time() + getattr(settings, "MPESA_EVENTS_TIMEOUT", 300)
+        queue = waiter[1]
+        while (remaining := deadline - loop.time()) > 0:
+            try:
+                change = await asyncio.wait_for(queue.get(), min(keepalive, remaining))
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield _sse("final", _visible_status({**data, **change}, staff))
+            return
+
+        # Out of time (or a message was lost): report what the DB says now
+        data = await sync_to_async(status_cache.get_by_id)(pk)
+        if data is None:
+            yield _sse("error", {"id": str(pk), "detail": "Not found."})
+        else:
+            event = "final" if data["status"] in transitions.TERMINAL_STATUSES else "status"
+            yield _sse(event, _visible_status(data, staff))
+    finally:
+        events.unsubscribe(pk, waiter)
+
+
+async def transaction_events(request, pk):
+    """
+    GET: Server-Sent Events stream for one transaction.
+
+    Sends a ``status`` event with the current state, then a single ``final``
+    event when the transaction reaches SUCCESS / FAILED / CANCELLED /
+    TIMEOUT, and closes. Streams give up after MPESA_EVENTS_TIMEOUT seconds
+    with the latest status; EventSource clients then reconnect. Needs an
+    ASGI server: under WSGI every open stream would hold a worker thread.
+    Events carry the same fields as TransactionDetailView's responses.
+    """
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    if await sync_to_async(status_cache.get_by_id)(pk) is None:
+        return JsonResponse({"detail": "Not found."}, status=404)
+    user = await request.auser()
+    response = StreamingHttpResponse(_status_events(pk, user.is_staff), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def _encode_cursor(tx):
+    raw = f"{tx.created_at.isoformat()}|{tx.pk}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(value):
+    """Return the (created_at, id) position encoded in a cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)).decode("utf-8")
+        created_at, pk = raw.split("|", 1)
+        position = (parse_datetime(created_at), uuid.UUID(pk))
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("invalid cursor")
+    if position[0] is None:
+        raise ValueError("invalid cursor")
+    return position
+
+
+def _parse_bound(value, name, end=False):
+    """Parse a created_after / created_before value (datetime or date)."""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f"{name} must be an ISO date or datetime")
+        parsed = datetime.datetime.combine(day, datetime.time.min)
+        if end:
+            parsed += datetime.timedelta(days=1)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class TransactionListView(APIView):
+    """
+    GET: newest-first list of PaymentTransactions.
+
+    Query parameters: status, phone_number, created_after, created_before
+    (ISO date or datetime; a bare date in created_before covers the whole
+    day), limit and cursor. Pages are keyset-paginated on (created_at, id):
+    follow ``next`` rather than building offsets, so every page costs the
+    same however deep the client goes. No total count is computed.
+
+    The response carries an ETag over the page's ids and updated_at values;
+    repeat the request with If-None-Match to get 304 while nothing changed.
+    Staff only: rows carry customers' phone numbers and amounts.
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        params = request.query_params
+        queryset = PaymentTransaction.objects.only(*PaymentTransactionSerializer.Meta.fields)
+
+        try:
+            limit = int(params.get("limit", getattr(settings, "MPESA_TRANSACTIONS_PAGE_SIZE", 50)))
+        except ValueError:
+            return Response({"detail": "limit must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+        limit = max(1, min(limit, getattr(settings, "MPESA_TRANSACTIONS_MAX_PAGE_SIZE", 200)))
+
+        status_filter = params.get("status")
+        if status_filter:
+            status_filter = status_filter.upper()
+            if status_filter not in dict(PaymentTransaction.STATUS_CHOICES):
+                return Response({"detail": f"unknown status {status_filter}"}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(status=status_filter)
+        if params.get("phone_number"):
+            queryset = queryset.filter(phone_number=params["phone_number"])
+
+        try:
+            if params.get("created_after"):
+                queryset = queryset.filter(created_at__gte=_parse_bound(params["created_after"], "created_after"))
+            if params.get("created_before"):
+                queryset = queryset.filter(
+                    created_at__lt=_parse_bound(params["created_before"], "created_before", end=True)
+                )
+            if params.get("cursor"):
+                created_at, pk = _decode_cursor(params["cursor"])
+                queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+        except ValueError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # One extra row tells us whether there is a next page without a COUNT
+        rows = list(queryset.order_by("-created_at", "-id")[: limit + 1])
+        next_url = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            query = params.copy()
+            query["cursor"] = _encode_cursor(rows[-1])
+            next_url = request.build_absolute_uri(f"{request.path}?{query.urlencode()}")
+
+        results = PaymentTransactionSerializer(rows, many=True).data
+        etag = _etag(results, next_url)
+        last_modified = max((row.updated_at for row in rows), default=None)
+        # Only the ETag decides 304 here: a row that left the filter does not
+        # move the page's newest updated_at, so If-Modified-Since could lie.
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return _with_validators(not_modified, etag, last_modified)
+
+        response = Response(
+            {"results": results, "next": next_url},
+            status=status.HTTP_200_OK,
+        )
+        return _with_validators(response, etag, last_modified)
 
 
 @method_decorator(csrf_exempt, name="dispatch")
@@ -136,103 +572,45 @@ class STKCallbackView(APIView):
     permission_classes = []
 
     def post(self, request):
+        started = time.perf_counter()
+        ingest = getattr(settings, "MPESA_CALLBACK_INGEST_ONLY", False)
+        response = self._ingest(request) if ingest else self._process(request)
+        metrics.observe_callback("ingest" if ingest else "sync", response.data.get("status"), started)
+        return response
+
+    def _process(self, request):
+        callback = None
+        claimed = False
         try:
             # 1. Parse payload safely
             data = json.loads(request.body.decode("utf-8"))
             callback = data.get("Body", {}).get("stkCallback", {})
 
-            checkout_id = callback.get("CheckoutRequestID")
-            result_code = callback.get("ResultCode")
-            result_desc = callback.get("ResultDesc")
-            callback_amount = None
-
-            # Extract amount if available (from CallbackMetadata)
-            items = callback.get("CallbackMetadata", {}).get("Item", [])
-            for item in items:
-                if item.get("Name") == "Amount":
-                    try:
-                        callback_amount = float(item.get("Value", 0))
-                    except Exception:
-                        callback_amount = None
-
-            if not checkout_id:
-                logger.warning("Callback ignored: no CheckoutRequestID")
-                return Response({"status": "ignored"}, status=200)
-
-            # 2. Retrieve transaction safely
-            tx = PaymentTransaction.objects.filter(
-                mpesa_checkout_request_id=checkout_id
-            ).first()
-            if not tx:
-                logger.warning("Transaction not found for ID: %s", checkout_id)
-                return Response({"status": "transaction not found"}, status=200)
-
-            # 3. Idempotency / duplicate callback protection
-            if tx.status in ["SUCCESS", "FAILED"]:
-                logger.info(
-                    "Duplicate callback received for %s. Current status: %s",
-                    checkout_id, tx.status
-                )
-                return Response({"status": "already processed"}, status=200)
-
-            # 4. Map result code
-            try:
-                result_code_int = int(result_code)
-            except Exception:
-                result_code_int = None
-
-            status_str = RESULT_CODE_MAPPING.get(result_code_int, "FAILED")
-
-            # 5. Amount verification
-            if callback_amount is not None:
-                try:
-                    expected_amount = float(tx.amount)
-                    if expected_amount != callback_amount:
-                        logger.warning(
-                            "Amount mismatch for %s: expected %.2f, callback %.2f",
-                            checkout_id, expected_amount, callback_amount
-                        )
-                        tx.status = "FAILED"
-                        tx.save()
-                        return Response({"status": "error", "detail": "amount mismatch"}, status=200)
-                except Exception:
-                    logger.exception("Error verifying amount for %s", checkout_id)
-                    tx.status = "FAILED"
-                    tx.save()
-                    return Response({"status": "error", "detail": "amount verification error"}, status=200)
-
-            # 6. Update transaction
-            tx.status = status_str
-            tx.save()
-
-            # Persist callback log if model exists
-            try:
-                from .models import CallbackLog
-                CallbackLog.objects.create(
-                    checkout_request_id=checkout_id,
-                    payload=data,
-                    processed=True,
-                    processing_status=status_str,
-                    details=result_desc or "",
-                )
-            except Exception:
-                logger.exception("Failed to persist callback log for %s", checkout_id)
+            # 2. Drop M-Pesa retries of a callback we already took, before any DB work
+            parsed = callbacks.parse_stk_callback(data)
+            if not dedup.claim(parsed["checkout_id"], parsed["result_code"]):
+                return Response({"status": callbacks.DUPLICATE}, status=200)
+            claimed = True
 
-            logger.info(
-                "Callback processed: %s -> %s, desc: %s",
-                checkout_id, status_str, result_desc
-            )
+            # 3. Validate and apply the status transition, log it and queue the task
+            result = _apply_callback(data)
 
-            # Enqueue asynchronous processing
-            process_stk_callback.delay(data)
+            if result.outcome == callbacks.NOT_FOUND:
+                # May arrive before the push response is saved; let the retry through
+                dedup.release(parsed["checkout_id"], parsed["result_code"])
+            if result.outcome in (callbacks.AMOUNT_MISMATCH, callbacks.AMOUNT_ERROR):
+                return Response({"status": "error", "detail": result.outcome}, status=200)
+            if result.outcome != callbacks.PROCESSED:
+                return Response({"status": result.outcome}, status=200)
 
             return Response({"status": "processed"}, status=200)
 
         except Exception as e:
             logger.exception("Callback processing error: %s", e)
+            if claimed:
+                dedup.release(parsed["checkout_id"], parsed["result_code"])
             # Try to persist failed callback for later inspection
             try:
-                from .models import CallbackLog
                 CallbackLog.objects.create(
                     checkout_request_id=(callback.get("CheckoutRequestID") if isinstance(callback, dict) else None),
                     payload=(data if 'data' in locals() else {}),
@@ -245,6 +623,133 @@ class STKCallbackView(APIView):
 
             return Response({"status": "error", "detail": str(e)}, status=200)
 
+    def _ingest(self, request):
+        """
+        Fast path: durably record the raw callback with a single insert and
+        acknowledge M-Pesa. Validation and the status change happen once, in
+        process_callback_log or the drain_callback_logs batch consumer.
+        """
+        body = request.body.decode("utf-8", errors="replace")
+        try:
+            data = json.loads(body)
+        except ValueError:
+            logger.warning("Malformed callback body stored for inspection")
+            CallbackLog.objects.create(
+                payload={"raw": body}, processed=True, processing_status="error", details="malformed JSON"
+            )
+            return Response({"status": "error", "detail": "malformed JSON"}, status=200)
+
+        parsed = callbacks.parse_stk_callback(data)
+        checkout_id = parsed["checkout_id"]
+        if not dedup.claim(checkout_id, parsed["result_code"]):
+            return Response({"status": callbacks.DUPLICATE}, status=200)
+        try:
+            _ingest_callback(checkout_id, data)
+        except Exception:
+            dedup.release(checkout_id, parsed["result_code"])
+            raise
+        return Response({"status": "received"}, status=200)
+
+
+def _apply_callback(data):
+    """
+    Apply a callback and, when it moved the transaction, log it and queue
+    process_stk_callback through the outbox, all in one DB transaction.
+    """
+    with transaction.atomic():
+        result = callbacks.apply_stk_callback(data)
+        if result.outcome == callbacks.PROCESSED:
+            CallbackLog.objects.create(
+                checkout_request_id=result.checkout_id,
+                payload=data,
+                processed=True,
+                processing_status=result.status,
+                details=result.result_desc or "",
+            )
+            outbox.enqueue(process_stk_callback, data)
+    return result
+
+
+def _ingest_callback(checkout_id, data):
+    """Store a raw callback and queue process_callback_log in the same DB transaction."""
+    with transaction.atomic():
+        log = CallbackLog.objects.create(
+            checkout_request_id=checkout_id,
+            payload=data,
+            processed=False,
+            processing_status=callbacks.RECEIVED,
+        )
+        # With batching on, drain_callback_logs picks the row up instead
+        if not getattr(settings, "MPESA_CALLBACK_BATCHING", False):
+            outbox.enqueue(process_callback_log, str(log.id))
+    return log
+
+
+@csrf_exempt
+async def stk_callback_async(request):
+    """
+    Async variant of STKCallbackView for ASGI deployments.
+
+    Same rules and responses: never a 4xx to M-Pesa, retries de-duplicated
+    before any DB access, and the ingest-only fast path when
+    MPESA_CALLBACK_INGEST_ONLY is set. The transition, log row and queued
+    task share STKCallbackView's helpers, so they commit together.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    started = time.perf_counter()
+    response = await _handle_callback_async(request)
+    metrics.observe_callback("async", json.loads(response.content).get("status"), started)
+    return response
+
+
+async def _handle_callback_async(request):
+    body = request.body.decode("utf-8", errors="replace")
+    try:
+        data = json.loads(body)
+    except ValueError:
+        logger.warning("Malformed callback body stored for inspection")
+        await CallbackLog.objects.acreate(
+            payload={"raw": body}, processed=True, processing_status="error", details="malformed JSON"
+        )
+        return JsonResponse({"status": "error", "detail": "malformed JSON"}, status=200)
+
+    parsed = callbacks.parse_stk_callback(data)
+    checkout_id = parsed["checkout_id"]
+    if not await sync_to_async(dedup.claim)(checkout_id, parsed["result_code"]):
+        return JsonResponse({"status": callbacks.DUPLICATE}, status=200)
+
+    try:
+        if getattr(settings, "MPESA_CALLBACK_INGEST_ONLY", False):
+            await sync_to_async(_ingest_callback)(checkout_id, data)
+            return JsonResponse({"status": "received"}, status=200)
+
+        result = await sync_to_async(_apply_callback)(data)
+        if result.outcome == callbacks.NOT_FOUND:
+            await sync_to_async(dedup.release)(checkout_id, parsed["result_code"])
+        if result.outcome in (callbacks.AMOUNT_MISMATCH, callbacks.AMOUNT_ERROR):
+            return JsonResponse({"status": "error", "detail": result.outcome}, status=200)
+        if result.outcome != callbacks.PROCESSED:
+            return JsonResponse({"status": result.outcome}, status=200)
+
+        return JsonResponse({"status": "processed"}, status=200)
+
+    except Exception as e:
+        logger.exception("Callback processing error: %s", e)
+        await sync_to_async(dedup.release)(checkout_id, parsed["result_code"])
+        try:
+            await CallbackLog.objects.acreate(
+                checkout_request_id=checkout_id,
+                payload=data,
+                processed=False,
+                processing_status="error",
+                details=str(e),
+            )
+        except Exception:
+            logger.exception("Failed to persist failed callback")
+        return JsonResponse({"status": "error", "detail": str(e)}, status=200)
+
 
 # Replay endpoint for manual reprocessing/reconciliation
 class ReplayCallbackView(APIView):
@@ -269,14 +774,102 @@ class ReplayCallbackView(APIView):
         }
 
         # enqueue background processing
-        process_stk_callback.delay(payload)
+        outbox.enqueue(process_stk_callback, payload)
         return Response({"status": "replayed"}, status=200)
 
 
+def _replay_job_data(job):
+    return {
+        "job_id": str(job.id),
+        "created_at": job.created_at,
+        "source": job.source,
+        "selection": job.selection,
+        "total": job.total,
+        "processed": job.processed,
+        "applied": job.applied,
+        "failed": job.failed,
+        "finished": job.finished_at is not None,
+        "finished_at": job.finished_at,
+    }
+
+
+class BulkReplayCallbackView(APIView):
+    """
+    POST: { "ids": [...], "checkout_ids": [...], "created_after": "...",
+    "created_before": "..." } (all optional, combined with AND; at least one
+    is required).
+
+    Replays a success callback, like ReplayCallbackView, for every matching
+    PENDING transaction: the work is fanned out to Celery in chunks of
+    MPESA_REPLAY_CHUNK_SIZE and the job id is returned for progress polling.
+    Staff only.
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        data = request.data if isinstance(request.data, dict) else {}
+        queryset = PaymentTransaction.objects.all()
+        selection = {}
+        max_items = getattr(settings, "MPESA_BULK_MAX_ITEMS", 10000)
+
+        for key, field in (("ids", "pk__in"), ("checkout_ids", "mpesa_checkout_request_id__in")):
+            values = data.get(key)
+            if values is None:
+                continue
+            if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+                return Response({"detail": f"{key} must be a list of strings"}, status=status.HTTP_400_BAD_REQUEST)
+            if len(values) > max_items:
+                return Response({"detail": f"at most {max_items} {key}"}, status=status.HTTP_400_BAD_REQUEST)
+            if key == "ids":
+                try:
+                    values = [str(uuid.UUID(v)) for v in values]
+                except ValueError:
+                    return Response({"detail": "ids must be UUIDs"}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(**{field: values})
+            selection[key] = values
+
+        try:
+            if data.get("created_after"):
+                queryset = queryset.filter(created_at__gte=_parse_bound(data["created_after"], "created_after"))
+                selection["created_after"] = data["created_after"]
+            if data.get("created_before"):
+                queryset = queryset.filter(
+                    created_at__lt=_parse_bound(data["created_before"], "created_before", end=True)
+                )
+                selection["created_before"] = data["created_before"]
+        except (TypeError, ValueError) as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not selection:
+            return Response(
+                {"detail": "give ids, checkout_ids or a created_after/created_before range"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            job = start_callback_replay(queryset, "api", selection, created_by=request.user.get_username())
+        except ReplaySelectionTooLarge as e:
+            return Response({"detail": f"{e}; narrow it"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(
+            {**_replay_job_data(job), "status_url": reverse("stk_callback_replay_bulk_detail", args=[job.id])},
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+
+class BulkReplayCallbackDetailView(APIView):
+    """GET: progress of a bulk callback replay job."""
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, pk):
+        return Response(_replay_job_data(get_object_or_404(CallbackReplayJob, pk=pk)), status=status.HTTP_200_OK)
+
+
 def admin_retry_callback(request, transaction_id):
     tx = get_object_or_404(PaymentTransaction, id=transaction_id)
 
-    if tx.status != "PENDING":
+    if tx.status != transitions.PENDING:
         messages.warning(request, f"Transaction {tx.id} is not PENDING.")
         return redirect("/admin/payments/paymenttransaction/")
 
@@ -289,6 +882,25 @@ def admin_retry_callback(request, transaction_id):
         }
     }
 
-    process_stk_callback.delay(payload)
+    outbox.enqueue(process_stk_callback, payload)
     messages.success(request, f"Transaction {tx.id} enqueued for retry.")
     return redirect("/admin/payments/paymenttransaction/")
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint; see ``payments.metrics``."""
+    if not metrics.authorized(request):
+        return HttpResponse(status=401)
+    body, content_type = metrics.render()
+    return HttpResponse(body, content_type=content_type)
+
+
+def query_profiles(request):
+    """Staff-only view of this process's query profiling ring buffer."""
+    if not request.user.is_staff or profiling.output_mode() not in ("buffer", "both"):
+        raise Http404
+    try:
+        limit = int(request.GET.get("limit", 50))
+    except ValueError:
+        limit = 50
+    return JsonResponse({"profiles": profiling.recent(limit)})